@@ -0,0 +1,305 @@
+"""Access log module
+
+Contains a WSGI middleware that writes a structured access log: one
+JSON object per line for every request, with its method, path, route,
+status, size, duration, the logged in user, and the time spent in
+storage operations (see :func:`metrics.start_timings`)::
+
+    {"time": "2016-03-01T12:00:00.123", "method": "GET", "path": "/",
+     "route": "/", "status": 200, "bytes": 5120, "ms": 3.2,
+     "user": "jessie", "remote": "127.0.0.1", "storage_ms": 1.9,
+     "storage": {"load_received_messages": [1, 1.9], ...}}
+
+Each ``storage`` entry is ``[calls, milliseconds]``; operations called
+by other operations are counted in both, and ``storage_ms`` is the
+total.
+
+Handling a request only appends a record (a tuple of values the
+request already had) to an in-memory buffer, a
+:class:`collections.deque`, whose appends and pops are atomic without
+taking a lock. Everything else (parsing the cookie, formatting, JSON
+encoding and writing) is done by an :class:`AccessLogWriter` thread,
+which empties the buffer in batches every ``flush_interval`` seconds
+(or sooner, once ``batch_size`` records are waiting) and rotates the
+file once it reaches ``max_bytes``. A slow disk only slows down the
+writer: if the buffer fills up, new records are dropped and counted in
+``rockettalk_access_log_records_total``, and requests never wait.
+
+The log is off unless a path is configured (``server.py
+--access-log``), in which case bottle's own line per request on
+stderr is turned off. Workers must not share a file, since each
+rotates its own; a ``{pid}`` in the path is replaced by the process
+ID.
+
+"""
+import json
+import os
+import threading
+import time
+import traceback
+
+from collections import deque
+from http.cookies import SimpleCookie
+
+import metrics
+
+
+_settings = {
+    "path": None,            # Where to write the log, or None for no log
+    "max_bytes": 64 * 1024 * 1024,  # Rotate the file once this large
+    "backups": 5,            # Rotated files kept: path.1 ... path.N
+    "flush_interval": 1.0,   # Most seconds a record waits to be written
+    "batch_size": 1000,      # Records that wake the writer early
+    "max_buffer": 100000,    # Records held before new ones are dropped
+}
+_buffer = deque()
+_wake = threading.Event()
+
+
+def configure(path=None, max_bytes=None, backups=None, flush_interval=None,
+              batch_size=None, max_buffer=None):
+    """Updates the access log settings.
+
+    Arguments left as ``None`` are not changed.
+
+    :param str path: The file to write the log to. ``{pid}`` is
+        replaced by the process ID; any other braces are kept as they
+        are. ``""`` turns the log off.
+    :param int max_bytes: The size at which the file is rotated
+    :param int backups: How many rotated files to keep. ``0`` means the
+        file is emptied instead.
+    :param float flush_interval: How many seconds to wait between
+        writes
+    :param int batch_size: How many waiting records make the writer
+        write early
+    :param int max_buffer: The most records to hold in memory
+
+    """
+    if path is not None:
+        _settings["path"] = (path.replace("{pid}", str(os.getpid()))
+                             if path else None)
+    if max_bytes is not None:
+        if max_bytes < 1:
+            raise ValueError("max_bytes must be at least 1")
+        _settings["max_bytes"] = max_bytes
+    if backups is not None:
+        _settings["backups"] = backups
+    if flush_interval is not None:
+        if flush_interval <= 0:
+            raise ValueError("flush_interval must be positive")
+        _settings["flush_interval"] = flush_interval
+    if batch_size is not None:
+        _settings["batch_size"] = batch_size
+    if max_buffer is not None:
+        _settings["max_buffer"] = max_buffer
+
+
+def is_enabled():
+    """Checks whether an access log path is configured."""
+    return _settings["path"] is not None
+
+
+class AccessLogMiddleware:
+    """WSGI middleware that records every request in the buffer
+    described in the module documentation, once its response has been
+    sent (that is, once the server closes the response iterable).
+
+    When the log is off, requests are passed straight through.
+
+    :param app: The WSGI application to wrap
+
+    """
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if _settings["path"] is None:
+            return self.app(environ, start_response)
+        started = time.time()
+        start = time.perf_counter()
+        timings = metrics.start_timings()
+        status = [None]
+
+        def recording_start_response(status_line, headers, exc_info=None):
+            status[0] = status_line
+            return start_response(status_line, headers, exc_info)
+
+        def finish(size):
+            metrics.stop_timings()
+            _record((started, time.perf_counter() - start,
+                     environ.get("REQUEST_METHOD"),
+                     environ.get("PATH_INFO"), environ.get("bottle.route"),
+                     status[0], size, environ.get("HTTP_COOKIE"),
+                     environ.get("REMOTE_ADDR"), timings))
+
+        try:
+            result = self.app(environ, recording_start_response)
+        except BaseException:
+            status[0] = status[0] or "500"
+            finish(0)
+            raise
+        return _CountingIterable(result, finish)
+
+
+class _CountingIterable:
+    """Wraps a WSGI response iterable, counting the bytes sent, and
+    calls ``on_close`` with the count once the server closes it."""
+    def __init__(self, iterable, on_close):
+        self.iterable = iterable
+        self.on_close = on_close
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.iterable:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, "close"):
+                self.iterable.close()
+        finally:
+            on_close, self.on_close = self.on_close, None
+            if on_close is not None:
+                on_close(self.size)
+
+
+def _record(record):
+    if len(_buffer) >= _settings["max_buffer"]:
+        metrics.inc("rockettalk_access_log_records_total", outcome="dropped")
+        return
+    _buffer.append(record)
+    if len(_buffer) == _settings["batch_size"]:
+        _wake.set()
+
+
+def _format(record):
+    """Turns a buffered record into a line of JSON."""
+    (started, duration, method, path, route, status, size, cookie,
+     remote, timings) = record
+    total = timings.pop(None)
+    line = {
+        "time": "{}.{:03d}".format(
+            time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+            int(started % 1 * 1000)),
+        "method": method,
+        "path": path,
+        "route": route.rule if route is not None else None,
+        "status": int(status.split(" ", 1)[0]) if status else None,
+        "bytes": size,
+        "ms": round(duration * 1000, 3),
+        "user": _username(cookie),
+        "remote": remote,
+        "storage_ms": round(total * 1000, 3),
+        "storage": {op: [calls, round(seconds * 1000, 3)]
+                    for op, (calls, seconds) in timings.items()},
+    }
+    return json.dumps(line, separators=(",", ":")) + "\n"
+
+
+def _username(cookie):
+    morsel = SimpleCookie(cookie or "").get("logged_in_as")
+    if morsel is not None and morsel.value:
+        return morsel.value
+    return None
+
+
+class AccessLogWriter(threading.Thread):
+    """A daemon thread that writes buffered records to the access log
+    in batches (see the module documentation), until :meth:`stop` is
+    called.
+
+    A batch that cannot be written is counted as dropped, and the
+    error printed; later batches are still tried.
+
+    """
+    def __init__(self):
+        super().__init__(name="access-log", daemon=True)
+        self._stop_event = threading.Event()
+        self._file = None
+        self._size = 0
+
+    def run(self):
+        while not self._stop_event.is_set():
+            _wake.wait(_settings["flush_interval"])
+            _wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Writes every buffered record now.
+
+        :returns: How many records were written
+
+        """
+        lines = []
+        while True:
+            try:
+                lines.append(_format(_buffer.popleft()))
+            except IndexError:
+                break
+        if not lines:
+            return 0
+        data = "".join(lines).encode("utf-8")
+        try:
+            self._write(data)
+        except OSError:
+            metrics.inc("rockettalk_access_log_records_total", len(lines),
+                        outcome="dropped")
+            traceback.print_exc()
+            return 0
+        metrics.inc("rockettalk_access_log_records_total", len(lines),
+                    outcome="written")
+        return len(lines)
+
+    def _write(self, data):
+        path = _settings["path"]
+        if self._file is None or self._file.name != path:
+            self._open(path)
+        if self._size and self._size + len(data) > _settings["max_bytes"]:
+            self._rotate(path)
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+
+    def _open(self, path):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(path, "ab")
+        self._size = self._file.tell()
+
+    def _rotate(self, path):
+        self._file.close()
+        backups = _settings["backups"]
+        if backups:
+            for number in range(backups - 1, 0, -1):
+                older = "{}.{}".format(path, number)
+                if os.path.exists(older):
+                    os.replace(older, "{}.{}".format(path, number + 1))
+            os.replace(path, path + ".1")
+        else:
+            os.remove(path)
+        self._file = None
+        self._open(path)
+        metrics.inc("rockettalk_access_log_rotations_total")
+
+    def stop(self):
+        """Asks the writer to finish, waits for it (if it was started),
+        and writes whatever is still buffered."""
+        self._stop_event.set()
+        _wake.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+metrics.describe("rockettalk_access_log_records_total", "counter",
+                 "Access log records, by outcome (written, or dropped "
+                 "because the buffer was full or the write failed).")
+metrics.describe("rockettalk_access_log_rotations_total", "counter",
+                 "Times the access log file was rotated.")
+metrics.register_gauge("rockettalk_access_log_buffered",
+                       "Access log records waiting to be written.",
+                       lambda: len(_buffer))
@@ -0,0 +1,290 @@
+"""Admission module
+
+Contains a WSGI middleware that sheds load when the server is busier
+than it can handle, so that a burst of traffic slows down a few
+requests (which are turned away quickly) rather than every request.
+
+Two kinds of limit are applied:
+
+* **Concurrency limits** - Every request belongs to a *route class*
+  (see :data:`ROUTE_CLASSES`), and each class may only have so many
+  requests in flight at once. A request that finds its class full
+  waits in a short queue; if no slot frees up within the queue
+  timeout, or the queue is full too, it is answered with
+  ``503 Service Unavailable``. Expensive pages (listing, shredding)
+  get tight limits, and static assets loose ones.
+* **Rate limits** - Each user may only send messages (``POST
+  /compose/``) at a set rate, with bursts allowed up to a set size (a
+  token bucket). Sending faster than that is answered with ``429 Too
+  Many Requests``.
+
+Both answers carry a ``Retry-After`` header, and cost no more than a
+dictionary lookup and a lock: the request never reaches bottle. The
+middleware wraps the session middleware (not the other way around),
+so a rejected request does not decode its session cookie either; the
+rate limit reads the ``logged_in_as`` cookie itself.
+
+Requests in flight, time spent queueing and requests turned away are
+recorded in the ``rockettalk_admission_*`` metrics.
+
+"""
+import math
+import re
+import threading
+import time
+
+from http.cookies import SimpleCookie
+
+import metrics
+
+
+ROUTE_CLASSES = (
+    ("list", re.compile(r"/$")),
+    ("shred", re.compile(r"/shred/$")),
+    ("assets", re.compile(r"/assets/")),
+    ("admin", re.compile(r"/admin/")),
+    ("metrics", re.compile(r"/metrics$")),
+)
+"""``(name, pattern)`` pairs, tried in order against the request path
+(with :meth:`re.Pattern.match`). Requests matching none of them are in
+the ``other`` class."""
+
+_settings = {
+    # Most requests of each route class in flight at once
+    "limits": {"list": 4, "shred": 1, "assets": 64, "admin": 2,
+               "metrics": 4, "other": 16},
+    "max_queue": 32,        # Most requests waiting per route class
+    "queue_timeout": 0.5,   # Seconds a request may wait for a slot
+    "compose_rate": None,   # Messages per second per user, or None
+    "compose_burst": 10,    # Messages a user may send at once
+}
+_gates = {}
+_gates_lock = threading.Lock()
+_buckets = {}  # username -> [tokens, time of last update]
+_buckets_lock = threading.Lock()
+
+MAX_BUCKETS = 10000
+"""Once this many users have token buckets, full buckets (which would
+behave the same as new ones) are dropped"""
+
+
+def configure(limits=None, max_queue=None, queue_timeout=None,
+              compose_rate=None, compose_burst=None):
+    """Updates the admission settings.
+
+    Arguments left as ``None`` are not changed.
+
+    :param dict limits: Maps route class names (see
+        :data:`ROUTE_CLASSES`, plus ``"other"``) to the most requests
+        of that class to handle at once. Classes left out keep their
+        limit.
+    :param int max_queue: The most requests of a class that may wait
+        for a slot at once
+    :param float queue_timeout: How many seconds a request may wait
+        for a slot before it is turned away
+    :param float compose_rate: How many messages per second each user
+        may send in the long run. ``0`` turns rate limiting off.
+    :param int compose_burst: How many messages a user may send in a
+        quick burst
+
+    """
+    if limits is not None:
+        for name, limit in limits.items():
+            if name not in _settings["limits"]:
+                raise ValueError("Unknown route class {!r}".format(name))
+            if limit < 1:
+                raise ValueError("limits must be at least 1")
+        _settings["limits"].update(limits)
+    if max_queue is not None:
+        _settings["max_queue"] = max_queue
+    if queue_timeout is not None:
+        _settings["queue_timeout"] = queue_timeout
+    if compose_rate is not None:
+        _settings["compose_rate"] = compose_rate or None
+    if compose_burst is not None:
+        if compose_burst < 1:
+            raise ValueError("compose_burst must be at least 1")
+        _settings["compose_burst"] = compose_burst
+    with _gates_lock:
+        _gates.clear()  # Picked up by the next request of each class
+    with _buckets_lock:
+        _buckets.clear()
+
+
+def route_class(path):
+    """Returns the name of the route class a request path belongs to."""
+    for name, pattern in ROUTE_CLASSES:
+        if pattern.match(path):
+            return name
+    return "other"
+
+
+class _Gate:
+    """Lets a limited number of requests through at once, with a
+    bounded queue of requests waiting for a turn."""
+    def __init__(self, limit, max_queue):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def enter(self, timeout):
+        """Takes a slot, waiting up to ``timeout`` seconds for one.
+
+        :returns: True if a slot was taken
+
+        """
+        with self.condition:
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                return True
+            if self.waiting >= self.max_queue:
+                return False
+            self.waiting += 1
+            try:
+                if not self.condition.wait_for(
+                        lambda: self.active < self.limit, timeout):
+                    return False
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def leave(self):
+        """Gives a slot back."""
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+
+def _gate(name):
+    with _gates_lock:
+        gate = _gates.get(name)
+        if gate is None:
+            gate = _gates[name] = _Gate(_settings["limits"][name],
+                                        _settings["max_queue"])
+        return gate
+
+
+def take_token(username, now=None):
+    """Takes a token from a user's compose bucket.
+
+    :param str username: The user sending a message
+    :param float now: The current :func:`time.monotonic` time
+
+    :returns: 0 if a token was taken (or rate limiting is off),
+        otherwise how many seconds until one is available
+
+    """
+    rate = _settings["compose_rate"]
+    if rate is None:
+        return 0
+    burst = _settings["compose_burst"]
+    now = time.monotonic() if now is None else now
+    with _buckets_lock:
+        bucket = _buckets.get(username)
+        if bucket is None:
+            if len(_buckets) >= MAX_BUCKETS:
+                _drop_full_buckets(now, rate, burst)
+            bucket = _buckets[username] = [burst, now]
+        tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0
+        bucket[0] = tokens
+        return (1 - tokens) / rate
+
+
+def _drop_full_buckets(now, rate, burst):
+    for username, (tokens, last) in list(_buckets.items()):
+        if tokens + (now - last) * rate >= burst:
+            del _buckets[username]
+
+
+def _reject(start_response, status, retry_after, text):
+    body = text.encode("utf-8")
+    start_response(status, [
+        ("Content-Type", "text/plain; charset=utf-8"),
+        ("Content-Length", str(len(body))),
+        ("Retry-After", str(max(1, int(math.ceil(retry_after))))),
+    ])
+    return [body]
+
+
+def _username(environ):
+    cookie = SimpleCookie(environ.get("HTTP_COOKIE", ""))
+    morsel = cookie.get("logged_in_as")
+    if morsel is not None and morsel.value:
+        return morsel.value
+    return environ.get("REMOTE_ADDR", "")
+
+
+class AdmissionMiddleware:
+    """WSGI middleware that applies the concurrency and rate limits
+    described in the module documentation.
+
+    A request holds its slot until its response has been sent (that
+    is, until the server closes the response iterable), so a page that
+    is streamed counts for as long as it is being sent.
+
+    :param app: The WSGI application to wrap
+
+    """
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "/")
+        name = route_class(path)
+        if path == "/compose/" and environ.get("REQUEST_METHOD") == "POST":
+            wait = take_token(_username(environ))
+            if wait:
+                metrics.inc("rockettalk_admission_rejected_total",
+                            route=name, reason="rate")
+                return _reject(start_response, "429 Too Many Requests",
+                               wait, "Too many messages sent. Please slow "
+                                     "down.")
+
+        gate = _gate(name)
+        start = time.perf_counter()
+        if not gate.enter(_settings["queue_timeout"]):
+            metrics.inc("rockettalk_admission_rejected_total", route=name,
+                        reason="concurrency")
+            return _reject(start_response, "503 Service Unavailable",
+                           _settings["queue_timeout"],
+                           "The server is busy. Please try again shortly.")
+        metrics.observe("rockettalk_admission_queue_seconds",
+                        time.perf_counter() - start, route=name)
+        try:
+            result = self.app(environ, start_response)
+        except BaseException:
+            gate.leave()
+            raise
+        return metrics.ClosingIterable(result, gate.leave)
+
+
+def _in_flight():
+    with _gates_lock:
+        return {(("route", name),): gate.active
+                for name, gate in _gates.items()}
+
+
+def _queued():
+    with _gates_lock:
+        return {(("route", name),): gate.waiting
+                for name, gate in _gates.items()}
+
+
+metrics.describe("rockettalk_admission_queue_seconds", "histogram",
+                 "Time requests waited for a slot, by route class.")
+metrics.describe("rockettalk_admission_rejected_total", "counter",
+                 "Requests turned away, by route class and reason "
+                 "(concurrency or rate).")
+metrics.register_gauge("rockettalk_admission_in_flight",
+                       "Requests being handled, by route class.",
+                       _in_flight)
+metrics.register_gauge("rockettalk_admission_queued",
+                       "Requests waiting for a slot, by route class.",
+                       _queued)
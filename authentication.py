@@ -4,12 +4,21 @@ Contains helper functions for checking whether a user is logged in.
 
 """
 import json
+import re
 from functools import wraps
 
 from bottle import request, redirect
 
 from alerts import save_danger
-from message import load_message
+from message import find_message_header
+import metrics
+from metrics import timer
+
+
+ADMIN_USERS = set()
+"""Usernames (lowercase) that may use administrative features such as
+profiling. Filled in from the ``--admin`` command line option of
+``server.py``."""
 
 
 def requires_authentication(func):
@@ -55,12 +64,13 @@ def requires_authorization(func):
       redirected to ``/login/`` using :func:`bottle.redirect`, so that
       they may login.
 
-    * If they are logged in, the message corresponding to the
-      ``message_id`` is loaded using :func:`message.load_message`.
+    * If they are logged in, the sender and recipient of the message
+      corresponding to the ``message_id`` are looked up in the message
+      index using :func:`message.find_message_header`, so no file is
+      opened (not even for IDs that do not exist).
 
-        * If :func:`message.load_message` raises an :class:`OSError`,
-          a danger alert is saved, and the user is redirected to
-          ``/``.
+        * If there is no such message, a danger alert is saved, and
+          the user is redirected to ``/``.
 
     * Then, we check that the loaded message was either sent **to**
       the current user, or sent **from** the current user.
@@ -97,17 +107,88 @@ def requires_authorization(func):
         if not username:  # i.e. username cookie is blank or empty
             redirect("/login/")
         else:  # user is logged in
-            try:
-                msg = load_message(message_id)
-                if msg["to"] == username or msg["from"] == username:
-                    return func(message_id, *args, **kwargs)  # all clear!
-                else:  # User is not sender or recepient of message
-                    save_danger("User not authorized to view message")
-                    redirect("/")
-            except OSError:
+            msg = find_message_header(message_id)
+            if msg is None:
+                metrics.inc("rockettalk_authorization_total",
+                            outcome="unknown")
                 err = "No such message " + message_id
                 save_danger(err)
                 redirect("/")
+            elif is_authorized(username, msg):
+                metrics.inc("rockettalk_authorization_total",
+                            outcome="allowed")
+                return func(message_id, *args, **kwargs)  # all clear!
+            else:  # User is not sender or recepient of message
+                metrics.inc("rockettalk_authorization_total",
+                            outcome="forbidden")
+                save_danger("User not authorized to view message")
+                redirect("/")
+    return wrapper
+
+
+def is_authorized(username, msg):
+    """Checks whether a user may see a message: only its sender and its
+    recipient may (see :func:`authentication.requires_authorization`).
+
+    :param str username: The logged in user
+    :param dict msg: A loaded message, or just its header
+
+    """
+    return msg["to"] == username or msg["from"] == username
+
+
+def may_view_message(username, message_id):
+    """Like :func:`authentication.is_authorized`, but for a message ID
+    taken from user input (e.g., a form field).
+
+    :returns: False if ``message_id`` is not a valid message ID, if
+        there is no such message, or if the user may not see it
+
+    """
+    if not re.fullmatch(r"[0-9a-f\-]{36}", message_id):
+        return False
+    msg = find_message_header(message_id)
+    return msg is not None and is_authorized(username, msg)
+
+
+def is_admin(username):
+    """Checks whether a user may use administrative features.
+
+    :param str username: The username to check (may be ``None``)
+
+    :returns: True if ``username`` is listed in
+        :data:`authentication.ADMIN_USERS`, otherwise False
+
+    """
+    return bool(username) and username.lower() in ADMIN_USERS
+
+
+def requires_admin(func):
+    """Updates a handler, so that only administrators may use it.
+
+    * If the ``"logged_in_as"`` cookie is missing or blank, then the
+      user is redirected to ``/login/``.
+
+    * If the user is logged in, but is not an administrator (see
+      :func:`authentication.is_admin`), a danger alert is saved and
+      they are redirected to ``/``.
+
+    * Otherwise, the wrapped handler is called as usual.
+
+    :param func: A handler function to wrap
+    :returns: The wrapped function
+
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        username = request.get_cookie("logged_in_as")
+        if not username:
+            redirect("/login/")
+        elif not is_admin(username):
+            save_danger("Administrator access required")
+            redirect("/")
+        else:
+            return func(*args, **kwargs)
     return wrapper
 
 
@@ -138,6 +219,7 @@ def validate_login_form(form):
     return errors
 
 
+@timer("rockettalk_password_check_seconds")
 def check_password(username, password):
     """Checks a user's password using a plaintext password file.
 
@@ -162,3 +244,8 @@ def check_password(username, password):
         return pw_list[username] == password
     else:
         return False
+
+
+metrics.describe("rockettalk_authorization_total", "counter",
+                 "Message authorization checks, by outcome (allowed, "
+                 "forbidden, or unknown for IDs with no such message).")
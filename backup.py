@@ -0,0 +1,418 @@
+"""Backup module
+
+Contains helper functions for backing up the message store while the
+server is running, and for restoring it.
+
+A backup is a consistent snapshot of ``messages/`` (see
+:func:`message.begin_snapshot`): it holds exactly the messages that
+existed at one moment, however many are sent or deleted while it is
+being written, and taking it never makes a request wait for more than
+a single hard link.
+
+The snapshot is written as a gzip-compressed tar archive, one message
+file at a time, so memory use does not grow with the size of the
+store. Reads are throttled to :data:`RATE` bytes per second, so that a
+backup does not starve request handlers of disk bandwidth. The first
+member of the archive is a manifest (``MANIFEST.jsonl``) listing the
+metadata of every message, and whether its recipient had read it,
+which lets a restore rebuild the message index and the read markers
+in the same pass that writes the files, without reading any of them
+back.
+
+Backups can be downloaded from ``/admin/backup/``, or made and
+restored from the command line::
+
+    $ python backup.py create rockettalk.tar.gz --rate 50
+    $ python backup.py restore rockettalk.tar.gz
+
+"""
+import gzip
+import json
+import os
+import queue
+import re
+import sys
+import tarfile
+import threading
+import time
+
+from datetime import datetime
+
+import message
+import metrics
+
+
+RATE = 20 * 1024 * 1024
+"""The most bytes of message files to read (or write, when restoring)
+per second. ``0`` or ``None`` means no limit."""
+
+COMPRESS_LEVEL = 6
+"""The gzip compression level of archives (1 is fastest, 9 is
+smallest). Bodies that were saved compressed barely shrink further."""
+
+CHUNK_SIZE = 64 * 1024
+"""How many bytes of the archive to hand over at a time when it is
+streamed (see :func:`stream_archive`)"""
+
+QUEUE_CHUNKS = 8
+"""How many chunks of a streamed archive may wait to be sent. Bounds
+the memory a download takes, however slow the client."""
+
+MANIFEST = "MANIFEST.jsonl"
+"""The name of the manifest in an archive"""
+
+MANIFEST_VERSION = 2
+"""Bumped whenever the layout of the manifest changes. Version 1
+manifests (without read markers) can still be restored."""
+
+_MESSAGE_NAME = re.compile(
+    r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+    r"\.(json|msg)$")
+
+
+class BackupCancelled(Exception):
+    """Raised in the thread writing a streamed archive when its reader
+    goes away (e.g., the client disconnected)."""
+
+
+def create_backup(path, rate=None):
+    """Takes a snapshot of the message store and writes it to an
+    archive file. The file is only put in place once it is complete.
+
+    :param str path: The archive to create
+    :param int rate: The most bytes to read per second. Defaults to
+        :data:`RATE`.
+
+    :returns: A dict with the keys ``messages``, ``bytes`` (of message
+        files read) and ``duration``
+
+    """
+    message.clean_snapshots()
+    snapshot = message.begin_snapshot()
+    try:
+        snapshot.fill()
+        with open(path + ".tmp", "wb") as archive_file:
+            stats = write_archive(snapshot, archive_file, rate)
+        os.replace(path + ".tmp", path)
+    finally:
+        snapshot.close()
+    return stats
+
+
+def stream_archive(rate=None):
+    """Takes a snapshot of the message store, and returns a generator
+    yielding it as a gzip-compressed tar archive.
+
+    The snapshot is taken straight away. The archive is written by a
+    separate thread once the generator is first advanced, and that
+    thread waits whenever :data:`QUEUE_CHUNKS` chunks are waiting to be
+    taken. Closing the generator early stops the thread and removes
+    the snapshot.
+
+    :param int rate: The most bytes to read per second. Defaults to
+        :data:`RATE`.
+
+    :returns: A generator of :class:`bytes`
+
+    """
+    message.clean_snapshots()
+    snapshot = message.begin_snapshot()
+    try:
+        snapshot.fill()
+    except Exception:
+        snapshot.close()
+        raise
+    return _consume(snapshot, rate)
+
+
+def _consume(snapshot, rate):
+    chunks = queue.Queue(QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    writer = _QueueWriter(chunks, cancelled)
+
+    def produce():
+        try:
+            write_archive(snapshot, writer, rate)
+            writer.flush()
+        except BackupCancelled:
+            return
+        except Exception as error:
+            writer.put(error)
+            return
+        writer.put(None)
+
+    thread = threading.Thread(target=produce, name="backup", daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        cancelled.set()
+        thread.join()
+        snapshot.close()
+
+
+class _QueueWriter:
+    """A write-only file object that hands what is written to a queue,
+    :data:`CHUNK_SIZE` bytes at a time."""
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def put(self, item):
+        while True:
+            if self.cancelled.is_set():
+                raise BackupCancelled()
+            try:
+                self.chunks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+
+def write_archive(snapshot, fileobj, rate=None):
+    """Writes a completed snapshot to ``fileobj`` as a gzip-compressed
+    tar archive, manifest first.
+
+    :param message.Snapshot snapshot: A snapshot, after
+        :meth:`message.Snapshot.fill`
+    :param fileobj: A binary file object to write the archive to. Only
+        its ``write`` method is used.
+    :param int rate: The most bytes to read per second. Defaults to
+        :data:`RATE`.
+
+    :returns: See :func:`create_backup`
+
+    """
+    start = time.perf_counter()
+    throttle = _Throttle(RATE if rate is None else rate)
+    files = snapshot.files()
+    manifest_filename = os.path.join(snapshot.directory, "." + MANIFEST)
+    _write_manifest(manifest_filename, snapshot, files)
+
+    stats = {"messages": 0, "bytes": 0}
+    with gzip.GzipFile(fileobj=fileobj, mode="wb",
+                       compresslevel=COMPRESS_LEVEL) as gzip_file, \
+            tarfile.open(fileobj=gzip_file, mode="w|") as archive:
+        archive.add(manifest_filename, arcname=MANIFEST)
+        for filename in files:
+            info = archive.gettarinfo(filename,
+                                      arcname=os.path.basename(filename))
+            info.uid = info.gid = 0
+            info.uname = info.gname = ""
+            with open(filename, "rb") as msg_file:
+                archive.addfile(info, _ThrottledReader(msg_file, throttle))
+            stats["messages"] += 1
+            stats["bytes"] += info.size
+            metrics.inc("rockettalk_backup_bytes_total", info.size,
+                        op="backup")
+    stats["duration"] = time.perf_counter() - start
+    metrics.inc("rockettalk_backup_messages_total", stats["messages"],
+                op="backup")
+    metrics.observe("rockettalk_backup_seconds", stats["duration"],
+                    op="backup")
+    return stats
+
+
+def _write_manifest(filename, snapshot, files):
+    """Writes the manifest of a snapshot: a header line, then one
+    ``[id, time, to, from, thread, read]`` line per message file."""
+    with open(filename, "w") as manifest_file:
+        manifest_file.write(json.dumps({
+            "version": MANIFEST_VERSION,
+            "time": datetime.now().strftime(message.DATE_FORMAT),
+            "messages": len(files),
+        }) + "\n")
+        for filename in files:
+            message_id = message._message_id(filename)
+            sent, to, sender = snapshot.records[message_id]
+            manifest_file.write(json.dumps([
+                message_id, sent.strftime(message.DATE_FORMAT), to, sender,
+                snapshot.threads.get(message_id),
+                message_id in snapshot.read
+            ]) + "\n")
+
+
+def restore_backup(path, rate=None):
+    """Restores the messages in an archive file. See
+    :func:`restore_archive`."""
+    with open(path, "rb") as archive_file:
+        return restore_archive(archive_file, rate)
+
+
+def restore_archive(fileobj, rate=None):
+    """Restores the messages in an archive made by
+    :func:`write_archive` into ``messages/``, reading it in one pass.
+
+    Messages that are already saved are skipped, so a restore can be
+    run again after an interruption. Restored messages that had been
+    read when the backup was made are marked as read again. If
+    ``messages/`` held no messages beforehand, the message index is
+    rebuilt from the manifest (and its snapshot saved, if
+    :data:`message.INDEX_SNAPSHOT` is set), so the restored files never
+    have to be read again. Otherwise the index is left to be rebuilt
+    from ``messages/`` when next used.
+
+    Archive members that are not message files are skipped.
+
+    :param fileobj: A binary file object to read the archive from
+    :param int rate: The most bytes to write per second. Defaults to
+        :data:`RATE`.
+
+    :raises ValueError: If the archive's manifest is missing, or is of
+        an unknown version
+
+    :returns: A dict with the keys ``messages`` (restored),
+        ``existing`` (skipped because they were already saved),
+        ``skipped`` (other members), ``read`` (restored messages
+        marked as read), ``indexed`` (whether the index was rebuilt
+        from the manifest) and ``duration``
+
+    """
+    start = time.perf_counter()
+    throttle = _Throttle(RATE if rate is None else rate)
+    was_empty = not message._list_message_files(message.MESSAGE_DIR)
+    os.makedirs(message.MESSAGE_DIR, exist_ok=True)
+    records = read = None
+    restored = []
+    stats = {"messages": 0, "existing": 0, "skipped": 0}
+
+    with tarfile.open(fileobj=fileobj, mode="r|gz") as archive:
+        for member in archive:
+            if records is None:
+                if member.name != MANIFEST or not member.isfile():
+                    raise ValueError("Not a RocketTalk backup: the "
+                                     "manifest is missing")
+                records, read = _read_manifest(archive.extractfile(member))
+                continue
+            if not (member.isfile() and _MESSAGE_NAME.match(member.name)):
+                stats["skipped"] += 1
+                continue
+            source = _ThrottledReader(archive.extractfile(member), throttle)
+            if message.restore_message_file(member.name, source):
+                restored.append(message._message_id(member.name))
+                stats["messages"] += 1
+                metrics.inc("rockettalk_backup_bytes_total", member.size,
+                            op="restore")
+            else:
+                stats["existing"] += 1
+    if records is None:
+        raise ValueError("Not a RocketTalk backup: the manifest is missing")
+
+    stats["indexed"] = was_empty and all(i in records for i in restored)
+    if stats["indexed"]:
+        message.rebuild_index((i,) + records[i] for i in restored)
+    stats["read"] = message.mark_all_read(i for i in restored if i in read)
+    if stats["indexed"]:
+        message.save_index_snapshot()
+    stats["duration"] = time.perf_counter() - start
+    metrics.inc("rockettalk_backup_messages_total", stats["messages"],
+                op="restore")
+    metrics.observe("rockettalk_backup_seconds", stats["duration"],
+                    op="restore")
+    return stats
+
+
+def _read_manifest(manifest_file):
+    """Reads a manifest written by :func:`_write_manifest`.
+
+    :returns: A ``(records, read)`` pair: a dict mapping each message
+        ID to ``(time, to, from, thread)``, and the set of the IDs of
+        the messages that had been read
+
+    """
+    lines = iter(manifest_file)
+    header = json.loads(next(lines).decode("utf-8"))
+    if header.get("version") not in (1, MANIFEST_VERSION):
+        raise ValueError("Unknown backup manifest version {!r}".format(
+            header.get("version")))
+    records = {}
+    read = set()
+    for line in lines:
+        fields = json.loads(line.decode("utf-8"))
+        message_id, sent, to, sender, thread = fields[:5]
+        records[message_id] = (message.parse_time(sent), to, sender, thread)
+        if fields[5:] == [True]:
+            read.add(message_id)
+    return records, read
+
+
+class _Throttle:
+    """Sleeps as needed to keep a byte count under a rate."""
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.total = 0
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        self.total += size
+        ahead = self.total / self.rate - (time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+class _ThrottledReader:
+    """A binary file object whose reads are counted by a
+    :class:`_Throttle`."""
+    def __init__(self, raw_file, throttle):
+        self.raw_file = raw_file
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.raw_file.read(size)
+        self.throttle.consume(len(data))
+        return data
+
+
+metrics.describe("rockettalk_backup_bytes_total", "counter",
+                 "Bytes of message files backed up or restored, by op.")
+metrics.describe("rockettalk_backup_messages_total", "counter",
+                 "Messages backed up or restored, by op.")
+metrics.describe("rockettalk_backup_seconds", "histogram",
+                 "Time taken by each backup or restore, by op.")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Back up or restore the RocketTalk message store'
+    )
+    parser.add_argument('command', choices=('create', 'restore'),
+                        help='What to do.')
+    parser.add_argument('archive', help='The archive file (.tar.gz).')
+    parser.add_argument('--rate', type=float,
+                        help='Most MiB of messages to read or write per '
+                             'second (0 for no limit).')
+    parser.add_argument('--index-snapshot', type=str,
+                        help='Where to save the rebuilt message index '
+                             'after a restore.')
+    args = parser.parse_args()
+
+    rate = None if args.rate is None else int(args.rate * 1024 * 1024)
+    message.INDEX_SNAPSHOT = args.index_snapshot
+    if args.command == 'create':
+        result = create_backup(args.archive, rate)
+    else:
+        result = restore_backup(args.archive, rate)
+    json.dump(result, sys.stdout, indent=2)
+    print()
@@ -0,0 +1,333 @@
+"""Benchmark module
+
+Micro-benchmarks for the storage helpers in :mod:`message`.
+
+A synthetic corpus of message files is generated in a scratch
+directory, and each storage function is timed against it. Results
+(ops/sec, latency percentiles and peak memory) are emitted as JSON, so
+that runs from different commits can be compared with ``--compare``.
+
+Example::
+
+    $ python bench_message.py --sizes 1000,100000 --output bench.json
+    $ python bench_message.py --sizes 1000,100000 --compare bench.json
+
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from datetime import datetime, timedelta
+from uuid import UUID
+
+import message
+
+
+DEFAULT_SIZES = (1000, 100000, 1000000)
+"""The corpus sizes (number of messages) benchmarked by default"""
+
+
+def parse_distribution(spec):
+    """Parses a body-size distribution specification.
+
+    Supported specifications are:
+
+    * ``fixed:N`` - Every body is exactly ``N`` characters long
+    * ``uniform:A,B`` - Body lengths are drawn uniformly from ``[A, B]``
+    * ``lognormal:MU,SIGMA`` - Body lengths are drawn from a log-normal
+      distribution (most bodies are short, a few are very long)
+
+    :param str spec: The distribution specification
+
+    :raises ValueError: If the specification cannot be parsed
+
+    :returns: A function that takes a :class:`random.Random` and
+        returns a body length
+
+    """
+    kind, _, args = spec.partition(":")
+    try:
+        params = [float(a) for a in args.split(",")] if args else []
+    except ValueError:
+        raise ValueError("Invalid distribution parameters: {}".format(spec))
+
+    if kind == "fixed" and len(params) == 1:
+        return lambda rng: int(params[0])
+    elif kind == "uniform" and len(params) == 2:
+        return lambda rng: rng.randint(int(params[0]), int(params[1]))
+    elif kind == "lognormal" and len(params) == 2:
+        return lambda rng: int(rng.lognormvariate(params[0], params[1]))
+    raise ValueError("Invalid distribution: {}".format(spec))
+
+
+def generate_corpus(count, users=50, body_size="lognormal:5,1.2", seed=0):
+    """Writes ``count`` synthetic messages to the ``messages/`` directory.
+
+    Senders and recipients are drawn from ``users`` synthetic
+    usernames (``user0``, ``user1``, ...). Timestamps are spread over
+    the year preceding the time of generation. The generator is
+    seeded, so the same arguments always produce the same corpus.
+
+    :param int count: The number of messages to write
+    :param int users: The number of distinct usernames to use
+    :param str body_size: A body-size distribution; see
+        :func:`parse_distribution`
+    :param int seed: The seed for the random number generator
+
+    :returns: A list of the usernames used in the corpus
+
+    """
+    rng = random.Random(seed)
+    sizes = parse_distribution(body_size)
+    names = ["user{}".format(i) for i in range(users)]
+    now = datetime.now()
+    os.makedirs("messages", exist_ok=True)
+
+    for _ in range(count):
+        sender, receiver = rng.sample(names, 2) if users > 1 else names * 2
+        sent = now - timedelta(seconds=rng.randint(0, 365 * 24 * 3600))
+        msg = {
+            "to": receiver,
+            "from": sender,
+            "subject": "Subject {}".format(rng.randint(0, 10 ** 6)),
+            "body": "x" * sizes(rng),
+            "time": sent.strftime(message.DATE_FORMAT),
+        }
+        msg_id = UUID(int=rng.getrandbits(128), version=4)
+        with open("messages/{}.json".format(msg_id), "w") as msg_file:
+            json.dump(msg, msg_file)
+    return names
+
+
+def percentile(sorted_values, pct):
+    """Returns the ``pct``-th percentile of a sorted list of numbers.
+
+    Uses the nearest-rank method.
+
+    :param list sorted_values: The (already sorted) values
+    :param float pct: A percentile in the range ``[0, 100]``
+
+    :returns: The percentile, or ``None`` if there are no values
+
+    """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+def summarize_latencies(latencies, elapsed=None):
+    """Summarizes a list of latencies (in seconds).
+
+    :param list latencies: The latency of each operation, in seconds
+    :param float elapsed: The wall-clock time spent on all of the
+        operations. Defaults to the sum of ``latencies``.
+
+    :returns: A dict with the number of operations, ops/sec and the
+        p50/p90/p95/p99/max latencies
+
+    """
+    ordered = sorted(latencies)
+    if elapsed is None:
+        elapsed = sum(ordered)
+    return {
+        "count": len(ordered),
+        "ops_per_sec": len(ordered) / elapsed if elapsed else None,
+        "p50": percentile(ordered, 50),
+        "p90": percentile(ordered, 90),
+        "p95": percentile(ordered, 95),
+        "p99": percentile(ordered, 99),
+        "max": ordered[-1] if ordered else None,
+    }
+
+
+def measure(func, args_for_call, min_time=1.0, max_calls=1000):
+    """Repeatedly calls a function and records its performance.
+
+    The function is called until ``min_time`` seconds have passed or
+    ``max_calls`` calls have been made, whichever comes first (but at
+    least once). Afterwards, one extra call is made with
+    :mod:`tracemalloc` enabled to record peak memory use; it is not
+    included in the timings.
+
+    :param func: The function to benchmark
+    :param args_for_call: A function that takes the call number and
+        returns the tuple of arguments for that call
+    :param float min_time: The minimum number of seconds to spend
+    :param int max_calls: The maximum number of timed calls
+
+    :returns: A latency summary (see :func:`summarize_latencies`) with
+        an additional ``peak_memory_bytes`` entry
+
+    """
+    latencies = []
+    start = time.perf_counter()
+    while not latencies or (time.perf_counter() - start < min_time and
+                            len(latencies) < max_calls):
+        args = args_for_call(len(latencies))
+        before = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - before)
+    result = summarize_latencies(latencies)
+
+    tracemalloc.start()
+    try:
+        func(*args_for_call(len(latencies)))
+        result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result
+
+
+def bench_corpus(size, users, body_size, min_time, max_calls, seed=0):
+    """Benchmarks every storage function against a corpus of ``size``.
+
+    The corpus is generated in a temporary working directory that is
+    removed afterwards. :func:`message._load_message` is measured twice:
+    with the message cache turned off (reading every file), and with it
+    on (``_load_message (cached)``, mostly cache hits).
+
+    :returns: A dict mapping function names to their results
+
+    """
+    original = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="rockettalk-bench-")
+    try:
+        os.chdir(workdir)
+        names = generate_corpus(size, users, body_size, seed)
+        files = sorted(os.listdir("messages"))
+        rng = random.Random(seed)
+
+        def pick_file(_):
+            return ("messages/" + rng.choice(files),)
+
+        def pick_user(_):
+            return (rng.choice(names),)
+
+        def new_message(i):
+            sender, receiver = (rng.sample(names, 2) if len(names) > 1
+                                else names * 2)
+            return ({"to": receiver, "from": sender,
+                     "subject": "bench {}".format(i), "body": "body"},)
+
+        results = {}
+        cache_bytes = message.CACHE_BYTES
+        message.CACHE_BYTES = 0
+        try:
+            results["_load_message"] = measure(
+                message._load_message, pick_file, min_time, max_calls * 100)
+        finally:
+            message.CACHE_BYTES = cache_bytes
+        results["_load_message (cached)"] = measure(
+            message._load_message, pick_file, min_time, max_calls * 100)
+        results["load_all_messages"] = measure(
+            message.load_all_messages, lambda _: (), min_time, max_calls)
+        results["load_sent_messages"] = measure(
+            message.load_sent_messages, pick_user, min_time, max_calls)
+        results["load_received_messages"] = measure(
+            message.load_received_messages, pick_user, min_time, max_calls)
+        results["send_message"] = measure(
+            message.send_message, new_message, min_time, max_calls * 100)
+        return results
+    finally:
+        os.chdir(original)
+        shutil.rmtree(workdir)
+
+
+def git_revision():
+    """Returns the current git commit hash, or ``None`` if unavailable."""
+    try:
+        out = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode().strip()
+
+
+def compare(baseline, current, threshold=0.10):
+    """Compares two benchmark reports and describes any regressions.
+
+    A case regresses when its ops/sec dropped by more than
+    ``threshold`` (as a fraction of the baseline).
+
+    :param dict baseline: A report previously written by this module
+    :param dict current: A freshly generated report
+    :param float threshold: The tolerated slow-down
+
+    :returns: A list of lines describing each benchmark case
+
+    """
+    lines = []
+    results = current["results"]
+    for size, funcs in sorted(results.items(), key=lambda x: int(x[0])):
+        for name, result in sorted(funcs.items()):
+            old = baseline["results"].get(size, {}).get(name)
+            if not old or not old["ops_per_sec"]:
+                lines.append("{:>8} {:<24} (no baseline)".format(size, name))
+                continue
+            ratio = result["ops_per_sec"] / old["ops_per_sec"]
+            flag = "REGRESSION" if ratio < 1 - threshold else ""
+            lines.append("{:>8} {:<24} {:6.2f}x {}".format(
+                size, name, ratio, flag).rstrip())
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the RocketTalk message storage functions'
+    )
+    parser.add_argument('--sizes', type=str,
+                        default=",".join(str(s) for s in DEFAULT_SIZES),
+                        help='Comma-separated corpus sizes to benchmark.')
+    parser.add_argument('--users', type=int, default=50,
+                        help='The number of distinct users in the corpus.')
+    parser.add_argument('--body-size', type=str, default="lognormal:5,1.2",
+                        help='Body-size distribution (fixed:N, '
+                             'uniform:A,B or lognormal:MU,SIGMA).')
+    parser.add_argument('--min-time', type=float, default=1.0,
+                        help='Minimum seconds to spend per function.')
+    parser.add_argument('--max-calls', type=int, default=20,
+                        help='Maximum timed calls per scanning function.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the corpus generator.')
+    parser.add_argument('--output', type=str,
+                        help='Write the JSON report to this file.')
+    parser.add_argument('--compare', type=str,
+                        help='A previous JSON report to compare against.')
+    args = parser.parse_args()
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "timestamp": datetime.now().strftime(message.DATE_FORMAT),
+        "parameters": {"users": args.users, "body_size": args.body_size,
+                       "seed": args.seed},
+        "results": {},
+    }
+    for size in (int(s) for s in args.sizes.split(",")):
+        print("Benchmarking {} messages...".format(size), file=sys.stderr)
+        report["results"][str(size)] = bench_corpus(
+            size, args.users, args.body_size, args.min_time,
+            args.max_calls, args.seed)
+
+    if args.output:
+        with open(args.output, "w") as out_file:
+            json.dump(report, out_file, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print("\n".join(compare(baseline, report)), file=sys.stderr)
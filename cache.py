@@ -0,0 +1,191 @@
+"""Cache module
+
+Contains a least-recently-used cache bounded by the memory its entries
+take up, rather than by how many there are, so that a few large
+messages cannot push the process over its budget and many small ones
+are not evicted needlessly.
+
+Each entry is stored with a *version* (for message files, what
+:func:`os.stat` says about the file). A lookup with a different
+version drops the entry, so a file that changed on disk is never served
+from the cache.
+
+Hits, misses, evictions and invalidations, and the size of every
+cache, are recorded in the ``rockettalk_cache_*`` metrics.
+
+"""
+import sys
+import threading
+
+from collections import OrderedDict
+
+import metrics
+
+
+ENTRY_OVERHEAD = 200
+"""Bytes charged for each entry on top of its value: the cache's own
+bookkeeping (the key, the version and the ordered dict's links)"""
+
+_caches = []  # Every LRUCache, for the gauges
+
+
+def sizeof(value):
+    """Estimates the memory taken up by a value: its own size, plus the
+    sizes of the keys and values of a dict (one level deep), since
+    they are what makes a message large."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in dict.items(value):
+            size += sys.getsizeof(k) + sys.getsizeof(v)
+    return size
+
+
+class LRUCache:
+    """A thread safe cache that evicts its least recently used entries
+    once their total size goes over ``max_bytes``.
+
+    Values are shared between callers, so they must not be changed
+    once cached; callers that hand them out copy them first.
+
+    :param str name: The name of the cache, for the metrics
+    :param int max_bytes: The most bytes to hold. ``0`` disables the
+        cache.
+    :param int max_entry_bytes: Values larger than this are not
+        cached, so one huge value cannot empty the cache. Defaults to
+        an eighth of ``max_bytes``.
+
+    :ivar int size: The bytes held now
+
+    """
+    def __init__(self, name, max_bytes, max_entry_bytes=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self._entries = OrderedDict()  # key -> (version, value, size)
+        self._lock = threading.Lock()
+        _caches.append(self)
+
+    def get(self, key, version, accept=None):
+        """Looks a value up, and marks it as recently used.
+
+        :param key: The key
+        :param version: The current version of the value. An entry
+            stored with another version is dropped.
+        :param accept: If given, a function that returns whether a
+            cached value will do. A value it refuses counts as a miss,
+            but stays cached until it is replaced.
+
+        :returns: The cached value, or ``None`` on a miss
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] != version:
+                self._drop(key)
+                metrics.inc("rockettalk_cache_invalidations_total",
+                            cache=self.name)
+                entry = None
+            if entry is None or (accept is not None and
+                                 not accept(entry[1])):
+                metrics.inc("rockettalk_cache_requests_total",
+                            cache=self.name, result="miss")
+                return None
+            self._entries.move_to_end(key)
+        metrics.inc("rockettalk_cache_requests_total", cache=self.name,
+                    result="hit")
+        return entry[1]
+
+    def put(self, key, version, value):
+        """Caches a value, replacing any other version of it, and
+        evicts the least recently used entries if the cache is now
+        too big."""
+        size = sizeof(value) + ENTRY_OVERHEAD
+        limit = self.max_entry_bytes
+        if limit is None:
+            limit = self.max_bytes // 8
+        if size > limit:
+            self.discard(key)
+            return
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (version, value, size)
+            self.size += size
+            self._evict(self.max_bytes)
+
+    def discard(self, key):
+        """Drops a value, if it is cached (e.g., because it was
+        deleted)."""
+        with self._lock:
+            if self._drop(key):
+                metrics.inc("rockettalk_cache_invalidations_total",
+                            cache=self.name)
+
+    def clear(self):
+        """Drops every value."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def resize(self, max_bytes):
+        """Changes :attr:`max_bytes`, evicting entries until they fit.
+
+        :returns: How many bytes were freed
+
+        """
+        with self._lock:
+            before = self.size
+            self.max_bytes = max_bytes
+            self._evict(max_bytes)
+            return before - self.size
+
+    def shrink(self, size):
+        """Evicts entries until no more than ``size`` bytes are held,
+        without changing :attr:`max_bytes` (so the cache may grow back
+        later; see :mod:`memory`).
+
+        :returns: How many bytes were freed
+
+        """
+        with self._lock:
+            before = self.size
+            self._evict(size)
+            return before - self.size
+
+    def stats(self):
+        """Returns a dict of the cache's ``entries``, ``bytes`` and
+        ``max_bytes``."""
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.size,
+                    "max_bytes": self.max_bytes}
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self.size -= entry[2]
+        return True
+
+    def _evict(self, max_bytes):
+        while self.size > max_bytes:
+            _, (_, _, size) = self._entries.popitem(last=False)
+            self.size -= size
+            metrics.inc("rockettalk_cache_evictions_total", cache=self.name)
+
+
+def _gauge(field):
+    return lambda: {(("cache", c.name),): c.stats()[field] for c in _caches}
+
+
+metrics.describe("rockettalk_cache_requests_total", "counter",
+                 "Cache lookups, by cache and result (hit or miss).")
+metrics.describe("rockettalk_cache_evictions_total", "counter",
+                 "Entries evicted to keep caches under their size limit.")
+metrics.describe("rockettalk_cache_invalidations_total", "counter",
+                 "Entries dropped because what they cached changed or "
+                 "was deleted.")
+metrics.register_gauge("rockettalk_cache_bytes",
+                       "Estimated bytes held by each cache.",
+                       _gauge("bytes"))
+metrics.register_gauge("rockettalk_cache_entries",
+                       "Entries held by each cache.", _gauge("entries"))
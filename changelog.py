@@ -0,0 +1,276 @@
+"""Changelog module
+
+Contains a log of the changes made to ``messages/`` (messages added,
+removed and read), shared by every process that uses the directory,
+so that each process can bring its message index up to date by
+replaying the changes the others made, instead of rescanning the
+directory whenever it changes behind its back.
+
+The log is a SQLite database in WAL mode, so it must be on a local
+disk shared by the processes (that is, they must run on one host).
+Each change gets a sequence number, and each process's index records
+the sequence number of the last change it has applied. Taking the
+log's write lock (see :meth:`ChangeLog.transaction`) also serializes
+changes to ``messages/`` across processes, so a process that reads the
+log while holding the lock never sees a change that is halfway done.
+
+The log is a write-ahead journal: each change is logged as *pending*
+(see :meth:`ChangeLog.intend`) before it is made, and marked done
+(see :meth:`ChangeLog.complete`) once every change of the batch has
+been made. The write lock is a :func:`fcntl.flock` lock, which the
+operating system releases if its holder dies, so pending changes seen
+while holding the lock were left by a process that died halfway
+through a batch. Whoever finds them checks each one against the
+directory, and completes or drops it, so a crash never costs a
+rescan.
+
+Along with the last change of each batch, the log records the stamps
+(see :func:`index.directory_stamp`) of ``messages/`` and of its read
+markers just after the batch. If, after replaying the log, they do
+not match the directories, something changed them without logging it
+(e.g., a process configured without the log, or files copied in by
+hand), and the index must be rebuilt by scanning after all.
+
+The log is owned and kept up to date by :mod:`message`; nothing else
+should need to use it directly.
+
+"""
+import fcntl
+import os
+import sqlite3
+import time
+
+from contextlib import contextmanager
+
+
+KEEP = 100000
+"""How many of the most recent changes to keep. A process whose index
+is further behind than this rebuilds it by scanning instead."""
+
+PRUNE_EVERY = 1000
+"""Old changes are pruned whenever the sequence number reaches a
+multiple of this"""
+
+TIMEOUT = 30.0
+"""How many seconds to wait for another process to release the write
+lock before giving up"""
+
+_SCHEMA_VERSION = 2
+"""Bumped whenever the table changes. A log with another version is
+emptied, so every process rebuilds its index once."""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,
+    id TEXT NOT NULL,
+    time TEXT,
+    recipient TEXT,
+    sender TEXT,
+    thread TEXT,
+    stamp INTEGER,
+    read_stamp INTEGER,
+    pending INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS pending_changes ON changes (seq)
+    WHERE pending = 1;
+"""
+
+_COLUMNS = ("op", "id", "time", "recipient", "sender", "thread")
+
+
+class ChangeLog:
+    """A log of changes to a message directory, stored in a SQLite
+    database at ``path``.
+
+    Each process opens its own connection, when it first uses the log
+    (and again after a fork). The log is not thread safe; callers
+    serialize access to it (:mod:`message` holds its index lock).
+
+    The write lock is held on a file next to the database, at
+    ``path + ".lock"``.
+
+    :ivar str path: The path of the database
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._lock_file = None
+        self._pid = None
+        self._depth = 0  # How many transaction() blocks we are in
+
+    def _connect(self):
+        if self._connection is None or self._pid != os.getpid():
+            # A connection (or a lock) inherited across a fork must not
+            # be used
+            connection = sqlite3.connect(self.path, timeout=TIMEOUT,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._lock_file = open(self.path + ".lock", "a")
+            self._connection, self._pid, self._depth = (
+                connection, os.getpid(), 0)
+            with self.transaction():
+                version, = connection.execute(
+                    "PRAGMA user_version").fetchone()
+                if version != _SCHEMA_VERSION:
+                    connection.execute("DROP TABLE IF EXISTS changes")
+                connection.executescript(_SCHEMA)
+                connection.execute(
+                    "PRAGMA user_version = {}".format(_SCHEMA_VERSION))
+        return self._connection
+
+    @contextmanager
+    def transaction(self):
+        """Holds the log's write lock, which every process takes while
+        it changes the message directory and logs the change, for the
+        duration of a ``with`` block. Blocks may be nested; the lock is
+        released when the outermost one ends.
+
+        :raises TimeoutError: If another process held the lock for
+            longer than :data:`TIMEOUT` seconds
+
+        """
+        self._connect()
+        if not self._depth:
+            self._lock()
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            if not self._depth:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _lock(self):
+        deadline = time.monotonic() + TIMEOUT
+        delay = 0.0001
+        while True:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError("The change log at {} is locked".format(
+                        self.path))
+                time.sleep(delay)
+                delay = min(delay * 2, 0.01)
+
+    def intend(self, changes):
+        """Logs changes that are about to be made, as pending. Must be
+        called in a :meth:`transaction`, before the changes are made.
+
+        :param changes: A list of tuples of the form ``(op, id[, time,
+            to, from, thread])``, where ``op`` is ``"add"`` (which
+            needs the other fields; ``time`` is text), ``"remove"`` or
+            ``"read"``
+
+        :returns: The sequence numbers of the changes, in order
+
+        """
+        connection = self._connect()
+        rows = [tuple(c) + (None,) * (len(_COLUMNS) - len(c))
+                for c in changes]
+        with _atomic(connection):
+            connection.executemany(
+                "INSERT INTO changes ({}, pending) VALUES ({}, 1)".format(
+                    ", ".join(_COLUMNS), ", ".join("?" * len(_COLUMNS))),
+                rows)
+            seq, = connection.execute("SELECT last_insert_rowid()").fetchone()
+        return list(range(seq - len(rows) + 1, seq + 1))
+
+    def pending(self):
+        """Returns the pending changes, in order, as ``(seq, op, id)``
+        tuples. Called in a :meth:`transaction` before any change is
+        intended, it returns the changes of processes that died."""
+        return self._connect().execute(
+            "SELECT seq, op, id FROM changes WHERE pending = 1 "
+            "ORDER BY seq").fetchall()
+
+    def complete(self, stamp, read_stamp, dropped=()):
+        """Marks the pending changes as done, and records the stamps on
+        the last of them. Must be called in a :meth:`transaction`,
+        either at the end of a batch of changes, or to settle the
+        changes of a process that died (see :meth:`pending`).
+
+        :param stamp: The stamp of the message directory after the
+            changes
+        :param read_stamp: The stamp of its read markers after the
+            changes
+        :param dropped: The sequence numbers of pending changes that
+            were not made after all, which are removed instead. If no
+            pending change is left, a ``"stamp"`` change is logged to
+            record the new stamps.
+
+        :returns: The sequence number of the last change logged
+
+        """
+        connection = self._connect()
+        with _atomic(connection):
+            connection.executemany("DELETE FROM changes WHERE seq = ?",
+                                   [(seq,) for seq in dropped])
+            done = connection.execute(
+                "UPDATE changes SET pending = 0 WHERE pending = 1").rowcount
+            if done:
+                seq, = connection.execute(
+                    "SELECT MAX(seq) FROM changes").fetchone()
+                connection.execute(
+                    "UPDATE changes SET stamp = ?, read_stamp = ? "
+                    "WHERE seq = ?", (stamp, read_stamp, seq))
+            else:
+                connection.execute(
+                    "INSERT INTO changes (op, id, stamp, read_stamp) "
+                    "VALUES ('stamp', '', ?, ?)", (stamp, read_stamp))
+                seq, = connection.execute(
+                    "SELECT last_insert_rowid()").fetchone()
+                done = 1
+            if seq // PRUNE_EVERY != (seq - done) // PRUNE_EVERY:
+                connection.execute("DELETE FROM changes WHERE seq <= ?",
+                                   (seq - KEEP,))
+        return seq
+
+    def last_seq(self):
+        """Returns the sequence number of the last change logged, or 0
+        if there is none."""
+        row = self._connect().execute(
+            "SELECT MAX(seq) FROM changes").fetchone()
+        return row[0] or 0
+
+    def since(self, seq):
+        """Returns the changes logged after ``seq``, in order, as
+        ``(seq, op, id, time, to, from, thread, stamp, read_stamp)``
+        tuples, or ``None`` if some of them have been pruned (or ``seq``
+        is not from this log)."""
+        connection = self._connect()
+        first, last = connection.execute(
+            "SELECT MIN(seq), MAX(seq) FROM changes").fetchone()
+        if first is None:
+            return None if seq else []
+        if first > seq + 1 or last < seq:
+            return None
+        return connection.execute(
+            "SELECT seq, {}, stamp, read_stamp FROM changes WHERE seq > ? "
+            "ORDER BY seq".format(", ".join(_COLUMNS)), (seq,)).fetchall()
+
+    def close(self):
+        """Closes this process's connection, if it has one."""
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+            self._lock_file.close()
+        self._connection = self._lock_file = None
+
+
+@contextmanager
+def _atomic(connection):
+    """Runs a ``with`` block in a SQLite transaction, which is committed
+    if the block succeeds and rolled back if it raises, so that a batch
+    is never left half logged."""
+    connection.execute("BEGIN")
+    try:
+        yield
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
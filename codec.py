@@ -0,0 +1,375 @@
+"""Codec module
+
+Contains helper functions for a compact binary message format, as an
+alternative to the JSON files written by :func:`message.send_message`.
+
+A binary message file is named ``<uuid>.msg`` and laid out as follows
+(all integers little-endian):
+
+========  ==========================================================
+Bytes     Contents
+========  ==========================================================
+4         Magic number ``RTM1``
+1         Flags (bit 0: the body is zlib-compressed; see
+          :func:`message.send_message`. Bit 1: the message is a reply)
+8         Time sent, as whole seconds since 1970-01-01 00:00:00
+          (signed; local time, like the JSON format)
+16 + 16   Only for replies: the IDs of the message replied to and of
+          the first message of the thread, as raw UUIDs
+2 + n     Recipient username: length, then UTF-8 bytes
+2 + n     Sender username: length, then UTF-8 bytes
+4 + n     Subject: length, then UTF-8 bytes
+4 + n     Body: length, then UTF-8 bytes
+========  ==========================================================
+
+Everything except the body fits in the first few hundred bytes, so
+listing and authorization only ever read one small block. Decoded
+usernames are interned, so thousands of loaded messages share a
+handful of username strings.
+
+This module can also be run as a script to convert existing JSON
+messages, or to compare the two formats::
+
+    $ python codec.py convert messages/
+    $ python codec.py compare messages/
+
+"""
+import base64
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+from datetime import datetime, timedelta
+from uuid import UUID
+
+
+MAGIC = b"RTM1"
+"""The first four bytes of every binary message file"""
+
+EXTENSION = ".msg"
+"""The file name extension of binary message files"""
+
+EPOCH = datetime(1970, 1, 1)
+"""Times are stored as seconds since this (naive) time"""
+
+HEADER_BLOCK = 4096
+"""How many bytes to read when only the header fields are wanted"""
+
+MMAP_THRESHOLD = 256 * 1024
+"""Files at least this large are memory-mapped when the body is read"""
+
+FLAG_ZLIB = 0x01
+"""Flag bit set when the body is stored zlib-compressed"""
+
+FLAG_REPLY = 0x02
+"""Flag bit set when the message is a reply, and has ``in_reply_to``
+and ``thread`` IDs"""
+
+_PREFIX = struct.Struct("<4sBq")
+_SHORT = struct.Struct("<H")
+_LONG = struct.Struct("<I")
+_REPLY = struct.Struct("<16s16s")
+
+
+def encode(msg):
+    """Encodes a message in the binary format.
+
+    :param dict msg: A message with the keys ``to``, ``from``,
+        ``subject``, ``body`` (all :class:`str`) and ``time`` (a
+        :class:`datetime.datetime`). If it also has ``"encoding":
+        "zlib"``, the body must be the compressed :class:`bytes`.
+
+    :raises ValueError: If a username is longer than 65535 bytes
+
+    :returns: The encoded message as :class:`bytes`
+
+    """
+    seconds = int((msg["time"] - EPOCH).total_seconds())
+    flags = FLAG_ZLIB if msg.get("encoding") == "zlib" else 0
+    if msg.get("in_reply_to"):
+        flags |= FLAG_REPLY
+    parts = [_PREFIX.pack(MAGIC, flags, seconds)]
+    if flags & FLAG_REPLY:
+        parts.append(_REPLY.pack(UUID(msg["in_reply_to"]).bytes,
+                                 UUID(msg["thread"]).bytes))
+    for key, length in (("to", _SHORT), ("from", _SHORT),
+                        ("subject", _LONG), ("body", _LONG)):
+        data = msg[key]
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        if length is _SHORT and len(data) > 0xffff:
+            raise ValueError("{} is too long".format(key))
+        parts.append(length.pack(len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def is_binary(data):
+    """Checks whether ``data`` starts like a binary message."""
+    return data[:len(MAGIC)] == MAGIC
+
+
+def decode(data, body=True):
+    """Decodes a binary message.
+
+    :param data: The encoded message (:class:`bytes`, or any object
+        supporting the buffer protocol, such as an :class:`mmap.mmap`)
+    :param bool body: Whether to decode the body. If False, ``data``
+        may be cut off anywhere after the subject.
+
+    :raises ValueError: If ``data`` is not a binary message, or is
+        cut off too early
+
+    :returns: A dict with the keys ``to``, ``from``, ``subject``,
+        ``time`` and (if requested) ``body``. If the body is
+        compressed, it is returned as the compressed :class:`bytes`,
+        and the dict also has ``"encoding": "zlib"``. A reply also has
+        ``in_reply_to`` and ``thread``.
+
+    """
+    try:
+        magic, flags, seconds = _PREFIX.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a binary message")
+        msg = {"time": EPOCH + timedelta(seconds=seconds)}
+        if flags & FLAG_ZLIB:
+            msg["encoding"] = "zlib"
+        offset = _PREFIX.size
+        if flags & FLAG_REPLY:
+            parent, thread = _REPLY.unpack_from(data, offset)
+            msg["in_reply_to"] = str(UUID(bytes=parent))
+            msg["thread"] = str(UUID(bytes=thread))
+            offset += _REPLY.size
+        view = memoryview(data)
+        try:
+            for key, length in (("to", _SHORT), ("from", _SHORT),
+                                ("subject", _LONG), ("body", _LONG)):
+                if key == "body" and not body:
+                    break
+                size, = length.unpack_from(data, offset)
+                offset += length.size
+                if offset + size > len(data):
+                    raise ValueError("Truncated message")
+                if key == "body" and flags & FLAG_ZLIB:
+                    value = bytes(view[offset:offset + size])
+                else:
+                    value = str(view[offset:offset + size], "utf-8")
+                msg[key] = sys.intern(value) if length is _SHORT else value
+                offset += size
+        finally:
+            view.release()
+    except struct.error:
+        raise ValueError("Truncated message")
+    return msg
+
+
+def read(filename, body=True):
+    """Reads and decodes a binary message file.
+
+    If the body is not wanted, only the first :data:`HEADER_BLOCK`
+    bytes are read (unless the subject is longer than that). Large
+    files are memory-mapped rather than read into memory.
+
+    :param str filename: The file to read
+    :param bool body: Whether to decode the body
+
+    :raises OSError: If the file cannot be read
+    :raises ValueError: If the file is not a valid binary message
+
+    :returns: See :func:`decode`
+
+    """
+    with open(filename, "rb") as raw_file:
+        if not body:
+            try:
+                return decode(raw_file.read(HEADER_BLOCK), body=False)
+            except ValueError:
+                raw_file.seek(0)  # Subject longer than one block
+        size = os.fstat(raw_file.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(raw_file.fileno(), 0,
+                           access=mmap.ACCESS_READ) as data:
+                return decode(data, body)
+        return decode(raw_file.read(), body)
+
+
+def write(filename, msg):
+    """Encodes a message and writes it to a new file.
+
+    :raises FileExistsError: If ``filename`` already exists
+
+    """
+    with open(filename, "xb") as msg_file:
+        msg_file.write(encode(msg))
+
+
+def write_stream(filename, msg, chunks):
+    """Like :func:`write`, but the body is written as it is produced.
+
+    The body length is written as zero at first, and filled in once
+    every chunk has been written, so the body never has to be held in
+    memory as a whole.
+
+    :param str filename: The file to create
+    :param dict msg: The message, without a body (see :func:`encode`)
+    :param chunks: An iterable of :class:`bytes`, making up the body
+        (already compressed, if ``msg`` has ``"encoding": "zlib"``)
+
+    :raises FileExistsError: If ``filename`` already exists
+    :raises ValueError: If the body is 4 GiB or larger
+
+    :returns: The length of the body in bytes
+
+    """
+    head = encode(dict(msg, body=b""))
+    size = 0
+    with open(filename, "xb") as msg_file:
+        msg_file.write(head)
+        for chunk in chunks:
+            msg_file.write(chunk)
+            size += len(chunk)
+        if size > 0xffffffff:
+            raise ValueError("body is too long")
+        msg_file.seek(len(head) - _LONG.size)
+        msg_file.write(_LONG.pack(size))
+    return size
+
+
+def body_span(raw_file):
+    """Finds the body of a binary message, without reading it.
+
+    :param raw_file: The message file, opened for reading in binary
+        mode and positioned at its start
+
+    :raises ValueError: If the file is not a binary message, or is
+        cut off before the body
+
+    :returns: An ``(offset, length, encoding)`` tuple, where
+        ``encoding`` is ``"zlib"`` if the body is compressed and
+        ``None`` otherwise
+
+    """
+    data = raw_file.read(HEADER_BLOCK)
+    while True:
+        try:
+            magic, flags, _ = _PREFIX.unpack_from(data, 0)
+            if magic != MAGIC:
+                raise ValueError("Not a binary message")
+            offset = _PREFIX.size
+            if flags & FLAG_REPLY:
+                offset += _REPLY.size
+            for length in (_SHORT, _SHORT, _LONG):
+                size, = length.unpack_from(data, offset)
+                offset += length.size + size
+            size, = _LONG.unpack_from(data, offset)
+            break
+        except struct.error:
+            more = raw_file.read(len(data))  # Subject longer than a block
+            if not more:
+                raise ValueError("Truncated message")
+            data += more
+    encoding = "zlib" if flags & FLAG_ZLIB else None
+    return offset + _LONG.size, size, encoding
+
+
+def _load_json(filename):
+    with open(filename) as raw_file:
+        msg = json.load(raw_file)
+    msg["time"] = datetime.strptime(msg["time"], "%Y-%m-%d %H:%M:%S")
+    if msg.get("encoding") == "zlib":
+        msg["body"] = base64.b64decode(msg["body"])
+    return msg
+
+
+def convert_directory(directory, keep=False):
+    """Converts every JSON message in ``directory`` to the binary format.
+
+    Each message is written to a temporary file and renamed into
+    place before its JSON file is removed, so a message is never
+    missing (although a reader may briefly see it in both formats).
+
+    :param str directory: The directory holding the messages
+    :param bool keep: Whether to keep the JSON files
+
+    :returns: The number of messages converted
+
+    """
+    converted = 0
+    for name in sorted(os.listdir(directory)):
+        base, ext = os.path.splitext(name)
+        if ext != ".json" or name.startswith("."):
+            continue
+        source = os.path.join(directory, name)
+        target = os.path.join(directory, base + EXTENSION)
+        tmp_target = os.path.join(directory, "." + base + EXTENSION)
+        with open(tmp_target, "wb") as msg_file:
+            msg_file.write(encode(_load_json(source)))
+        os.replace(tmp_target, target)
+        if not keep:
+            os.remove(source)
+        converted += 1
+    return converted
+
+
+def compare_formats(directory, rounds=3):
+    """Compares the size and decode speed of the JSON messages in
+    ``directory`` with the same messages in the binary format.
+
+    :returns: A dict with total bytes and messages decoded per second
+        for each format
+
+    """
+    json_files = [os.path.join(directory, n) for n in os.listdir(directory)
+                  if n.endswith(".json") and not n.startswith(".")]
+    json_data = []
+    for filename in json_files:
+        with open(filename, "rb") as raw_file:
+            json_data.append(raw_file.read())
+    binary_data = [encode(_load_json(f)) for f in json_files]
+
+    def rate(func, blobs):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for blob in blobs:
+                func(blob)
+        elapsed = time.perf_counter() - start
+        return len(blobs) * rounds / elapsed if elapsed else None
+
+    def decode_json(blob):
+        msg = json.loads(blob.decode("utf-8"))
+        msg["time"] = datetime.strptime(msg["time"], "%Y-%m-%d %H:%M:%S")
+
+    return {
+        "messages": len(json_files),
+        "json": {"bytes": sum(len(b) for b in json_data),
+                 "decodes_per_sec": rate(decode_json, json_data)},
+        "binary": {"bytes": sum(len(b) for b in binary_data),
+                   "decodes_per_sec": rate(decode, binary_data),
+                   "header_decodes_per_sec": rate(
+                       lambda b: decode(b, body=False), binary_data)},
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Convert or compare RocketTalk message formats'
+    )
+    parser.add_argument('command', choices=('convert', 'compare'),
+                        help='What to do.')
+    parser.add_argument('directory', nargs='?', default='messages',
+                        help='The message directory.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep JSON files after converting them.')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        count = convert_directory(args.directory, keep=args.keep)
+        print("Converted {} messages.".format(count))
+    else:
+        json.dump(compare_formats(args.directory), sys.stdout, indent=2)
+        print()
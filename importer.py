@@ -0,0 +1,308 @@
+"""Importer module
+
+Contains helper functions for importing messages in bulk (e.g., to
+seed a new deployment, or to migrate historical messages) from a JSONL
+or CSV file.
+
+Each record has the fields ``to``, ``from``, ``subject``, ``body`` and
+``time`` (formatted with :data:`message.DATE_FORMAT`), and optionally
+``id`` (a UUID). CSV files must have a header row naming the fields.
+
+Records are checked with the same rules as the compose form (see
+:func:`message.validate_message_form`), plus a sender and a valid
+time. Records that fail are skipped, and can be written to a rejects
+file along with the reasons. Valid records are saved in large batches
+with :func:`message.import_messages`, by a pool of workers.
+
+Records without an ``id`` get one derived from their contents, so
+importing the same record twice saves it once. Progress is written to
+a checkpoint file after every batch, and an interrupted import picks
+up where it left off when run again with the same checkpoint.
+
+Example::
+
+    $ python importer.py corpus.jsonl --workers 8 --checkpoint corpus.ckpt
+
+"""
+import csv
+import json
+import os
+import sys
+import time
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from uuid import UUID, uuid5
+
+import message
+
+
+ID_NAMESPACE = UUID("b7777b56-5e45-4194-bcca-b6fb828c38d5")
+"""The namespace of the UUIDs derived from imported messages"""
+
+FIELDS = ("to", "from", "subject", "body", "time")
+"""The fields every record must have"""
+
+
+def read_records(path, fmt=None):
+    """Reads the records of a JSONL or CSV file, one at a time.
+
+    :param str path: The file to read
+    :param str fmt: ``"jsonl"`` or ``"csv"``. Guessed from the file
+        name's extension if not given.
+
+    :returns: An iterator of ``(number, record)`` pairs, where
+        ``number`` counts records from 1. A JSONL line that cannot be
+        decoded yields ``None`` as its record.
+
+    """
+    fmt = fmt or ("csv" if path.lower().endswith(".csv") else "jsonl")
+    with open(path, newline="" if fmt == "csv" else None,
+              encoding="utf-8") as input_file:
+        if fmt == "csv":
+            for number, row in enumerate(csv.DictReader(input_file), 1):
+                yield number, row
+            return
+        number = 0
+        for line in input_file:
+            if not line.strip():
+                continue
+            number += 1
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield number, record if isinstance(record, dict) else None
+
+
+def validate_record(record):
+    """Checks an imported record, and converts it to a message for
+    :func:`message.import_messages`.
+
+    :param dict record: A record from :func:`read_records`
+
+    :returns: A ``(msg, errors)`` pair. If there are no errors,
+        ``msg`` is the message to save; otherwise it is ``None``.
+
+    """
+    if record is None:
+        return None, ["Not a JSON object!"]
+    errors = message.validate_message_form(record)
+    for k in ("from", "time"):
+        if not record.get(k):
+            errors.append("Missing " + k + " field!")
+    for k in FIELDS:
+        if k in record and not isinstance(record[k], str):
+            errors.append(k + " field must be text!")
+    if errors:
+        return None, errors
+
+    try:
+        sent = message.parse_time(record["time"])
+    except (TypeError, ValueError):
+        return None, ["Bad time {!r}!".format(record["time"])]
+    msg = {k: record[k] for k in ("to", "from", "subject", "body")}
+    for k in ("to", "from"):
+        msg[k] = msg[k].lower()  # Usernames are case insensitive
+    msg["time"] = sent
+    if record.get("id"):
+        try:
+            msg["id"] = str(UUID(record["id"]))
+        except (TypeError, ValueError):
+            return None, ["Bad id {!r}!".format(record["id"])]
+    else:
+        key = json.dumps([record[k] for k in FIELDS])
+        msg["id"] = str(uuid5(ID_NAMESPACE, key))
+    return msg, []
+
+
+def load_checkpoint(path, input_path):
+    """Loads the progress saved by an earlier import of ``input_path``.
+
+    :returns: A dict with the keys ``records`` (how many records were
+        dealt with), ``imported``, ``duplicates`` and ``rejected``
+
+    """
+    progress = {"records": 0, "imported": 0, "duplicates": 0, "rejected": 0}
+    if path is None:
+        return progress
+    try:
+        with open(path) as checkpoint_file:
+            saved = json.load(checkpoint_file)
+    except FileNotFoundError:
+        return progress
+    if saved.get("input") != os.path.abspath(input_path):
+        raise ValueError("{} is a checkpoint for {}, not {}".format(
+            path, saved.get("input"), input_path))
+    progress.update((k, saved[k]) for k in progress)
+    return progress
+
+
+def save_checkpoint(path, input_path, progress):
+    """Saves import progress, replacing the checkpoint atomically."""
+    state = dict(progress, input=os.path.abspath(input_path))
+    with open(path + ".tmp", "w") as checkpoint_file:
+        json.dump(state, checkpoint_file)
+    os.replace(path + ".tmp", path)
+
+
+def _import_batch(batch, settings):
+    """Saves one batch of messages, in a worker.
+
+    Storage settings are passed along (rather than relying on the
+    worker having inherited them), so that worker processes save
+    messages the same way as the importing process.
+
+    """
+    for name, value in settings.items():
+        setattr(message, name, value)
+    return len(message.import_messages(batch))
+
+
+def import_file(path, fmt=None, batch_size=1000, workers=4,
+                processes=False, checkpoint=None, rejects=None,
+                report=None, report_interval=2.0):
+    """Imports the records of a JSONL or CSV file into ``messages/``.
+
+    Batches are saved by ``workers`` threads (or processes), while the
+    importing process reads and validates the next ones. At most two
+    batches per worker are in flight at once, so memory use stays
+    bounded however large the input is. Batches finish in order, and
+    the checkpoint (if any) is saved after each one.
+
+    :param str path: The file to import
+    :param str fmt: ``"jsonl"`` or ``"csv"`` (see :func:`read_records`)
+    :param int batch_size: How many messages to save at once
+    :param int workers: How many batches to save at once
+    :param bool processes: Whether to save batches in worker processes
+        (which sidesteps the GIL for encoding) rather than threads
+    :param str checkpoint: A file to save progress to, and to resume
+        from if it exists
+    :param str rejects: A JSONL file to append rejected records (with
+        their line number and errors) to
+    :param report: A function that is called with a progress dict
+        (see below) and ``False`` about every ``report_interval``
+        seconds, and with the final progress and ``True`` at the end
+    :param float report_interval: Seconds between progress reports
+
+    :returns: A progress dict with the keys ``records``, ``imported``,
+        ``duplicates`` (records whose ID was already taken),
+        ``rejected``, ``elapsed`` and ``rate`` (records per second in
+        this run)
+
+    """
+    progress = load_checkpoint(checkpoint, path)
+    resume_from = progress["records"]
+    settings = {"MESSAGE_DIR": message.MESSAGE_DIR,
+                "CHANGE_LOG": message.CHANGE_LOG,
+                "STORAGE_FORMAT": message.STORAGE_FORMAT,
+                "COMPRESS_THRESHOLD": message.COMPRESS_THRESHOLD,
+                "COMPRESS_LEVEL": message.COMPRESS_LEVEL}
+    start = last_report = time.perf_counter()
+    # (future, batch size, rejected records, records up to batch end)
+    pending = deque()
+    rejects_file = open(rejects, "a") if rejects else None
+
+    def finish(future, size, rejected, records):
+        saved = future.result() if future is not None else 0
+        progress["records"] = records
+        progress["imported"] += saved
+        progress["duplicates"] += size - saved
+        progress["rejected"] += rejected
+        if checkpoint:
+            save_checkpoint(checkpoint, path, progress)
+
+    def update(final=False):
+        elapsed = time.perf_counter() - start
+        progress["elapsed"] = elapsed
+        progress["rate"] = ((progress["records"] - resume_from) / elapsed
+                            if elapsed else 0.0)
+        if report is not None:
+            report(dict(progress), final)
+
+    pool_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    try:
+        with pool_class(max_workers=workers) as pool:
+            batch, rejected = [], 0
+            number = resume_from
+            for number, record in read_records(path, fmt):
+                if number <= resume_from:
+                    continue
+                msg, errors = validate_record(record)
+                if errors:
+                    rejected += 1
+                    if rejects_file:
+                        rejects_file.write(json.dumps({
+                            "record": number, "errors": errors,
+                            "data": record}) + "\n")
+                else:
+                    batch.append(msg)
+                if len(batch) >= batch_size:
+                    pending.append((pool.submit(_import_batch, batch,
+                                                settings),
+                                    len(batch), rejected, number))
+                    batch, rejected = [], 0
+                    while len(pending) >= 2 * workers or (
+                            pending[0][0].done()):
+                        finish(*pending.popleft())
+                        if not pending:
+                            break
+                now = time.perf_counter()
+                if now - last_report >= report_interval:
+                    last_report = now
+                    update()
+            if batch or rejected:
+                future = (pool.submit(_import_batch, batch, settings)
+                          if batch else None)
+                pending.append((future, len(batch), rejected, number))
+            while pending:
+                finish(*pending.popleft())
+    finally:
+        if rejects_file:
+            rejects_file.close()
+    update(final=True)
+    return progress
+
+
+def print_progress(progress, final=False):
+    """Prints a progress report to stderr (see :func:`import_file`)."""
+    print("{}{records} records: {imported} imported, {duplicates} "
+          "duplicates, {rejected} rejected ({rate:.0f} records/s)".format(
+              "Done. " if final else "", **progress), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Import RocketTalk messages from a JSONL or CSV file'
+    )
+    parser.add_argument('input', help='The file to import.')
+    parser.add_argument('--format', choices=('jsonl', 'csv'),
+                        help='The input format (default: from the name).')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='How many messages to save at once.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='How many batches to save at once.')
+    parser.add_argument('--processes', action='store_true',
+                        help='Save batches in worker processes.')
+    parser.add_argument('--checkpoint', type=str,
+                        help='A file to save progress to and resume from.')
+    parser.add_argument('--rejects', type=str,
+                        help='A JSONL file to write rejected records to.')
+    parser.add_argument('--storage-format', choices=('json', 'binary'),
+                        default='json',
+                        help='The format to save messages in.')
+    parser.add_argument('--change-log', type=str,
+                        help='The change log of the servers using the '
+                             'messages, to record the import in.')
+    parser.add_argument('--report-interval', type=float, default=2.0,
+                        help='Seconds between progress reports.')
+    args = parser.parse_args()
+
+    message.STORAGE_FORMAT = args.storage_format
+    message.CHANGE_LOG = args.change_log
+    import_file(args.input, fmt=args.format, batch_size=args.batch_size,
+                workers=args.workers, processes=args.processes,
+                checkpoint=args.checkpoint, rejects=args.rejects,
+                report=print_progress, report_interval=args.report_interval)
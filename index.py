@@ -0,0 +1,374 @@
+"""Index module
+
+Contains an in-memory index of message metadata (who sent each
+message, who received it and when), so that a mailbox can be listed
+by opening only the files that belong to it, instead of every file in
+``messages/``.
+
+It also counts each user's received and unread messages, so that
+they can be shown on every page without listing the mailbox, and
+groups replies into threads (conversations), so that a whole
+conversation can be listed without opening any file that is not part
+of it.
+
+The index is owned and kept up to date by :mod:`message`; nothing
+else should need to use it directly.
+
+"""
+import os
+import pickle
+import sys
+import threading
+
+from bisect import bisect_left, insort
+
+
+SNAPSHOT_VERSION = 4
+"""Bumped whenever the layout of a pickled snapshot changes"""
+
+
+class MessageIndex:
+    """Message metadata, looked up by ID or by user.
+
+    Each user's sent and received messages are kept as lists of
+    ``(time, id)`` pairs sorted from least to most recent, so that
+    they can be read back in order without sorting. Each thread's
+    replies are kept the same way, under the ID of the thread's first
+    message.
+
+    The index remembers which directory it describes, along with a
+    *stamp* of that directory (see :func:`directory_stamp`). If the
+    stamp changes, the directory was changed by someone else and the
+    index must be rebuilt.
+
+    Which messages have been read by their recipient is stored apart
+    from the messages (see :meth:`set_read`), and stamped separately
+    with :attr:`read_stamp`.
+
+    When changes to the directory are logged (see :mod:`changelog`),
+    :attr:`seq` is the sequence number of the last logged change the
+    index reflects, and the index can be brought up to date by
+    applying the changes logged after it, instead of being rebuilt.
+
+    Every method that reads or changes the index must be called while
+    holding :attr:`lock`.
+
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self, directory=None, stamp=None):
+        """Empties the index, and records the directory it describes."""
+        self.directory = directory
+        self.stamp = stamp
+        self.entries = {}   # id -> (time, to, from)
+        self.sent = {}      # username -> [(time, id), ...]
+        self.received = {}  # username -> [(time, id), ...]
+        self.thread_of = {}  # reply id -> thread id
+        self.threads = {}   # thread id -> [(time, reply id), ...]
+        self.read = set()   # ids of messages read by their recipient
+        self.unread = {}    # username -> number of unread messages
+        self.read_stamp = None
+        self.seq = None     # The last change log entry applied
+
+    def estimate_bytes(self):
+        """Estimates the memory taken up by the index: the exact size
+        of its tables and lists, plus the size of one message's entry,
+        ID and pairs times the number of messages. Takes time
+        proportional to the number of users and threads, not
+        messages."""
+        tables = (self.entries, self.sent, self.received, self.thread_of,
+                  self.threads, self.read, self.unread)
+        size = sum(sys.getsizeof(t) for t in tables)
+        for table in (self.sent, self.received, self.threads):
+            size += sum(sys.getsizeof(pairs) for pairs in table.values())
+        for message_id, entry in self.entries.items():
+            per_message = sys.getsizeof(message_id) + sys.getsizeof(entry)
+            per_message += sum(sys.getsizeof(field) for field in entry)
+            per_message += 2 * sys.getsizeof((entry[0], message_id))
+            size += per_message * len(self.entries)
+            break
+        return size
+
+    def is_current(self, directory, stamp):
+        """Checks whether the index describes ``directory`` as it was
+        when ``stamp`` was taken."""
+        return self.directory == directory and self.stamp == stamp
+
+    def add(self, message_id, time, to, sender, thread=None):
+        """Adds a message to the index. Adding a message that is
+        already indexed does nothing.
+
+        :param str thread: The thread of a reply (the ID of the first
+            message of the conversation), or ``None``
+
+        """
+        if message_id in self.entries:
+            return
+        self.entries[message_id] = (time, to, sender)
+        insort(self.sent.setdefault(sender, []), (time, message_id))
+        insort(self.received.setdefault(to, []), (time, message_id))
+        self.unread[to] = self.unread.get(to, 0) + 1
+        if thread is not None:
+            self.thread_of[message_id] = thread
+            insort(self.threads.setdefault(thread, []), (time, message_id))
+
+    def discard(self, message_id):
+        """Removes a message from the index, if it is indexed."""
+        entry = self.entries.pop(message_id, None)
+        if entry is None:
+            return
+        time, to, sender = entry
+        if message_id in self.read:
+            self.read.discard(message_id)
+        else:
+            self._count_unread(to, -1)
+        mailboxes = [(self.sent, sender), (self.received, to)]
+        thread = self.thread_of.pop(message_id, None)
+        if thread is not None:
+            mailboxes.append((self.threads, thread))
+        for mailbox, user in mailboxes:
+            pairs = mailbox[user]
+            del pairs[bisect_left(pairs, (time, message_id))]
+            if not pairs:
+                del mailbox[user]
+
+    def rebuild(self, directory, stamp, records):
+        """Replaces the contents of the index.
+
+        Faster than calling :meth:`add` for every message, since each
+        mailbox is sorted once at the end.
+
+        :param str directory: The directory the records came from
+        :param stamp: The stamp of the directory before it was scanned
+        :param records: An iterable of ``(id, time, to, from, thread)``
+            tuples, where ``thread`` is ``None`` unless the message is
+            a reply
+
+        """
+        self.clear(directory, stamp)
+        for message_id, time, to, sender, thread in records:
+            if message_id in self.entries:
+                continue  # Listed twice, e.g. in both storage formats
+            self.entries[message_id] = (time, to, sender)
+            self.sent.setdefault(sender, []).append((time, message_id))
+            self.received.setdefault(to, []).append((time, message_id))
+            if thread is not None:
+                self.thread_of[message_id] = thread
+                self.threads.setdefault(thread, []).append(
+                    (time, message_id))
+        for mailbox in (self.sent, self.received, self.threads):
+            for pairs in mailbox.values():
+                pairs.sort()
+        self.unread = {u: len(pairs) for u, pairs in self.received.items()}
+
+    def set_read(self, message_ids, stamp):
+        """Replaces the set of messages read by their recipients, and
+        recounts every user's unread messages.
+
+        :param message_ids: An iterable of IDs. IDs of messages that
+            are not indexed are ignored.
+        :param stamp: The stamp of wherever the IDs were read from
+
+        """
+        self.read = {i for i in message_ids if i in self.entries}
+        self.unread = {u: len(pairs) for u, pairs in self.received.items()}
+        for message_id in self.read:
+            self._count_unread(self.entries[message_id][1], -1)
+        self.read_stamp = stamp
+
+    def mark_read(self, message_id):
+        """Records that a message was read by its recipient.
+
+        :returns: True if the message was indexed and unread
+
+        """
+        entry = self.entries.get(message_id)
+        if entry is None or message_id in self.read:
+            return False
+        self.read.add(message_id)
+        self._count_unread(entry[1], -1)
+        return True
+
+    def is_read(self, message_id):
+        """Checks whether a message was read by its recipient."""
+        return message_id in self.read
+
+    def counts(self, username):
+        """Returns ``(total, unread)``: how many messages ``username``
+        has received, and how many of those are unread."""
+        return (len(self.received.get(username, ())),
+                self.unread.get(username, 0))
+
+    def _count_unread(self, username, change):
+        count = self.unread.get(username, 0) + change
+        if count:
+            self.unread[username] = count
+        else:
+            self.unread.pop(username, None)
+
+    def get(self, message_id):
+        """Returns ``(time, to, from)`` for a message, or ``None``."""
+        return self.entries.get(message_id)
+
+    def all_ids(self):
+        """Returns every message ID, from most to least recent."""
+        pairs = sorted((e[0], i) for i, e in self.entries.items())
+        return [i for _, i in reversed(pairs)]
+
+    def sent_ids(self, username):
+        """Returns the IDs of messages sent by ``username``, from most
+        to least recent."""
+        return [i for _, i in reversed(self.sent.get(username, ()))]
+
+    def received_ids(self, username):
+        """Returns the IDs of messages received by ``username``, from
+        most to least recent."""
+        return [i for _, i in reversed(self.received.get(username, ()))]
+
+    def mailbox_ids(self, username, sent=True, received=True, start=None,
+                    end=None):
+        """Returns the IDs of the messages ``username`` sent and/or
+        received, from least to most recent, optionally only those
+        whose time is in ``[start, end)``.
+
+        Each end of the window is found by bisecting the mailbox, so
+        the cost is proportional to the number of IDs returned. A
+        message a user sent themselves is only listed once.
+
+        """
+        ids = []
+        for wanted, mailbox in ((sent, self.sent),
+                                (received, self.received)):
+            if not wanted:
+                continue
+            pairs = mailbox.get(username, ())
+            low = 0 if start is None else bisect_left(pairs, (start,))
+            high = len(pairs) if end is None else bisect_left(pairs, (end,))
+            ids.extend(i for _, i in pairs[low:high])
+        return list(dict.fromkeys(ids))
+
+    def thread_id(self, message_id):
+        """Returns the ID of the thread a message belongs to: the ID of
+        the conversation's first message (which is the message itself,
+        unless it is a reply)."""
+        return self.thread_of.get(message_id, message_id)
+
+    def thread_ids(self, message_id):
+        """Returns the IDs of every message in the same thread as
+        ``message_id``, from least to most recent. The thread's first
+        message is left out if it is no longer indexed."""
+        thread = self.thread_id(message_id)
+        pairs = list(self.threads.get(thread, ()))
+        if thread in self.entries:
+            pairs.append((self.entries[thread][0], thread))
+            pairs.sort()
+        return [i for _, i in pairs]
+
+    def expired(self, policy_for, now):
+        """Finds the messages that have outlived their retention policy.
+
+        Each mailbox (a user's sent or received messages) keeps its
+        messages for as long as its owner's policy says. A message is
+        expired once it has expired from *both* mailboxes it is in, so
+        one user's policy never deletes another user's copy early.
+
+        Since each mailbox is sorted by time, the expired messages of a
+        mailbox are always a prefix of it, found with one bisection.
+
+        :param policy_for: A function taking a username and returning
+            a ``(max_age, max_count)`` pair: a
+            :class:`datetime.timedelta` and an :class:`int`, either of
+            which may be ``None`` for no limit
+        :param datetime.datetime now: The current time
+
+        :returns: A list of ``(time, id, reason)`` tuples from least to
+            most recent, where ``reason`` is ``"age"`` if the message
+            is too old for both mailboxes, or ``"count"`` otherwise
+
+        """
+        sent = _expired_prefixes(self.sent, policy_for, now)
+        received = _expired_prefixes(self.received, policy_for, now)
+        expired = []
+        for message_id, reason in sent.items():
+            other = received.get(message_id)
+            if other is not None:
+                time = self.entries[message_id][0]
+                both_age = reason == other == "age"
+                expired.append((time, message_id,
+                                "age" if both_age else "count"))
+        expired.sort()
+        return expired
+
+    def save_snapshot(self, path):
+        """Saves the index to ``path``, so that a later process can load
+        it instead of scanning the message directory.
+
+        The snapshot is written to a temporary file first and renamed
+        into place, so that a crash never leaves a partial snapshot.
+
+        """
+        state = (SNAPSHOT_VERSION, self.directory, self.stamp,
+                 self.entries, self.sent, self.received, self.thread_of,
+                 self.threads, self.read, self.unread, self.read_stamp,
+                 self.seq)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as snapshot_file:
+            pickle.dump(state, snapshot_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load_snapshot(self, path, directory, stamp=None):
+        """Loads a snapshot saved by :meth:`save_snapshot`.
+
+        The snapshot is only used if it describes ``directory`` as of
+        ``stamp``; that is, if nothing changed since it was saved. If
+        ``stamp`` is ``None``, a snapshot of ``directory`` is used
+        however old it is, and the caller must bring it up to date
+        (e.g., from the change log, starting after :attr:`seq`).
+
+        :returns: True if the snapshot was loaded, otherwise False
+
+        """
+        try:
+            with open(path, "rb") as snapshot_file:
+                state = pickle.load(snapshot_file)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return False
+        if state[:2] != (SNAPSHOT_VERSION, directory) or (
+                stamp is not None and state[2] != stamp):
+            return False
+
+        self.clear(directory, state[2])
+        (self.entries, self.sent, self.received, self.thread_of,
+         self.threads, self.read, self.unread, self.read_stamp,
+         self.seq) = state[3:]
+        return True
+
+
+def _expired_prefixes(mailboxes, policy_for, now):
+    """Returns ``{id: reason}`` for the expired messages of every
+    mailbox in ``mailboxes``. See :meth:`MessageIndex.expired`."""
+    expired = {}
+    for user, pairs in mailboxes.items():
+        max_age, max_count = policy_for(user)
+        too_old = 0
+        if max_age is not None:
+            too_old = bisect_left(pairs, (now - max_age,))
+        too_many = 0
+        if max_count is not None:
+            too_many = max(0, len(pairs) - max_count)
+        for position in range(max(too_old, too_many)):
+            expired[pairs[position][1]] = ("age" if position < too_old
+                                           else "count")
+    return expired
+
+
+def directory_stamp(directory):
+    """Returns a value that changes whenever a file is added to or
+    removed from ``directory`` (its modification time), or ``None``
+    if the directory does not exist."""
+    try:
+        return os.stat(directory).st_mtime_ns
+    except OSError:
+        return None
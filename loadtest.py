@@ -0,0 +1,283 @@
+"""Load test module
+
+Replays a realistic mix of user sessions (login, inbox view, compose,
+view, delete) from many concurrent simulated users, and reports the
+throughput and latency percentiles of each route.
+
+Requests are driven either against the in-process WSGI application
+(:data:`server.message_app`, through WebTest, just like the test
+suite) or against a running ``server.py`` over HTTP.
+
+Example::
+
+    $ python loadtest.py --users 20 --duration 30
+    $ python loadtest.py --url http://localhost:8080 --users 50
+
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import (build_opener, HTTPCookieProcessor,
+                            HTTPRedirectHandler, Request)
+
+from bench_message import summarize_latencies
+
+
+DEFAULT_MIX = {"inbox": 50, "view": 25, "compose": 15, "delete": 5,
+               "login": 5}
+"""The relative weight of each action in a simulated session"""
+
+MESSAGE_LINK = re.compile(r'/view/([0-9a-f\-]{36})/')
+"""Finds links to messages in a rendered inbox page"""
+
+
+class WSGIClient:
+    """Sends requests to the in-process WSGI application.
+
+    Each client keeps its own cookies, so each simulated user should
+    get its own client.
+
+    """
+    def __init__(self):
+        # Imported here so that HTTP-only runs need not import the app
+        from webtest import TestApp
+        import server
+        self.app = TestApp(server.message_app)
+
+    def request(self, method, path, params=None):
+        """Sends a request and returns ``(status code, body text)``."""
+        if method == "GET":
+            response = self.app.get(path, expect_errors=True)
+        else:
+            response = self.app.post(path, params or {}, expect_errors=True)
+        return response.status_int, response.text
+
+
+class _NoRedirect(HTTPRedirectHandler):
+    """Keeps urllib from following redirects, so that each request is
+    measured on its own (as WebTest does)."""
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPClient:
+    """Sends requests to a running ``server.py`` over HTTP."""
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()),
+                                   _NoRedirect())
+
+    def request(self, method, path, params=None):
+        """Sends a request and returns ``(status code, body text)``."""
+        data = urlencode(params or {}).encode() if method == "POST" else None
+        req = Request(self.base_url + path, data=data, method=method)
+        try:
+            with self.opener.open(req) as response:
+                return response.status, response.read().decode()
+        except HTTPError as err:
+            return err.code, err.read().decode(errors="replace")
+
+
+class Recorder:
+    """Collects per-route latencies from many threads."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, route, latency, status):
+        """Records one request. Statuses of 400 and above are errors."""
+        with self.lock:
+            self.latencies.setdefault(route, []).append(latency)
+            if status >= 400:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def report(self, elapsed):
+        """Summarizes every route over ``elapsed`` seconds of wall time."""
+        report = {}
+        for route, latencies in sorted(self.latencies.items()):
+            report[route] = summarize_latencies(latencies, elapsed)
+            report[route]["errors"] = self.errors.get(route, 0)
+        return report
+
+
+def timed_request(client, recorder, route, method, path, params=None):
+    """Sends a request through ``client`` and records it as ``route``."""
+    start = time.perf_counter()
+    status, body = client.request(method, path, params)
+    recorder.record(route, time.perf_counter() - start, status)
+    return body
+
+
+def simulate_user(client, recorder, username, password, people, mix,
+                  deadline, rng, think_time=0.0):
+    """Runs one simulated user's session until ``deadline``.
+
+    The user logs in, and then repeatedly picks an action from
+    ``mix`` (weighted at random).
+
+    """
+    actions = sorted(mix)
+    weights = [mix[a] for a in actions]
+    credentials = {"username": username, "password": password}
+    timed_request(client, recorder, "POST /login/", "POST", "/login/",
+                  credentials)
+    known_ids = []
+
+    while time.time() < deadline:
+        action = rng.choices(actions, weights)[0]
+        if action == "login":
+            timed_request(client, recorder, "GET /login/", "GET", "/login/")
+            timed_request(client, recorder, "POST /login/", "POST",
+                          "/login/", credentials)
+        elif action == "inbox":
+            body = timed_request(client, recorder, "GET /", "GET", "/")
+            known_ids = MESSAGE_LINK.findall(body)
+        elif action == "compose":
+            timed_request(client, recorder, "GET /compose/", "GET",
+                          "/compose/")
+            timed_request(client, recorder, "POST /compose/", "POST",
+                          "/compose/", {
+                              "to": rng.choice(people),
+                              "subject": "Load test",
+                              "body": "x" * rng.randint(10, 2000),
+                          })
+        elif action == "view" and known_ids:
+            path = "/view/{}/".format(rng.choice(known_ids))
+            timed_request(client, recorder, "GET /view/<id>/", "GET", path)
+        elif action == "delete" and known_ids:
+            msg_id = known_ids.pop(rng.randrange(len(known_ids)))
+            path = "/delete/{}/".format(msg_id)
+            timed_request(client, recorder, "GET /delete/<id>/", "GET", path)
+            timed_request(client, recorder, "POST /delete/<id>/", "POST",
+                          path)
+        if think_time:
+            time.sleep(rng.expovariate(1.0 / think_time))
+
+
+def run_load_test(make_client, passwords, users=10, duration=10.0,
+                  mix=None, think_time=0.0, seed=0):
+    """Runs ``users`` simulated users concurrently for ``duration`` seconds.
+
+    :param make_client: A function returning a new client
+        (:class:`WSGIClient` or :class:`HTTPClient`)
+    :param dict passwords: Maps usernames to passwords
+    :param int users: The number of concurrent simulated users
+    :param float duration: How long to run, in seconds
+    :param dict mix: Action weights; defaults to :data:`DEFAULT_MIX`
+    :param float think_time: Mean pause between actions, in seconds
+    :param int seed: Seed for the simulated users' choices
+
+    :returns: A per-route report (see :meth:`Recorder.report`)
+
+    """
+    recorder = Recorder()
+    people = sorted(passwords)
+    deadline = time.time() + duration
+    threads = []
+    for i in range(users):
+        username = people[i % len(people)]
+        thread = threading.Thread(target=simulate_user, args=(
+            make_client(), recorder, username, passwords[username], people,
+            mix or DEFAULT_MIX, deadline, random.Random(seed + i),
+            think_time))
+        threads.append(thread)
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder.report(time.perf_counter() - start)
+
+
+def prepare_workdir():
+    """Creates a scratch working directory for the in-process app.
+
+    The application reads ``passwords.json``, ``templates/`` and
+    ``messages/`` relative to the working directory, so these are
+    copied over (the same way the test suite does).
+
+    :returns: The path of the new directory
+
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix="rockettalk-load-")
+    os.mkdir(os.path.join(workdir, "messages"))
+    shutil.copyfile(os.path.join(here, "passwords.json"),
+                    os.path.join(workdir, "passwords.json"))
+    shutil.copytree(os.path.join(here, "templates"),
+                    os.path.join(workdir, "templates"))
+    return workdir
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load test the RocketTalk Messaging Application'
+    )
+    parser.add_argument('--url', type=str,
+                        help='Base URL of a running server. If omitted, '
+                             'the in-process WSGI app is used.')
+    parser.add_argument('--users', type=int, default=10,
+                        help='The number of concurrent simulated users.')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='How long to run, in seconds.')
+    parser.add_argument('--think-time', type=float, default=0.0,
+                        help='Mean pause between actions, in seconds.')
+    parser.add_argument('--mix', type=str,
+                        help='Action weights as JSON, e.g. '
+                             '\'{"inbox": 5, "compose": 1}\'.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the simulated users.')
+    parser.add_argument('--output', type=str,
+                        help='Write the JSON report to this file.')
+    args = parser.parse_args()
+
+    with open("passwords.json") as pw_file:
+        passwords = json.load(pw_file)
+
+    if args.output:
+        # Relative to where we were run, not the scratch directory
+        args.output = os.path.abspath(args.output)
+    original = os.getcwd()
+    workdir = None
+    if args.url:
+        def make_client():
+            return HTTPClient(args.url)
+    else:
+        workdir = prepare_workdir()
+        os.chdir(workdir)
+        make_client = WSGIClient
+
+    try:
+        report = run_load_test(make_client, passwords, args.users,
+                               args.duration,
+                               json.loads(args.mix) if args.mix else None,
+                               args.think_time, args.seed)
+    finally:
+        if workdir:
+            os.chdir(original)
+            shutil.rmtree(workdir)
+
+    if args.output:
+        with open(args.output, "w") as out_file:
+            json.dump(report, out_file, indent=2, sort_keys=True)
+
+    fmt = "{:<20} {:>7} {:>8} {:>9} {:>9} {:>9} {:>6}"
+    print(fmt.format("route", "count", "req/s", "p50 ms", "p95 ms",
+                     "p99 ms", "errors"))
+    for route, r in report.items():
+        print(fmt.format(route, r["count"], "{:.1f}".format(r["ops_per_sec"]),
+                         "{:.2f}".format(r["p50"] * 1000),
+                         "{:.2f}".format(r["p95"] * 1000),
+                         "{:.2f}".format(r["p99"] * 1000), r["errors"]))
@@ -0,0 +1,291 @@
+"""Memory module
+
+Contains helper functions for finding out where a worker's memory
+goes, and for keeping its caches within a budget.
+
+* **Accounting** - Modules that keep data in memory (caches and
+  indexes) register an *account* with :func:`register_account`: a
+  function that estimates how many bytes the data takes up. Accounts
+  are cheap to read, and are reported in the
+  ``rockettalk_memory_account_bytes`` metric and by
+  :func:`report`.
+* **Budget** - If a budget is configured, a :class:`MemoryWorker`
+  checks the accounted total every ``interval`` seconds, and when it
+  is over budget asks the shrinkable accounts (caches), largest first,
+  to free the excess (see :func:`enforce_budget`). Only accounted
+  bytes count towards the budget: the process's resident size rarely
+  goes down after memory is freed, so a budget on it would keep
+  emptying the caches.
+* **Tracing** - If tracing is on, :mod:`tracemalloc` records where
+  every allocation was made, and the worker takes a snapshot every
+  ``interval`` seconds. :func:`report` lists the allocation sites
+  holding the most memory, and how each has grown since the previous
+  snapshot and since the first one, which shows what grows over a
+  day. Tracing slows Python down noticeably and uses memory of its
+  own, so it is off by default.
+
+Administrators can see the report at ``/admin/memory/``.
+
+"""
+import os
+import threading
+import traceback
+import tracemalloc
+
+import metrics
+
+
+_settings = {
+    "budget": None,      # Most accounted bytes, or None for no budget
+    "interval": 60.0,    # Seconds between checks (and snapshots)
+    "group_by": "lineno",  # How tracemalloc statistics are grouped
+}
+_accounts = {}  # name -> (estimate, shrink or None)
+_snapshots = {}  # "first" and "previous" -> tracemalloc.Snapshot
+_lock = threading.Lock()
+
+_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def configure(budget=None, interval=None, group_by=None):
+    """Updates the memory settings.
+
+    Arguments left as ``None`` are not changed.
+
+    :param int budget: The most bytes the accounts may hold before
+        caches are shrunk. ``0`` means no budget.
+    :param float interval: How many seconds to wait between checks
+    :param str group_by: How allocation sites are grouped in reports:
+        ``"lineno"`` (by line), ``"filename"`` (by module; shows e.g.
+        how much Jinja2 holds) or ``"traceback"``
+
+    """
+    if budget is not None:
+        _settings["budget"] = budget or None
+    if interval is not None:
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        _settings["interval"] = interval
+    if group_by is not None:
+        if group_by not in ("lineno", "filename", "traceback"):
+            raise ValueError("Unknown grouping {!r}".format(group_by))
+        _settings["group_by"] = group_by
+
+
+def register_account(name, estimate, shrink=None):
+    """Registers data kept in memory, to be accounted for.
+
+    :param str name: The name of the account
+    :param estimate: A function taking no arguments, that returns the
+        estimated bytes held
+    :param shrink: For caches, a function that takes a number of
+        bytes, evicts entries until no more than that is held, and
+        returns how many bytes it freed
+
+    """
+    _accounts[name] = (estimate, shrink)
+
+
+def accounted():
+    """Returns a dict mapping each account's name to its estimated
+    bytes."""
+    return {name: estimate() for name, (estimate, _) in _accounts.items()}
+
+
+def resident_bytes():
+    """Returns the process's resident set size, or ``None`` if it
+    cannot be read (``/proc`` is Linux only)."""
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def enforce_budget():
+    """Shrinks caches, largest first, until the accounted total is
+    within the budget (or every cache is empty).
+
+    :returns: How many bytes were freed
+
+    """
+    budget = _settings["budget"]
+    if budget is None:
+        return 0
+    sizes = accounted()
+    excess = sum(sizes.values()) - budget
+    freed = 0
+    for name in sorted(sizes, key=sizes.get, reverse=True):
+        shrink = _accounts[name][1]
+        if excess <= 0:
+            break
+        if shrink is None or not sizes[name]:
+            continue
+        amount = shrink(max(0, sizes[name] - excess))
+        excess -= amount
+        freed += amount
+    if freed:
+        metrics.inc("rockettalk_memory_shrinks_total")
+        metrics.inc("rockettalk_memory_freed_bytes_total", freed)
+    return freed
+
+
+def start_tracing(frames=1):
+    """Starts tracing allocations with :mod:`tracemalloc`, keeping
+    ``frames`` frames of traceback for each, and takes the first
+    snapshot."""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    with _lock:
+        _snapshots.clear()
+    take_snapshot()
+
+
+def stop_tracing():
+    """Stops tracing allocations, and forgets the snapshots."""
+    tracemalloc.stop()
+    with _lock:
+        _snapshots.clear()
+
+
+def take_snapshot():
+    """Takes a :mod:`tracemalloc` snapshot, if tracing is on. It
+    becomes the previous snapshot that the next report compares
+    against; the first one is kept as the baseline.
+
+    :returns: True if a snapshot was taken
+
+    """
+    if not tracemalloc.is_tracing():
+        return False
+    snapshot = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+    with _lock:
+        _snapshots.setdefault("first", snapshot)
+        _snapshots["previous"] = snapshot
+    metrics.inc("rockettalk_memory_snapshots_total")
+    return True
+
+
+def report(limit=10):
+    """Reports where memory goes, in a form that can be dumped as JSON.
+
+    :param int limit: How many allocation sites to list in each part
+        of the tracing report
+
+    :returns: A dict with the following fields:
+
+        * **accounts** - Estimated bytes held by each account
+        * **accounted** - Their total
+        * **budget** - The budget in bytes, or ``None``
+        * **resident** - The process's resident size, or ``None``
+        * **tracing** - Whether allocations are traced. If they are,
+          there are also:
+
+          - **traced** - The current and peak bytes traced
+          - **top** - The ``limit`` allocation sites holding the most
+            memory now, as dicts with ``site``, ``bytes`` and
+            ``count``
+          - **since_previous** and **since_first** - The sites that
+            grew the most since the previous and the first snapshots,
+            as dicts that also have ``bytes_diff`` and ``count_diff``
+
+    """
+    sizes = accounted()
+    result = {
+        "accounts": sizes,
+        "accounted": sum(sizes.values()),
+        "budget": _settings["budget"],
+        "resident": resident_bytes(),
+        "tracing": tracemalloc.is_tracing(),
+    }
+    if not result["tracing"]:
+        return result
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+    with _lock:
+        first = _snapshots.get("first")
+        previous = _snapshots.get("previous")
+    group_by = _settings["group_by"]
+    result["traced"] = {"current": current, "peak": peak}
+    result["top"] = [_describe(s) for s in
+                     snapshot.statistics(group_by)[:limit]]
+    for key, base in (("since_previous", previous), ("since_first", first)):
+        if base is not None:
+            diffs = snapshot.compare_to(base, group_by)[:limit]
+            result[key] = [_describe(d) for d in diffs]
+    return result
+
+
+def _describe(stat):
+    frame = stat.traceback[0]
+    described = {"site": "{}:{}".format(frame.filename, frame.lineno),
+                 "bytes": stat.size, "count": stat.count}
+    if isinstance(stat, tracemalloc.StatisticDiff):
+        described.update(bytes_diff=stat.size_diff,
+                         count_diff=stat.count_diff)
+    return described
+
+
+class MemoryWorker(threading.Thread):
+    """A daemon thread that, every ``interval`` seconds (see
+    :func:`configure`), takes a snapshot (if tracing is on) and
+    enforces the budget (if there is one), until :meth:`stop` is
+    called.
+
+    An error in one check is printed, and does not stop later ones.
+
+    """
+    def __init__(self):
+        super().__init__(name="memory", daemon=True)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(_settings["interval"]):
+            try:
+                take_snapshot()
+                enforce_budget()
+            except Exception:
+                traceback.print_exc()
+
+    def stop(self):
+        """Asks the worker to finish, and waits for it."""
+        self._stop_event.set()
+        self.join()
+
+
+def _account_bytes():
+    return {(("account", name),): size for name, size in accounted().items()}
+
+
+def _traced_bytes():
+    if not tracemalloc.is_tracing():
+        return 0
+    return tracemalloc.get_traced_memory()[0]
+
+
+metrics.describe("rockettalk_memory_shrinks_total", "counter",
+                 "Times caches were shrunk to stay within the memory "
+                 "budget.")
+metrics.describe("rockettalk_memory_freed_bytes_total", "counter",
+                 "Bytes freed by shrinking caches to stay within the "
+                 "memory budget.")
+metrics.describe("rockettalk_memory_snapshots_total", "counter",
+                 "tracemalloc snapshots taken.")
+metrics.register_gauge("rockettalk_memory_account_bytes",
+                       "Estimated bytes held by each in-process cache "
+                       "and index.", _account_bytes)
+metrics.register_gauge("rockettalk_memory_budget_bytes",
+                       "The memory budget for the accounts (0 for none).",
+                       lambda: _settings["budget"] or 0)
+metrics.register_gauge("rockettalk_memory_resident_bytes",
+                       "The process's resident set size.",
+                       lambda: resident_bytes() or 0)
+metrics.register_gauge("rockettalk_memory_traced_bytes",
+                       "Bytes allocated since tracing started that are "
+                       "still held (0 if tracing is off).", _traced_bytes)
@@ -3,17 +3,136 @@
 Helper functions for working with sent and received messages.
 
 """
+import base64
+import codecs
+import fcntl
 import json
+import mmap
 import os
-
+import re
+import shutil
+import sys
+import time
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from datetime import datetime
-from glob import glob
+from functools import lru_cache, partial
+from json.decoder import scanstring
+from threading import Lock
 from uuid import uuid4
 
+from cache import LRUCache
+from changelog import ChangeLog
+import codec
+from index import MessageIndex, directory_stamp
+import memory
+import metrics
+from metrics import timer
+
 
 DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 """The format to use for message time stamps"""
 
+MESSAGE_DIR = "messages"
+"""The directory (relative to the working directory) holding messages"""
+
+STORAGE_FORMAT = "json"
+"""The format new messages are saved in: ``"json"`` (``<uuid>.json``
+files) or ``"binary"`` (``<uuid>.msg`` files; see :mod:`codec`).
+Messages in either format can always be read."""
+
+INDEX_SNAPSHOT = None
+"""Path of a file to load the message index from at startup, instead
+of scanning :data:`MESSAGE_DIR`. See :func:`save_index_snapshot`."""
+
+CHANGE_LOG = None
+"""Path of a change log (see :mod:`changelog`) to record every change
+to :data:`MESSAGE_DIR` in. When several processes on one host use the
+same messages, set it to the same path in each of them, so that each
+process's index catches up on the others' changes by replaying the log
+rather than by rescanning the directory.
+
+It is required, not just faster: without a log, a process only notices
+other processes' changes from the directory's modification time, which
+misses a file added while it is writing, or within the same tick of
+the file system's clock. :func:`claim_directory` (which server.py
+calls on start up) refuses to share a directory without one."""
+
+CHECKPOINT_EVERY = 1000
+"""With a change log, the index is saved to :data:`INDEX_SNAPSHOT`
+whenever this many more changes have been logged, so that a process
+starting up replays at most this many changes rather than rescanning
+``messages/``"""
+
+LOAD_WORKERS = 1
+"""How many messages to read at once when loading many of them. The
+default (1) loads one message at a time, which is fastest when
+``messages/`` is on a local disk and already in the page cache. On
+network-backed storage, where each read waits on the network, 8-32
+workers keep many more reads in flight."""
+
+LOAD_IN_PROCESSES = False
+"""Whether to decode messages in a pool of processes (which sidesteps
+the GIL for JSON decoding) instead of threads (which is enough to keep
+the disk busy)"""
+
+PARALLEL_THRESHOLD = 64
+"""Fewer messages than this are loaded one at a time, since a pool
+would cost more than it saves"""
+
+HEADER_BLOCK = 4096
+"""How many bytes to read when looking for a message's header fields"""
+
+MMAP_THRESHOLD = 256 * 1024
+"""Message files at least this large are memory-mapped, rather than
+read, when their fields are searched"""
+
+COMPRESS_THRESHOLD = 64 * 1024
+"""Bodies of at least this many bytes (UTF-8 encoded) are saved
+zlib-compressed, if that makes them smaller. ``0`` or ``None``
+turns compression off. Messages saved either way can always be read."""
+
+COMPRESS_LEVEL = 6
+"""The zlib compression level (1 is fastest, 9 is smallest)"""
+
+CACHE_BYTES = 32 * 1024 * 1024
+"""The most memory (in bytes, estimated) to spend caching loaded
+messages, so that hot messages are not re-read and re-parsed on every
+view. ``0`` turns the cache off. See :mod:`cache`. With
+:data:`LOAD_IN_PROCESSES`, large batches are loaded (and cached) in the
+worker processes instead."""
+
+STREAM_CHUNK = 64 * 1024
+"""How many bytes of a body to copy at a time when it is written from,
+or read into, a stream"""
+
+INCOMING_DIR = ".incoming"
+"""The subdirectory of :data:`MESSAGE_DIR` where streamed messages are
+written before they are moved into place"""
+
+READ_DIR = ".read"
+"""The subdirectory of :data:`MESSAGE_DIR` recording which messages
+have been read by their recipient: an empty file named after each
+message's ID. Message files themselves are never changed."""
+
+SNAPSHOT_DIR = ".snapshots"
+"""The subdirectory of :data:`MESSAGE_DIR` holding snapshots in
+progress (see :func:`begin_snapshot`)"""
+
+_index = MessageIndex()
+_cache = LRUCache("messages", CACHE_BYTES)
+_pool = None
+_pool_lock = Lock()
+_snapshots = []  # Snapshots still being filled in; see begin_snapshot
+_log = None  # The ChangeLog at CHANGE_LOG, once opened
+_claim = None  # The locked ".serving" file; see claim_directory
+
+# Saved with replies only, between "from" and "subject" (so that they
+# come before "time", and can be read with the header fields)
+_REPLY_FIELDS = ("in_reply_to", "thread")
+
 
 def validate_message_form(form):
     """Validates a message form in the following ways:
@@ -44,11 +163,13 @@ def validate_message_form(form):
     return errors
 
 
-def _load_message(message_filename):
+@timer("rockettalk_storage_seconds", op="_load_message")
+def _load_message(message_filename, lazy=False):
     """Loads message data from a file.
 
-    Messages stored as JSON-encoded objects. Message data is loaded
-    and returned as dictionaries with the following attributes:
+    Messages stored as JSON-encoded objects (or in the binary format
+    described in :mod:`codec`, for ``.msg`` files). Message data is
+    loaded and returned as dictionaries with the following attributes:
 
     * **id** (:class:`str`) - The ID of the message. The same as
       its filename. Note that we **do not** store the id in the
@@ -66,71 +187,749 @@ def _load_message(message_filename):
     * **time** (:class:`datetime.datetime`) - The time when the
       message was sent
 
+    * **in_reply_to** (:class:`str`) - Only for replies: the ID of the
+      message replied to
+
+    * **thread** (:class:`str`) - Only for replies: the ID of the first
+      message of the conversation (see :func:`message.load_thread`)
+
     :param str message_filename: The path of the file that stores the
         JSON-encoded message data. The name of the file have the form
         ``<uuid>.json``, where ``<uuid>`` is a unique ID:
         https://en.wikipedia.org/wiki/Universally_unique_identifier
 
+    If ``lazy`` is true, the body is not read until it is first
+    accessed (see :class:`message.LazyMessage`). Pages that list
+    messages never show bodies, so they never pay to decode them.
+
+    If the body was saved compressed (see :data:`COMPRESS_THRESHOLD`),
+    it is only decompressed when it is first accessed, even if
+    ``lazy`` is false.
+
+    Messages are cached (see :data:`CACHE_BYTES`) by filename. Each
+    entry is checked against the file's :func:`os.stat` on every
+    lookup, so a file that was changed or replaced on disk is read
+    again. Compressed bodies are not cached.
+
+    :param bool lazy: Whether to defer reading the body
+
     :returns: A loaded message dict as described above
 
     """
-    with open(message_filename) as raw_file:
-        msg_data = json.load(raw_file)
-    msg = {}  # Because this homework makes me salty
+    if _cache.max_bytes != CACHE_BYTES:
+        _cache.resize(CACHE_BYTES)
+    version = None
+    if CACHE_BYTES:
+        stat = os.stat(message_filename)
+        version = (stat.st_ino, stat.st_dev, stat.st_mtime_ns, stat.st_size)
+        cached = _cache.get(message_filename, version,
+                            None if lazy else _has_body)
+        if cached is not None:
+            return _from_cache(cached, message_filename)
+
+    if lazy:
+        msg = _read_fields(message_filename, ("to", "from", "time", "subject"),
+                           optional=_REPLY_FIELDS)
+    else:
+        msg = _read_fields(message_filename,
+                           ("to", "from", "time", "subject", "body"),
+                           optional=_REPLY_FIELDS + ("encoding",))
+    encoding = msg.pop("encoding", None)
 
     # Using os, we split the filename from its path and extension.
-    msg["id"] = os.path.splitext(os.path.basename(message_filename))[0]
+    msg["id"] = _message_id(message_filename)
 
     # Using datetime, we convert the str to a datetime object
-    msg["time"] = datetime.strptime(msg_data["time"], DATE_FORMAT)
+    msg["time"] = parse_time(msg["time"])
+
+    if version is not None and encoding is None:
+        _cache.put(message_filename, version, dict(msg))
+    if lazy:
+        msg = LazyMessage(msg)
+        msg.defer("body", partial(_read_body, message_filename))
+    elif encoding is not None:
+        msg = LazyMessage(msg)
+        msg.defer("body", partial(_decode_body, msg["body"], encoding))
+    return msg
+
 
-    # Filling in the rest of msg keys
-    for k in ("to", "from", "subject", "body"):
-        msg[k] = msg_data[k]
+def _has_body(msg):
+    return "body" in msg
+
+
+def _from_cache(cached, message_filename):
+    """Returns a copy of a cached message for a caller to keep,
+    deferring the body if only the header was cached."""
+    if "body" in cached:
+        return dict(cached)
+    msg = LazyMessage(cached)
+    msg.defer("body", partial(_read_body, message_filename))
     return msg
 
 
-def load_message(message_id):
+class LazyMessage(dict):
+    """A loaded message whose expensive fields are read on first use.
+
+    It behaves like a plain message dict: deferred keys are listed by
+    ``keys()`` and ``in``, and are loaded as soon as their value is
+    looked up (by ``msg[key]``, ``get``, ``values``, ``items``,
+    comparison or pickling). Templates look fields up with ``[]``, so a
+    template that never shows a field never loads it.
+
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending = {}
+
+    def defer(self, key, loader):
+        """Adds ``key``, whose value will be ``loader()`` once needed."""
+        dict.__setitem__(self, key, None)
+        self._pending[key] = loader
+
+    def _load_pending(self, key=None):
+        keys = [key] if key is not None else list(self._pending)
+        for k in keys:
+            loader = self._pending.pop(k, None)
+            if loader is not None:
+                dict.__setitem__(self, k, loader())
+
+    def __getitem__(self, key):
+        if key in self._pending:
+            self._load_pending(key)
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        self._pending.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def values(self):
+        self._load_pending()
+        return dict.values(self)
+
+    def items(self):
+        self._load_pending()
+        return dict.items(self)
+
+    def copy(self):
+        self._load_pending()
+        return dict(self)
+
+    def __eq__(self, other):
+        self._load_pending()
+        if isinstance(other, LazyMessage):
+            other._load_pending()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return dict, (self.copy(),)
+
+    def __repr__(self):
+        self._load_pending()
+        return dict.__repr__(self)
+
+
+@lru_cache(maxsize=32)
+def _field_pattern(names):
+    """Compiles a regular expression that finds where the JSON string
+    values of the given keys start."""
+    keys = b"|".join(re.escape(n.encode()) for n in names)
+    return re.compile(b'"(' + keys + b')": "')
+
+
+def _read_fields(message_filename, names, optional=()):
+    """Reads some fields of a JSON-encoded message, without decoding
+    the rest of it.
+
+    The raw bytes are searched in place, so only the requested values
+    are copied out and decoded. This works because every value in a
+    message file is a string: inside a JSON string, every ``"`` is
+    escaped, so ``"key": "`` can only ever match a real key.
+
+    :func:`message.send_message` writes the body last, so the other
+    fields are usually within the first :data:`HEADER_BLOCK` bytes,
+    and reading them takes one small read no matter how big the body
+    is. Otherwise, the whole file is searched; files larger than
+    :data:`MMAP_THRESHOLD` are memory-mapped rather than read, so that
+    they are never copied into a Python object.
+
+    Files that are not laid out the way ``json.dump`` writes them
+    (e.g., with no space after ``:``) are decoded in full instead.
+
+    :param str message_filename: The message file to read
+    :param tuple names: The keys to read
+    :param tuple optional: Keys to read if they are present. They are
+        only looked for up to the last of ``names``, so they must be
+        written before it.
+
+    :raises OSError: If the file cannot be read
+    :raises ValueError: If the file is empty or not valid JSON
+    :raises KeyError: If any of the keys is missing
+
+    Binary message files (see :mod:`codec`) are read with
+    :func:`codec.read` instead; their ``time`` is already a
+    :class:`datetime.datetime`.
+
+    :returns: A dict mapping each key in ``names`` (and each key in
+        ``optional`` that was found) to its value
+
+    """
+    if message_filename.endswith(codec.EXTENSION):
+        msg_data = codec.read(message_filename, body="body" in names)
+        return _pick_fields(msg_data, names, optional)
+
+    pattern = _field_pattern(names + optional)
+    with open(message_filename, "rb") as raw_file:
+        block = raw_file.read(HEADER_BLOCK)
+        found = _match_fields(pattern, block, names)
+        if found is None and len(block) == HEADER_BLOCK:
+            size = os.fstat(raw_file.fileno()).st_size
+            if size >= MMAP_THRESHOLD:
+                with mmap.mmap(raw_file.fileno(), 0,
+                               access=mmap.ACCESS_READ) as data:
+                    found = _match_fields(pattern, data, names)
+            else:
+                found = _match_fields(pattern, block + raw_file.read(),
+                                      names)
+    if found is not None:
+        return found
+
+    with open(message_filename) as raw_file:
+        msg_data = json.load(raw_file)
+    return _pick_fields(msg_data, names, optional)
+
+
+def _pick_fields(msg_data, names, optional):
+    """Returns the ``names`` and any present ``optional`` keys of a
+    fully decoded message."""
+    fields = {k: msg_data[k] for k in names}
+    for k in optional:
+        if k in msg_data:
+            fields[k] = msg_data[k]
+    return fields
+
+
+def _match_fields(pattern, data, names):
+    """Finds the fields ``names`` in ``data`` with a pattern from
+    :func:`message._field_pattern`, or returns ``None``. Other keys
+    matched by the pattern on the way are returned too.
+
+    Each value is skipped over with ``find`` (rather than matched by
+    the pattern), so long values are passed over at memchr speed.
+
+    """
+    found = {}
+    remaining = len(names)
+    pos = 0
+    while True:
+        match = pattern.search(data, pos)
+        if match is None:
+            return None
+        start = match.end()
+        end = _string_end(data, start)
+        if end < 0:
+            return None
+        key = match.group(1).decode()
+        if key not in found:
+            value = data[start:end].decode()
+            if "\\" in value:
+                value = scanstring(value + '"', 0)[0]
+            found[key] = value
+            if key in names:
+                remaining -= 1
+                if not remaining:
+                    return found
+        pos = end + 1
+
+
+def _string_end(data, start):
+    """Returns the index of the ``"`` that ends the JSON string whose
+    contents begin at ``start``, or -1 if it is cut off."""
+    end = data.find(b'"', start)
+    while end >= 0:
+        # The quote ends the string unless it is escaped, i.e. preceded
+        # by an odd number of backslashes
+        backslashes = 0
+        while data[end - 1 - backslashes] == 0x5c:
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return end
+        end = data.find(b'"', end + 1)
+    return end
+
+
+def parse_time(text):
+    """Parses a time stamp written with :data:`DATE_FORMAT`.
+
+    Equivalent to ``datetime.strptime(text, DATE_FORMAT)``, but several
+    times faster for well-formed stamps, which matters when thousands
+    of messages are loaded at once.
+
+    :param text: The time stamp. A :class:`datetime.datetime` (as
+        read from a binary message) is returned as is.
+
+    :raises ValueError: If ``text`` is not a valid time stamp
+
+    """
+    if isinstance(text, datetime):
+        return text
+    if (len(text) == 19 and text[4] == text[7] == "-" and
+            text[10] == " " and text[13] == text[16] == ":"):
+        try:
+            return datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                            int(text[11:13]), int(text[14:16]),
+                            int(text[17:19]))
+        except ValueError:
+            pass
+    return datetime.strptime(text, DATE_FORMAT)
+
+
+def _read_body(message_filename):
+    """Reads only the body of a message, decompressing it if needed."""
+    fields = _read_fields(message_filename, ("body",), optional=("encoding",))
+    return _decode_body(fields["body"], fields.get("encoding"))
+
+
+def _encode_body(body, binary=False):
+    """Compresses a message body if it is large enough, and if that
+    makes it smaller.
+
+    Bodies saved as JSON are base64-encoded after compressing, which
+    grows them by a third, so they must compress better to be worth it.
+
+    :param str body: The body to save
+    :param bool binary: Whether the body will be saved in the binary
+        format (see :mod:`codec`), which stores bytes as they are
+
+    :returns: A ``(body, encoding)`` pair: either the body unchanged
+        and ``None``, or the compressed :class:`bytes` and ``"zlib"``
+
+    """
+    if not COMPRESS_THRESHOLD or len(body) < COMPRESS_THRESHOLD // 4:
+        return body, None  # Too short however it is encoded
+    data = body.encode("utf-8")
+    if len(data) < COMPRESS_THRESHOLD:
+        return body, None
+    with timer("rockettalk_compression_seconds", op="compress"):
+        packed = zlib.compress(data, COMPRESS_LEVEL)
+    stored = len(packed) if binary else (len(packed) + 2) // 3 * 4
+    if stored >= len(data):
+        metrics.inc("rockettalk_compression_skipped_total")
+        return body, None
+    metrics.inc("rockettalk_compression_bytes_total", len(data), stage="in")
+    metrics.inc("rockettalk_compression_bytes_total", stored, stage="out")
+    return packed, "zlib"
+
+
+def _check_encoding(encoding):
+    """Raises :class:`ValueError` unless we know how to decode bodies
+    saved with ``encoding``."""
+    if encoding != "zlib":
+        raise ValueError("Unknown body encoding: {}".format(encoding))
+
+
+def _decode_body(body, encoding):
+    """Undoes :func:`message._encode_body`.
+
+    :param body: The stored body: a :class:`str` (base64 text, if
+        compressed and read from JSON) or compressed :class:`bytes`
+    :param encoding: ``"zlib"``, or ``None`` if not compressed
+
+    :raises ValueError: If the encoding is unknown
+
+    """
+    if encoding is None:
+        return body
+    _check_encoding(encoding)
+    if isinstance(body, str):
+        body = base64.b64decode(body)
+    with timer("rockettalk_compression_seconds", op="decompress"):
+        return zlib.decompress(body).decode("utf-8")
+
+
+@timer("rockettalk_storage_seconds", op="load_message")
+def load_message(message_id, lazy=False):
     """Loads a single message from the ``messages/`` directory.
 
     Uses the ID of a message to construct a file path, and uses
     :func:`message._load_message` to load and return the message data.
 
+    :param bool lazy: Whether to defer reading the body (see
+        :func:`message._load_message`)
+
     :returns: A single loaded message.
 
     """
-    pathname = "messages/{}.json".format(message_id)
-    return _load_message(pathname)
+    return _load_message(_message_filename(message_id), lazy)
+
+
+def iter_message_body(message_id):
+    """Reads the body of a message a piece at a time.
+
+    At most about :data:`STREAM_CHUNK` bytes of the body are held in
+    memory at once, however large it is; compressed bodies are
+    decompressed as they are read.
+
+    The message file is opened right away, so a missing message raises
+    here rather than once iteration has started.
+
+    :raises OSError: If the message does not exist
+
+    :returns: An iterator of :class:`str` pieces of the body
+
+    """
+    message_filename = _message_filename(message_id)
+    return _body_chunks(open(message_filename, "rb"), message_filename)
+
+
+def _body_chunks(raw_file, message_filename):
+    """Yields the body of an open message file in pieces. See
+    :func:`message.iter_message_body`."""
+    with raw_file:
+        if message_filename.endswith(codec.EXTENSION):
+            offset, size, encoding = codec.body_span(raw_file)
+            raw_file.seek(offset)
+            chunks = _read_chunks(raw_file, size)
+            if encoding is not None:
+                chunks = _decompress_chunks(chunks)
+            yield from _text_chunks(chunks)
+            return
+
+        with mmap.mmap(raw_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            span = _json_body_span(data)
+            if span is None:  # Not laid out the way we write files
+                yield _read_body(message_filename)
+                return
+            start, end, encoding = span
+            if encoding is None:
+                yield from _json_string_chunks(data, start, end)
+                return
+            _check_encoding(encoding)
+            chunks = _base64_decode_chunks(data, start, end)
+            yield from _text_chunks(_decompress_chunks(chunks))
+
+
+def _read_chunks(raw_file, size):
+    """Yields the next ``size`` bytes of a file in pieces."""
+    while size > 0:
+        chunk = raw_file.read(min(STREAM_CHUNK, size))
+        if not chunk:
+            raise ValueError("Truncated message")
+        size -= len(chunk)
+        yield chunk
+
+
+def _json_body_span(data):
+    """Finds where the body of a JSON-encoded message starts and ends.
+
+    :returns: A ``(start, end, encoding)`` tuple, or ``None`` if the
+        body could not be found this way (see
+        :func:`message._read_fields`)
+
+    """
+    pattern = _field_pattern(("encoding", "body"))
+    encoding = None
+    pos = 0
+    while True:
+        match = pattern.search(data, pos)
+        if match is None:
+            return None
+        start = match.end()
+        end = _string_end(data, start)
+        if end < 0:
+            return None
+        if match.group(1) == b"body":
+            return start, end, encoding
+        encoding = data[start:end].decode()
+        pos = end + 1
+
+
+def _json_string_chunks(data, start, end):
+    """Decodes the contents of a JSON string in pieces.
+
+    Each piece is cut just before a backslash escape that would
+    otherwise be split (keeping ``\\uXXXX`` surrogate pairs together),
+    so that every piece can be decoded on its own.
+
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    pos = start
+    while pos < end:
+        cut = min(pos + STREAM_CHUNK, end)
+        if cut < end:
+            cut = _escape_boundary(data, pos, cut)
+        piece = decoder.decode(data[pos:cut])
+        if "\\" in piece:
+            piece = scanstring(piece + '"', 0)[0]
+        pos = cut
+        if piece:
+            yield piece
+    piece = decoder.decode(b"", True)
+    if piece:
+        yield piece
+
+
+_HIGH_SURROGATE = re.compile(rb"\\u[dD][89abAB][0-9a-fA-F]{2}$")
+
+
+def _escape_boundary(data, start, cut):
+    """Moves ``cut`` back so that it does not fall inside an escape
+    sequence of the JSON string contents in ``data[start:]``."""
+    escape = data.rfind(b"\\", max(start, cut - 12), cut)
+    if escape < 0:
+        return cut
+    # A run of backslashes always starts with an escape
+    while escape > start and data[escape - 1] == 0x5c:
+        escape -= 1
+    if escape - 6 >= start and _HIGH_SURROGATE.match(data[escape - 6:escape]):
+        escape -= 6
+        while escape > start and data[escape - 1] == 0x5c:
+            escape -= 1
+    return escape if escape > start else cut
+
+
+def _base64_decode_chunks(data, start, end):
+    """Yields the bytes encoded by the base64 text in
+    ``data[start:end]``, a piece at a time."""
+    step = STREAM_CHUNK - STREAM_CHUNK % 4
+    for pos in range(start, end, step):
+        yield base64.b64decode(data[pos:min(pos + step, end)])
+
+
+def _text_chunks(chunks):
+    """Decodes pieces of UTF-8 text, which may split characters."""
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", True)
+    if text:
+        yield text
+
+
+def _compress_chunks(chunks):
+    """Compresses pieces of a body with zlib, a piece at a time. The
+    result is the same as compressing them all with
+    :func:`message._encode_body`."""
+    compressor = zlib.compressobj(COMPRESS_LEVEL)
+    elapsed = 0.0
+    for chunk in chunks:
+        start = time.perf_counter()
+        packed = compressor.compress(chunk)
+        elapsed += time.perf_counter() - start
+        if packed:
+            yield packed
+    start = time.perf_counter()
+    packed = compressor.flush()
+    elapsed += time.perf_counter() - start
+    metrics.observe("rockettalk_compression_seconds", elapsed, op="compress")
+    yield packed
+
+
+def _decompress_chunks(chunks):
+    """Decompresses pieces of a zlib-compressed body. No piece of the
+    output is larger than :data:`STREAM_CHUNK`, however well the body
+    compressed."""
+    decompressor = zlib.decompressobj()
+    elapsed = 0.0
+    for chunk in chunks:
+        while chunk:
+            start = time.perf_counter()
+            data = decompressor.decompress(chunk, STREAM_CHUNK)
+            elapsed += time.perf_counter() - start
+            chunk = decompressor.unconsumed_tail
+            if data:
+                yield data
+    data = decompressor.flush()
+    metrics.observe("rockettalk_compression_seconds", elapsed,
+                    op="decompress")
+    if data:
+        yield data
+
+
+def _base64_chunks(chunks):
+    """Base64-encodes pieces of binary data, as text."""
+    carry = b""
+    for chunk in chunks:
+        chunk = carry + chunk
+        cut = len(chunk) - len(chunk) % 3
+        carry = chunk[cut:]
+        if cut:
+            yield base64.b64encode(chunk[:cut]).decode("ascii")
+    if carry:
+        yield base64.b64encode(carry).decode("ascii")
+
+
+@timer("rockettalk_storage_seconds", op="load_message_header")
+def load_message_header(message_id):
+    """Loads only the ``id``, ``to``, ``from`` and ``time`` of a message.
+
+    Much cheaper than :func:`message.load_message` for large messages,
+    since the subject and body are never decoded. Useful for checking
+    who may see a message.
+
+    :raises OSError: If the message does not exist
+
+    :returns: A dict with the keys ``id``, ``to``, ``from`` and ``time``
+
+    """
+    fields = _read_fields(_message_filename(message_id),
+                          ("to", "from", "time"))
+    return {"id": message_id, "to": fields["to"], "from": fields["from"],
+            "time": parse_time(fields["time"])}
+
+
+def find_message_header(message_id):
+    """Looks up the ``id``, ``to``, ``from`` and ``time`` of a message
+    in the message index, without opening any file.
+
+    Unlike :func:`message.load_message_header`, an ID that does not
+    exist costs no more than a dictionary lookup, so this is the one to
+    use for IDs taken from URLs, which bots and stale links fill with
+    messages that are long gone.
+
+    :returns: A dict like :func:`message.load_message_header`'s, or
+        ``None`` if there is no such message
+
+    """
+    return find_message_headers([message_id]).get(message_id)
+
+
+def find_message_headers(message_ids):
+    """Like :func:`message.find_message_header`, for many messages at
+    once; the index is checked and locked only once.
+
+    :param message_ids: An iterable of message IDs
+
+    :returns: A dict mapping each ID that exists to its header
+
+    """
+    headers = {}
+    with _index.lock:
+        index = _current_index()
+        for message_id in message_ids:
+            entry = index.get(message_id)
+            if entry is not None:
+                sent, to, sender = entry
+                headers[message_id] = {"id": message_id, "to": to,
+                                       "from": sender, "time": sent}
+    return headers
+
+
+def _load_messages(message_ids):
+    """Loads several messages, in the order given.
 
+    Messages whose files disappeared since they were indexed (e.g.,
+    deleted by another request in the meantime) are skipped. Any other
+    error from :func:`message._load_message` is raised.
 
+    :param message_ids: An iterable of message IDs
+
+    :returns: A list of loaded messages
+
+    """
+    filenames = [_message_filename(i) for i in message_ids]
+    return [m for m in _map_files(_load_if_exists, filenames) if m]
+
+
+def _load_if_exists(message_filename):
+    """Like :func:`message._load_message` (with a lazily loaded body),
+    but returns ``None`` if the file does not exist."""
+    try:
+        return _load_message(message_filename, lazy=True)
+    except FileNotFoundError:
+        return None
+
+
+def _header_if_exists(message_filename):
+    """Reads the ``(id, time, to, from, thread)`` of a message for the
+    index, or returns ``None`` if the file does not exist."""
+    try:
+        fields = _read_fields(message_filename, ("to", "from", "time"),
+                              optional=("thread",))
+    except FileNotFoundError:
+        return None
+    return (_message_id(message_filename),
+            parse_time(fields["time"]),
+            fields["to"], fields["from"], fields.get("thread"))
+
+
+def _map_files(func, filenames):
+    """Calls ``func`` on every filename, and returns the results in the
+    same order.
+
+    Large batches are spread over a pool of :data:`LOAD_WORKERS`
+    threads (or processes; see :data:`LOAD_IN_PROCESSES`), so that
+    many reads are in flight at once. If any call raises, the
+    exception from the earliest failing filename is raised, exactly as
+    if the files had been loaded one after another.
+
+    """
+    if LOAD_WORKERS <= 1 or len(filenames) < PARALLEL_THRESHOLD:
+        return [func(f) for f in filenames]
+    size = max(1, len(filenames) // (LOAD_WORKERS * 4))
+    chunks = [filenames[i:i + size] for i in range(0, len(filenames), size)]
+    results = []
+    for chunk_results in _get_pool().map(_map_chunk, [func] * len(chunks),
+                                         chunks):
+        results.extend(chunk_results)
+    return results
+
+
+def _map_chunk(func, filenames):
+    """Calls ``func`` on every filename in a chunk of work. Submitting
+    whole chunks keeps the pool's per-task overhead low."""
+    return [func(f) for f in filenames]
+
+
+def _get_pool():
+    """Returns the shared worker pool, creating it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            kind = (ProcessPoolExecutor if LOAD_IN_PROCESSES
+                    else ThreadPoolExecutor)
+            _pool = kind(max_workers=LOAD_WORKERS)
+        return _pool
+
+
+@timer("rockettalk_storage_seconds", op="load_all_messages")
 def load_all_messages():
     """Loads all messages from the ``messages/`` directory.
 
-    Uses :func:`message._load_message` and `glob.glob
-    <https://docs.python.org/3.4/library/glob.html#glob.glob>`_ to
-    create a new list of loaded messages. Messages are sorted
-    according to their timestamp, so that the returned list starts
-    with the most recent message and ends with the least recent.
+    Uses the message index (see :func:`message._current_index`) to
+    find every message in order, and :func:`message._load_message`
+    to load them. Messages are sorted according to their timestamp, so
+    that the returned list starts with the most recent message and
+    ends with the least recent.
 
     :returns: A list of loaded messages ordered by timestamp from
         most to least recent.
 
     """
-
-    all_files = glob("./messages/*.json")
-    msgs = [_load_message(i) for i in all_files]
-    return sorted(msgs, key=lambda x: x["time"], reverse=True)
+    with _index.lock:
+        message_ids = _current_index().all_ids()
+    return _load_messages(message_ids)
 
 
+@timer("rockettalk_storage_seconds", op="load_sent_messages")
 def load_sent_messages(username):
     """Loads all messages from the ``messages/`` directory that were
     **sent** by the specified user.
 
-    Uses :func:`message._load_message` and `glob.glob
-    <https://docs.python.org/3.4/library/glob.html#glob.glob>`_ to
-    create a new list of loaded messages. Messages are sorted
-    according to their timestamp, so that the returned list starts
-    with the most recent message and ends with the least recent.
+    Uses the message index to find the user's messages, so only their
+    files are opened (with :func:`message._load_message`). Messages
+    are sorted according to their timestamp, so that the returned list
+    starts with the most recent message and ends with the least
+    recent.
 
     The returned list container *only* messages that were sent by the
     specified user.
@@ -141,18 +940,21 @@ def load_sent_messages(username):
         by timestamp from most to least recent.
 
     """
-    return [m for m in load_all_messages() if m["from"] == username]
+    with _index.lock:
+        message_ids = _current_index().sent_ids(username)
+    return _load_messages(message_ids)
 
 
+@timer("rockettalk_storage_seconds", op="load_received_messages")
 def load_received_messages(username):
     """Loads all messages from the ``messages/`` directory that were
     **received** by the specified user.
 
-    Uses :func:`message._load_message` and `glob.glob
-    <https://docs.python.org/3.4/library/glob.html#glob.glob>`_ to
-    create a new list of loaded messages. Messages are sorted
-    according to their timestamp, so that the returned list starts
-    with the most recent message and ends with the least recent.
+    Uses the message index to find the user's messages, so only their
+    files are opened (with :func:`message._load_message`). Messages
+    are sorted according to their timestamp, so that the returned list
+    starts with the most recent message and ends with the least
+    recent.
 
     The returned list container *only* messages that were received by
     the specified user.
@@ -163,9 +965,51 @@ def load_received_messages(username):
         by timestamp from most to least recent.
 
     """
-    return [m for m in load_all_messages() if m["to"] == username]
+    with _index.lock:
+        message_ids = _current_index().received_ids(username)
+    return _load_messages(message_ids)
+
+
+@timer("rockettalk_storage_seconds", op="load_thread")
+def load_thread(message_id):
+    """Loads every message in the conversation (thread) that a message
+    belongs to: the first message, and every reply to it or to
+    another reply.
+
+    Uses the thread index, so only the thread's own files are opened.
+    Messages are sorted from least to most recent, the order a
+    conversation is read in.
+
+    :param str message_id: The ID of any message in the thread
+
+    :returns: A list of loaded messages (with lazily loaded bodies),
+        or an empty list if the message is not indexed
+
+    """
+    with _index.lock:
+        message_ids = _current_index().thread_ids(message_id)
+    return _load_messages(message_ids)
+
+
+def has_message(message_id):
+    """Checks whether a message is saved, using the index."""
+    return find_message_header(message_id) is not None
+
+
+def list_message_headers():
+    """Lists every message from the index, without opening any file.
+
+    :returns: A list of ``(id, time, to, from)`` tuples, from least to
+        most recent
+
+    """
+    with _index.lock:
+        entries = list(_current_index().entries.items())
+    return [(i, t, to, sender) for t, i, to, sender in
+            sorted((e[0], i, e[1], e[2]) for i, e in entries)]
 
 
+@timer("rockettalk_storage_seconds", op="send_message")
 def send_message(message_dict):
     """Saves a message to the ``messages/`` directory.
 
@@ -177,9 +1021,14 @@ def send_message(message_dict):
 
     * **subject** (:class:`str`) - The subject of the message
 
-    * **body** (:class:`str`) - The body of the message
+    * **body** (:class:`str`) - The body of the message. It may also
+      be a binary file object holding the body as UTF-8 text (such as
+      a large body spooled by :func:`streaming.read_message_form`),
+      which is copied :data:`STREAM_CHUNK` bytes at a time.
 
-    * **time** (:class:`str`) - The time the message was sent
+    * **in_reply_to** (:class:`str`) - Optional. The ID of the message
+      this one replies to. The reply joins that message's thread (see
+      :func:`message.load_thread`).
 
     The saved file is named uniquely by generating a UUID with
     Python's built-in `uuid.uuid4()
@@ -190,7 +1039,14 @@ def send_message(message_dict):
     The dictionary converted to a JSON-encoded string and saved to a
     file. The saved file has the name ``<uuid>.json`` (where
     ``<uuid>`` is a UUID) and is stored in the ``messages/``
-    directory.
+    directory. If :data:`STORAGE_FORMAT` is ``"binary"``, the message
+    is encoded with :func:`codec.encode` and saved as ``<uuid>.msg``
+    instead. The new message is added to the message index.
+
+    Bodies of at least :data:`COMPRESS_THRESHOLD` bytes are compressed
+    with zlib (and, in JSON, base64-encoded), and the file gets an
+    ``"encoding": "zlib"`` field. Loading such a message decompresses
+    the body only when it is accessed.
 
     :param dict message_dict: A dictionary containing message
         information as described above.
@@ -198,15 +1054,1085 @@ def send_message(message_dict):
     :raises OSError: If there's a problem writing to the file. Files
         are opened for `exclusive creation.
         <https://docs.python.org/3.4/library/functions.html#open>`_
+    :raises ValueError: If ``in_reply_to`` is not an existing message
 
-    :returns: None
+    :returns: The ID of the new message
 
     """
-    filename = "messages/" + str(uuid4()) + ".json"
+    message_id = str(uuid4())
+    # Stored times have no microseconds
+    now = datetime.now().replace(microsecond=0)
+    # The body goes last, so that the other fields can be read without
+    # reading past it (see _read_fields)
     msg = {}
-    for k in ("to", "from", "subject", "body"):
+    for k in ("to", "from"):
         msg[k] = message_dict[k]
-    msg["time"] = datetime.now().strftime(DATE_FORMAT)
-    with open(filename, 'w') as msg_file:
-        json.dump(msg, msg_file)
-    return
+    if message_dict.get("in_reply_to"):
+        msg.update(_reply_fields(message_dict["in_reply_to"]))
+    msg["subject"] = message_dict["subject"]
+    msg["time"] = now.strftime(DATE_FORMAT)
+    binary = STORAGE_FORMAT == "binary"
+    if hasattr(message_dict["body"], "read"):
+        _send_streamed(message_id, now, msg, message_dict["body"], binary)
+        return message_id
+    msg = _encode_record(msg, message_dict["body"], binary)
+    with _writing() as (index, changes):
+        filename = os.path.join(MESSAGE_DIR, message_id + _extensions()[0])
+        changes.append(_added(message_id, msg))
+        _write_record(filename, msg, now, binary)
+        index.add(message_id, now, msg["to"], msg["from"], msg.get("thread"))
+    return message_id
+
+
+def _reply_fields(in_reply_to):
+    """Returns the ``in_reply_to`` and ``thread`` fields of a reply to
+    a message, looking up the message's thread in the index.
+
+    :raises ValueError: If there is no such message
+
+    """
+    with _index.lock:
+        index = _current_index()
+        if index.get(in_reply_to) is None:
+            raise ValueError("No such message {} to reply to".format(
+                in_reply_to))
+        return {"in_reply_to": in_reply_to,
+                "thread": index.thread_id(in_reply_to)}
+
+
+def _encode_record(msg, body, binary):
+    """Adds a body to a message about to be saved, compressing it if
+    worthwhile (see :func:`message._encode_body`).
+
+    :param dict msg: The ``to``, ``from``, ``subject`` and ``time``
+        (as text) of the message. It is not changed.
+
+    :returns: The message as it should be saved
+
+    """
+    record = dict(msg)
+    body, encoding = _encode_body(body, binary)
+    if encoding is not None:
+        record["encoding"] = encoding
+        if not binary:
+            body = base64.b64encode(body).decode("ascii")
+    record["body"] = body
+    return record
+
+
+def _write_record(filename, record, now, binary):
+    """Writes a message from :func:`message._encode_record` to a new
+    file, in the binary format or as JSON."""
+    if binary:
+        codec.write(filename, dict(record, time=now))
+    else:
+        with open(filename, 'x') as msg_file:
+            json.dump(record, msg_file)
+
+
+@timer("rockettalk_storage_seconds", op="import_messages")
+def import_messages(messages):
+    """Saves a batch of messages that already have an ID and a time,
+    such as historical messages being migrated (see :mod:`importer`).
+
+    Each message is written to :data:`INCOMING_DIR` first, and the
+    whole batch is then linked into ``messages/`` at once. Readers
+    never see a partly written message, and the index lock is only
+    held for the links. A message whose ID is already taken is
+    skipped rather than overwritten, so importing the same messages
+    twice is harmless.
+
+    The message index is updated if it is in use; otherwise (e.g., in
+    a separate import process) it is left to be rebuilt when needed.
+    Either way, the messages are recorded in the change log (see
+    :data:`CHANGE_LOG`), if there is one.
+
+    :param messages: An iterable of dicts with the keys ``id``, ``to``,
+        ``from``, ``subject``, ``body`` (all :class:`str`) and ``time``
+        (a :class:`datetime.datetime` without microseconds). Replies
+        also have ``in_reply_to`` and ``thread`` (see
+        :func:`message.load_message`).
+
+    :raises OSError: If there's a problem writing a file. Messages
+        linked before the failure stay saved.
+
+    :returns: A list of the IDs of the messages that were saved
+
+    """
+    incoming = os.path.join(MESSAGE_DIR, INCOMING_DIR)
+    os.makedirs(incoming, exist_ok=True)
+    binary = STORAGE_FORMAT == "binary"
+    extension = _extensions()[0]
+    staged = []
+    saved = []
+    try:
+        for msg in messages:
+            record = {k: msg[k] for k in ("to", "from")}
+            if msg.get("thread"):
+                record.update((k, msg[k]) for k in _REPLY_FIELDS)
+            record["subject"] = msg["subject"]
+            record["time"] = msg["time"].strftime(DATE_FORMAT)
+            record = _encode_record(record, msg["body"], binary)
+            # Not named after the ID, in case two batches share an ID
+            tmp_filename = os.path.join(incoming, uuid4().hex + extension)
+            staged.append((msg, tmp_filename))
+            _write_record(tmp_filename, record, msg["time"], binary)
+
+        with _writing(sync=False) as (index, changes):
+            changes.extend(_added(msg["id"], dict(
+                msg, time=msg["time"].strftime(DATE_FORMAT)))
+                for msg, _ in staged)
+            for position, (msg, tmp_filename) in enumerate(staged):
+                filename = os.path.join(MESSAGE_DIR, msg["id"] + extension)
+                try:
+                    os.link(tmp_filename, filename)
+                except FileExistsError:
+                    changes.cancel(position)
+                    continue
+                saved.append(msg["id"])
+                if index is not None:
+                    index.add(msg["id"], msg["time"], msg["to"],
+                              msg["from"], msg.get("thread"))
+    finally:
+        for _, tmp_filename in staged:
+            try:
+                os.remove(tmp_filename)
+            except FileNotFoundError:
+                pass
+    return saved
+
+
+def _send_streamed(message_id, now, msg, body_file, binary):
+    """Saves a message whose body is a binary file object. See
+    :func:`message.send_message`.
+
+    The message is written to :data:`INCOMING_DIR` first, and only
+    linked into ``messages/`` once it is complete. Readers never see a
+    partly written message, and the index lock is only held for the
+    final link rather than for the whole copy.
+
+    """
+    incoming = os.path.join(MESSAGE_DIR, INCOMING_DIR)
+    os.makedirs(incoming, exist_ok=True)
+    name = message_id + _extensions()[0]
+    tmp_filename = os.path.join(incoming, name)
+
+    body_file.seek(0, os.SEEK_END)
+    size = body_file.tell()
+    compress = bool(COMPRESS_THRESHOLD) and size >= COMPRESS_THRESHOLD
+    try:
+        stored = _write_streamed(tmp_filename, msg, now, body_file, binary,
+                                 "zlib" if compress else None)
+        if compress and stored >= size:
+            metrics.inc("rockettalk_compression_skipped_total")
+            os.remove(tmp_filename)
+            _write_streamed(tmp_filename, msg, now, body_file, binary, None)
+        elif compress:
+            metrics.inc("rockettalk_compression_bytes_total", size,
+                        stage="in")
+            metrics.inc("rockettalk_compression_bytes_total", stored,
+                        stage="out")
+        with _writing() as (index, changes):
+            changes.append(_added(message_id, msg))
+            os.link(tmp_filename, os.path.join(MESSAGE_DIR, name))
+            index.add(message_id, now, msg["to"], msg["from"],
+                      msg.get("thread"))
+    finally:
+        try:
+            os.remove(tmp_filename)
+        except FileNotFoundError:
+            pass
+
+
+def _write_streamed(filename, msg, now, body_file, binary, encoding):
+    """Writes a message file, copying the body from ``body_file`` a
+    piece at a time.
+
+    :returns: How many bytes the stored body takes up
+
+    """
+    body_file.seek(0)
+    chunks = iter(partial(body_file.read, STREAM_CHUNK), b"")
+    header = dict(msg)
+    if encoding is not None:
+        header["encoding"] = encoding
+        chunks = _compress_chunks(chunks)
+    if binary:
+        return codec.write_stream(filename, dict(header, time=now), chunks)
+
+    if encoding is not None:
+        pieces = _base64_chunks(chunks)
+    else:
+        pieces = (json.dumps(text)[1:-1] for text in _text_chunks(chunks))
+    header["body"] = ""
+    stored = 0
+    with open(filename, 'x') as msg_file:
+        msg_file.write(json.dumps(header)[:-2])  # Up to the body's quote
+        for piece in pieces:
+            msg_file.write(piece)
+            stored += len(piece)
+        msg_file.write('"}')
+    return stored
+
+
+@timer("rockettalk_storage_seconds", op="remove_message")
+def remove_message(message_id):
+    """Deletes a message from the ``messages/`` directory, and removes
+    it from the message index.
+
+    :param str message_id: The ID of the message to delete
+
+    :raises OSError: If the message file could not be removed (e.g.,
+        it does not exist)
+
+    """
+    with _writing() as (index, changes):
+        filename = _message_filename(message_id)
+        _preserve(message_id, filename)
+        changes.append(("remove", message_id))
+        try:
+            _remove_files(message_id)
+        finally:
+            _forget(message_id)
+        _unmark_read(index, message_id)
+        index.discard(message_id)
+
+
+@timer("rockettalk_storage_seconds", op="remove_all_messages")
+def remove_all_messages():
+    """Deletes every message in the ``messages/`` directory, and empties
+    the message index.
+
+    :raises OSError: If any message file could not be removed. Files
+        removed before the failure stay removed.
+
+    """
+    with _writing() as (index, changes):
+        _cache.clear()
+        filenames = _list_message_files(MESSAGE_DIR)
+        changes.extend(("remove", _message_id(f)) for f in filenames)
+        for filename in filenames:
+            message_id = _message_id(filename)
+            _preserve(message_id, filename)
+            os.remove(filename)
+            _unmark_read(index, message_id)
+            index.discard(message_id)
+
+
+@timer("rockettalk_storage_seconds", op="remove_messages")
+def remove_messages(message_ids):
+    """Deletes several messages from the ``messages/`` directory, and
+    removes them from the message index.
+
+    Cheaper than calling :func:`message.remove_message` for each
+    message, since the index is checked and locked only once. Messages
+    that no longer exist are skipped.
+
+    :param message_ids: An iterable of message IDs
+
+    :raises OSError: If a message file could not be removed. Files
+        removed before the failure stay removed.
+
+    :returns: A list of the IDs of the messages that were removed
+
+    """
+    with _writing() as (index, changes):
+        return _remove(index, changes, message_ids)
+
+
+@timer("rockettalk_storage_seconds", op="remove_user_messages")
+def remove_user_messages(username, sent=True, received=True, start=None,
+                         end=None):
+    """Deletes a user's sent and/or received messages, optionally only
+    those sent in a time window.
+
+    The messages are found with the index (see
+    :meth:`index.MessageIndex.mailbox_ids`), so the cost is
+    proportional to how many messages are deleted, not to how many are
+    saved. Since the sender and the recipient of a message share its
+    file, it is gone from both mailboxes.
+
+    :param str username: The user
+    :param bool sent: Whether to delete the messages they sent
+    :param bool received: Whether to delete the messages they received
+    :param datetime.datetime start: If given, only messages sent at or
+        after this time are deleted
+    :param datetime.datetime end: If given, only messages sent before
+        this time are deleted
+
+    :raises OSError: If a message file could not be removed. Files
+        removed before the failure stay removed.
+
+    :returns: The number of messages removed
+
+    """
+    with _writing() as (index, changes):
+        message_ids = index.mailbox_ids(username, sent, received, start, end)
+        return len(_remove(index, changes, message_ids))
+
+
+def _remove(index, changes, message_ids):
+    """Deletes messages that may or may not exist, for
+    :func:`message.remove_messages`. The caller must be in a
+    :func:`message._writing` block.
+
+    :raises OSError: If a message file exists but could not be
+        removed. That message, and the ones after it, stay indexed;
+        the ones before it stay removed.
+
+    :returns: A list of the IDs of the messages that were removed
+
+    """
+    removed = []
+    message_ids = list(message_ids)
+    changes.extend(("remove", message_id) for message_id in message_ids)
+    for message_id in message_ids:
+        filename = _message_filename(message_id)
+        _preserve(message_id, filename)
+        try:
+            _remove_files(message_id)
+        except FileNotFoundError:
+            found = False
+        else:
+            found = True
+        finally:
+            _forget(message_id)
+        _unmark_read(index, message_id)
+        index.discard(message_id)
+        if found:
+            removed.append(message_id)
+    return removed
+
+
+def mark_read(message_id):
+    """Records that a message was read by its recipient, and updates
+    their unread count (see :func:`message.mailbox_counts`).
+
+    :param str message_id: The ID of the message
+
+    :returns: True if the message was unread until now
+
+    """
+    return mark_all_read([message_id]) == 1
+
+
+def mark_all_read(message_ids):
+    """Marks several messages as read at once (see :func:`mark_read`),
+    e.g. when restoring a backup. Unknown IDs are ignored.
+
+    :param message_ids: An iterable of message IDs
+
+    :returns: How many of the messages were unread until now
+
+    """
+    marked = 0
+    with _writing() as (index, changes):
+        read_dir = os.path.join(MESSAGE_DIR, READ_DIR)
+        for message_id in message_ids:
+            if index.get(message_id) is None or index.is_read(message_id):
+                continue
+            os.makedirs(read_dir, exist_ok=True)
+            changes.append(("read", message_id))
+            try:
+                open(os.path.join(read_dir, message_id), "x").close()
+            except FileExistsError:
+                pass
+            index.mark_read(message_id)
+            marked += 1
+    return marked
+
+
+def _unmark_read(index, message_id):
+    """Removes the read marker of a message being deleted. The caller
+    must hold ``_index.lock``."""
+    if index.is_read(message_id):
+        try:
+            os.remove(os.path.join(MESSAGE_DIR, READ_DIR, message_id))
+        except FileNotFoundError:
+            pass
+
+
+def is_read(message_id):
+    """Checks whether a message was read by its recipient."""
+    with _index.lock:
+        return _current_index().is_read(message_id)
+
+
+def mailbox_counts(username):
+    """Counts a user's received messages, and how many of them they
+    have not read yet.
+
+    The counts are kept up to date in the message index as messages
+    are sent, read and deleted, so this takes the same (short) time
+    however many messages there are.
+
+    :param str username: The recipient
+
+    :returns: A dict with the keys ``total`` and ``unread``
+
+    """
+    with _index.lock:
+        total, unread = _current_index().counts(username)
+    return {"total": total, "unread": unread}
+
+
+def find_expired_messages(policy_for, now=None):
+    """Finds the messages that have outlived a retention policy, using
+    the message index. See :meth:`index.MessageIndex.expired`.
+
+    :param policy_for: A function taking a username and returning a
+        ``(max_age, max_count)`` pair
+    :param datetime.datetime now: The current time. Defaults to now.
+
+    :returns: A list of ``(time, id, reason)`` tuples from least to
+        most recent
+
+    """
+    with _index.lock:
+        return _current_index().expired(policy_for, now or datetime.now())
+
+
+def clean_incoming(max_age=3600):
+    """Removes files left in :data:`INCOMING_DIR` by streamed sends
+    that never finished (e.g., because the server was killed).
+
+    :param float max_age: How old (in seconds) a file must be before
+        it is considered abandoned
+
+    :returns: The number of files removed
+
+    """
+    incoming = os.path.join(MESSAGE_DIR, INCOMING_DIR)
+    cutoff = time.time() - max_age
+    removed = 0
+    try:
+        with os.scandir(incoming) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+    except FileNotFoundError:
+        pass
+    return removed
+
+
+class Snapshot:
+    """A point-in-time copy of ``messages/``, made of hard links to the
+    message files in a private directory. See :func:`begin_snapshot`.
+
+    :ivar str directory: The directory holding the snapshot's links
+    :ivar dict records: ``id -> (time, to, from)`` for every message in
+        the snapshot
+    :ivar dict threads: ``id -> thread id`` for every reply in the
+        snapshot
+    :ivar set read: The IDs of the messages in the snapshot that had
+        been read by their recipient (see :data:`READ_DIR`)
+
+    """
+    def __init__(self, directory, records, threads, read=()):
+        self.directory = directory
+        self.records = records
+        self.threads = threads
+        self.read = set(read)
+        self._pending = set(records)  # Messages not linked in yet
+        self._lock = Lock()
+
+    def preserve(self, message_id, filename=None):
+        """Links a message into the snapshot, unless it is not part of
+        the snapshot or has been linked already.
+
+        :param str message_id: The ID of the message
+        :param str filename: The message's file, if known
+
+        :returns: True if the message was linked
+
+        """
+        with self._lock:
+            if message_id not in self._pending:
+                return False
+            self._pending.discard(message_id)
+            filename = filename or _message_filename(message_id)
+            target = os.path.join(self.directory, os.path.basename(filename))
+            try:
+                os.link(filename, target)
+            except FileNotFoundError:
+                # Removed by another process, which we can't stop
+                del self.records[message_id]
+                return False
+            return True
+
+    def fill(self):
+        """Links every message of the snapshot that has not been linked
+        yet. Once this returns, the snapshot is complete."""
+        for message_id in list(self._pending):
+            self.preserve(message_id)
+
+    def files(self):
+        """Returns the paths of the snapshot's message files, from least
+        to most recent. Only meaningful once :meth:`fill` returned."""
+        by_id = {_message_id(f): f for f in _list_message_files(
+            self.directory)}
+        pairs = sorted((r[0], i) for i, r in self.records.items()
+                       if i in by_id)
+        return [by_id[i] for _, i in pairs]
+
+    def close(self):
+        """Stops tracking the snapshot, and removes its directory."""
+        with _index.lock:
+            if self in _snapshots:
+                _snapshots.remove(self)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def begin_snapshot():
+    """Starts a consistent snapshot of ``messages/``, without stopping
+    other threads from sending or deleting messages.
+
+    The snapshot holds exactly the messages that were indexed at the
+    moment it was started. Message files are never changed once they
+    are in place, so a hard link to a file is as good as a copy of it;
+    the index lock is only held while the set of messages is copied.
+    The links are then made by :meth:`Snapshot.fill`, while a message
+    deleted in the meantime is linked into the snapshot just before
+    its file is removed. Messages sent after the snapshot started are
+    left out.
+
+    Call :meth:`Snapshot.close` once done with the snapshot.
+
+    :returns: A :class:`Snapshot`
+
+    """
+    name = "{}-{}".format(datetime.now().strftime("%Y%m%d%H%M%S"),
+                          uuid4().hex[:8])
+    with _writing() as (index, _):
+        directory = os.path.join(MESSAGE_DIR, SNAPSHOT_DIR, name)
+        os.makedirs(directory)  # Logged if SNAPSHOT_DIR was just created
+        snapshot = Snapshot(directory, dict(index.entries),
+                            dict(index.thread_of), index.read)
+        _snapshots.append(snapshot)
+    return snapshot
+
+
+def clean_snapshots(max_age=86400):
+    """Removes snapshot directories left in :data:`SNAPSHOT_DIR` by
+    backups that never finished (e.g., because the server was killed).
+    Snapshots still in use by this process are kept.
+
+    :param float max_age: How old (in seconds) a snapshot must be
+        before it is considered abandoned
+
+    :returns: The number of snapshots removed
+
+    """
+    with _index.lock:
+        active = {os.path.abspath(s.directory) for s in _snapshots}
+    cutoff = time.time() - max_age
+    removed = 0
+    try:
+        with os.scandir(os.path.join(MESSAGE_DIR, SNAPSHOT_DIR)) as entries:
+            for entry in entries:
+                if (os.path.abspath(entry.path) in active or
+                        entry.stat().st_mtime >= cutoff):
+                    continue
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+    except FileNotFoundError:
+        pass
+    return removed
+
+
+def _preserve(message_id, filename):
+    """Links a message into every snapshot that still needs it, before
+    its file is removed. The caller must hold ``_index.lock``."""
+    for snapshot in _snapshots:
+        snapshot.preserve(message_id, filename)
+
+
+def message_file(message_id):
+    """Returns the path of the file that stores a message, whichever
+    format it was saved in, e.g. to copy it to another node (see
+    :func:`sharding.deliver`).
+
+    :raises FileNotFoundError: If the message has no file
+
+    """
+    filename = _message_filename(message_id)
+    if not os.path.exists(filename):
+        raise FileNotFoundError(filename)
+    return filename
+
+
+def restore_message_file(name, source, index=False):
+    """Copies a message file (e.g., from a backup) into ``messages/``,
+    unless a message with the same ID is already saved.
+
+    The file is written to :data:`INCOMING_DIR` first and linked into
+    place once complete. Unless ``index`` is true, the message index
+    is not updated; it is rebuilt the next time it is used, or can be
+    replaced directly with :func:`rebuild_index`.
+
+    :param str name: The file's name: ``<uuid>.json`` or ``<uuid>.msg``
+    :param source: A binary file object to copy the file from
+    :param bool index: Whether to read the message's header fields and
+        add it to the index (and the change log) like a sent message.
+        Worth it for a few messages, but not for a whole backup.
+
+    :returns: True if the message was restored, False if it already
+        existed
+
+    """
+    message_id = _message_id(name)
+    if os.path.exists(_message_filename(message_id)):
+        return False
+    incoming = os.path.join(MESSAGE_DIR, INCOMING_DIR)
+    os.makedirs(incoming, exist_ok=True)
+    tmp_filename = os.path.join(incoming, uuid4().hex + "-" + name)
+    try:
+        with open(tmp_filename, "xb") as msg_file:
+            shutil.copyfileobj(source, msg_file, STREAM_CHUNK)
+        if not index:
+            os.link(tmp_filename, os.path.join(MESSAGE_DIR, name))
+            return True
+        _, sent, to, sender, thread = _header_if_exists(tmp_filename)
+        with _writing() as (current, changes):
+            changes.append(("add", message_id, sent.strftime(DATE_FORMAT),
+                            to, sender, thread))
+            os.link(tmp_filename, os.path.join(MESSAGE_DIR, name))
+            current.add(message_id, sent, to, sender, thread)
+    except FileExistsError:
+        return False
+    finally:
+        try:
+            os.remove(tmp_filename)
+        except FileNotFoundError:
+            pass
+    return True
+
+
+def rebuild_index(records):
+    """Replaces the message index without scanning ``messages/``.
+
+    :param records: An iterable of ``(id, time, to, from, thread)``
+        tuples (see :meth:`index.MessageIndex.rebuild`), which must
+        describe the messages in ``messages/`` exactly
+        (e.g., the manifest of a backup restored into an empty
+        directory)
+
+    """
+    with _index.lock:
+        log = _change_log()
+        seq = log.last_seq() if log is not None else None
+        directory = os.path.abspath(MESSAGE_DIR)
+        _index.rebuild(directory, directory_stamp(directory), records)
+        _index.seq = seq
+
+
+def _extensions():
+    """Returns the file extensions of the two storage formats, with the
+    one new messages are saved in (see :data:`STORAGE_FORMAT`) first."""
+    if STORAGE_FORMAT == "binary":
+        return codec.EXTENSION, ".json"
+    return ".json", codec.EXTENSION
+
+
+def _message_filename(message_id):
+    """Returns the path of the file that stores a message, in whichever
+    format it was saved. If there is no such file, the path it would
+    have in the current format is returned."""
+    base = os.path.join(MESSAGE_DIR, message_id)
+    preferred, other = _extensions()
+    if not os.path.exists(base + preferred) and os.path.exists(base + other):
+        return base + other
+    return base + preferred
+
+
+def _remove_files(message_id):
+    """Deletes a message's file, and its copy in the other format if
+    there is one (see :func:`codec.convert_directory`).
+
+    :raises FileNotFoundError: If the message has no file
+
+    """
+    removed = False
+    for extension in _extensions():
+        try:
+            os.remove(os.path.join(MESSAGE_DIR, message_id + extension))
+        except FileNotFoundError:
+            continue
+        removed = True
+    if not removed:
+        raise FileNotFoundError(_message_filename(message_id))
+
+
+def _forget(message_id):
+    """Drops a deleted message from the message cache, in whichever
+    format it was saved."""
+    for extension in _extensions():
+        _cache.discard(os.path.join(MESSAGE_DIR, message_id + extension))
+
+
+def _list_message_files(directory):
+    """Returns the paths of every message file (in either format) in
+    ``directory``, or an empty list if it does not exist."""
+    try:
+        with os.scandir(directory) as entries:
+            return [e.path for e in entries
+                    if e.name.endswith((".json", codec.EXTENSION)) and
+                    not e.name.startswith(".")]
+    except FileNotFoundError:
+        return []
+
+
+def _message_id(message_filename):
+    """Returns the ID of the message stored in a file."""
+    return os.path.splitext(os.path.basename(message_filename))[0]
+
+
+def _scan_messages(directory):
+    """Reads the metadata of every message in ``directory``.
+
+    :returns: A list of ``(id, time, to, from, thread)`` tuples, as expected
+        by :meth:`index.MessageIndex.rebuild`
+
+    """
+    return [r for r in _map_files(_header_if_exists,
+                                  _unique_message_files(directory)) if r]
+
+
+def _unique_message_files(directory):
+    """Returns the path of one file per message in ``directory``. A
+    message saved in both formats (e.g., by ``codec.py convert
+    --keep``, or while a conversion is running) is listed once, as its
+    binary file."""
+    by_id = {}
+    for filename in _list_message_files(directory):
+        message_id = _message_id(filename)
+        if (message_id not in by_id or
+                filename.endswith(codec.EXTENSION)):
+            by_id[message_id] = filename
+    return list(by_id.values())
+
+
+def _current_index():
+    """Returns the message index, after making sure that it describes
+    the current ``messages/`` directory.
+
+    If the directory changed behind our back (another process added
+    or removed files, or the working directory changed), the index
+    replays the changes recorded in the change log since it was last
+    up to date (see :data:`CHANGE_LOG`). If there is no log, or the
+    log does not explain every change, the index is reloaded from the
+    snapshot file (see :data:`INDEX_SNAPSHOT`) if it is still valid,
+    and otherwise rebuilt by scanning the directory.
+
+    The caller must hold ``_index.lock``.
+
+    """
+    directory = os.path.abspath(MESSAGE_DIR)
+    read_dir = os.path.join(directory, READ_DIR)
+    stamp, read_stamp = _stamps(directory)
+    if _index.is_current(directory, stamp) and (
+            _index.read_stamp == read_stamp):
+        return _index
+
+    log = _change_log()
+    if log is not None:
+        if _index.directory != directory and INDEX_SNAPSHOT:
+            # However old the snapshot, the log may bring it up to date
+            _index.load_snapshot(INDEX_SNAPSHOT, directory)
+        if _index.directory == directory and _catch_up(log, directory):
+            metrics.inc("rockettalk_index_refreshes_total", how="replay")
+            return _index
+        seq = log.last_seq()  # Before scanning; later changes are replayed
+        stamp, read_stamp = _stamps(directory)
+    if not _index.is_current(directory, stamp):
+        if INDEX_SNAPSHOT and _index.load_snapshot(INDEX_SNAPSHOT, directory,
+                                                   stamp):
+            metrics.inc("rockettalk_index_refreshes_total", how="snapshot")
+        else:
+            _index.rebuild(directory, stamp, _scan_messages(directory))
+            metrics.inc("rockettalk_index_refreshes_total", how="rescan")
+    if _index.read_stamp != read_stamp:
+        _index.set_read(_list_read(read_dir), read_stamp)
+    if log is not None:
+        _index.seq = seq
+    return _index
+
+
+def _catch_up(log, directory):
+    """Applies the changes logged since the index was last up to date.
+    The caller must hold ``_index.lock``.
+
+    :returns: True if the index is now current, or False if it must be
+        rebuilt: because the changes it needs were pruned from the log,
+        or because ``messages/`` was changed without logging the change
+
+    """
+    if _index.seq is None:
+        return False
+    with log.transaction():  # No other process is halfway through a change
+        _recover(log, directory)
+        changes = log.since(_index.seq)
+        if not changes:
+            return False
+        for (_, op, message_id, sent, to, sender, thread, _,
+             _) in changes:
+            if op == "add":
+                _index.add(message_id, parse_time(sent), to, sender, thread)
+            elif op == "remove":
+                _index.discard(message_id)
+                _forget(message_id)
+            elif op == "read":
+                _index.mark_read(message_id)
+        seq, stamps = changes[-1][0], changes[-1][-2:]
+        if stamps != _stamps(directory):
+            return False
+        _index.stamp, _index.read_stamp = stamps
+        _index.seq = seq
+    return True
+
+
+@contextmanager
+def _writing(sync=True):
+    """Takes what is needed to change ``messages/``: the index lock,
+    and the change log's write lock (if there is a log; see
+    :data:`CHANGE_LOG`), which keeps other processes from changing it
+    at the same time.
+
+    Yields an ``(index, changes)`` pair. ``index`` is the message
+    index, brought up to date; if ``sync`` is False, it is only the
+    index if that is up to date already, and otherwise ``None``.
+    ``changes`` is a :class:`message._Journal`, to which the caller
+    appends a tuple for every change *before* making it, so that the
+    change is in the log even if the process dies halfway through
+    making it. On the way out, even if the caller failed part way, the
+    changes are completed in the log and the index is restamped, so
+    that our own changes do not look like someone else's.
+
+    Every :data:`CHECKPOINT_EVERY` logged changes, the index is saved
+    to :data:`INDEX_SNAPSHOT` (if set), so that a process starting up
+    (after a crash, say) replays at most that many changes.
+
+    """
+    checkpoint = False
+    with _index.lock:
+        log = _change_log()
+        with ExitStack() as stack:
+            directory = os.path.abspath(MESSAGE_DIR)
+            if log is not None:
+                stack.enter_context(log.transaction())
+                _recover(log, directory)
+                start = log.last_seq()
+            before = _stamps(directory)
+            if sync:
+                index = _current_index()
+            elif _index.is_current(directory, before[0]):
+                index = _index
+            else:
+                index = None
+            changes = _Journal(log)
+            failed = False
+            try:
+                yield index, changes
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                if index is not None:
+                    _restamp(index)
+                after = _stamps(directory)
+                if log is not None and (changes or after != before):
+                    dropped = changes.cancelled
+                    if failed:
+                        dropped = dropped + [
+                            seq for seq, change in changes.logged()
+                            if not _was_made(change[0], change[1])]
+                    seq = log.complete(*after, dropped=dropped)
+                    if index is not None and index.seq == start:
+                        index.seq = seq
+                    checkpoint = (index is not None and INDEX_SNAPSHOT and
+                                  seq // CHECKPOINT_EVERY !=
+                                  start // CHECKPOINT_EVERY)
+    if checkpoint:
+        save_index_snapshot()
+        metrics.inc("rockettalk_index_checkpoints_total")
+
+
+class _Journal(list):
+    """The changes made in a :func:`message._writing` block. Each change
+    appended is logged as pending (see
+    :meth:`changelog.ChangeLog.intend`) right away, so it must be
+    appended before it is made.
+
+    :ivar list cancelled: The sequence numbers of changes that were
+        appended but then not made (see :meth:`cancel`)
+
+    """
+    def __init__(self, log):
+        super().__init__()
+        self.log = log
+        self.seqs = []
+        self.cancelled = []
+
+    def append(self, change):
+        self.extend([change])
+
+    def extend(self, changes):
+        changes = list(changes)
+        if self.log is not None and changes:
+            self.seqs.extend(self.log.intend(changes))
+        super().extend(changes)
+
+    def cancel(self, position):
+        """Records that the change appended at ``position`` was not
+        made after all (e.g., the message already existed)."""
+        if self.log is not None:
+            self.cancelled.append(self.seqs[position])
+
+    def logged(self):
+        """Returns ``(seq, change)`` pairs for the changes logged."""
+        return list(zip(self.seqs, self))
+
+
+def _recover(log, directory):
+    """Settles the changes left pending in the change log by a process
+    that died halfway through a batch (see :mod:`changelog`): each is
+    kept if it was made, and dropped otherwise. A message file that was
+    only partly written is deleted. The caller must hold the log's
+    write lock.
+
+    Only the pending changes are checked, so recovering takes time
+    proportional to the changes that were in flight, however many
+    messages are saved.
+
+    :returns: True if there was anything to recover
+
+    """
+    pending = log.pending()
+    if not pending:
+        return False
+    dropped = [seq for seq, op, message_id in pending
+               if not _was_made(op, message_id)]
+    log.complete(*_stamps(directory), dropped=dropped)
+    metrics.inc("rockettalk_journal_recovered_total",
+                len(pending) - len(dropped), outcome="kept")
+    metrics.inc("rockettalk_journal_recovered_total", len(dropped),
+                outcome="dropped")
+    return True
+
+
+def _was_made(op, message_id):
+    """Checks whether a logged change was made to the directory. A
+    message file that was only partly written (because its writer
+    failed or died halfway through) is deleted, and was not made."""
+    if op == "read":
+        return os.path.exists(os.path.join(MESSAGE_DIR, READ_DIR, message_id))
+    filename = _message_filename(message_id)
+    if op == "remove":
+        return not os.path.exists(filename)
+    try:
+        _read_fields(filename, ("to", "from", "time", "subject", "body"))
+    except FileNotFoundError:
+        return False
+    except (ValueError, KeyError):
+        os.remove(filename)
+        return False
+    return True
+
+
+def _added(message_id, msg):
+    """Returns the change log entry for a message being saved, given
+    its ``to``, ``from``, ``time`` (as text) and reply fields."""
+    return ("add", message_id, msg["time"], msg["to"], msg["from"],
+            msg.get("thread"))
+
+
+def _change_log():
+    """Returns the change log at :data:`CHANGE_LOG`, or ``None`` if
+    there is none. The caller must hold ``_index.lock``."""
+    global _log
+    if not CHANGE_LOG:
+        return None
+    path = os.path.abspath(CHANGE_LOG)
+    if _log is None or _log.path != path:
+        if _log is not None:
+            _log.close()
+        _log = ChangeLog(path)
+    return _log
+
+
+def _list_read(read_dir):
+    """Returns the IDs of the messages marked as read in ``read_dir``
+    (see :data:`READ_DIR`)."""
+    try:
+        return os.listdir(read_dir)
+    except FileNotFoundError:
+        return []
+
+
+def _restamp(index):
+    """Records the directory's stamp after we changed it ourselves, so
+    that our own changes do not look like someone else's."""
+    index.stamp, index.read_stamp = _stamps(index.directory)
+
+
+def _stamps(directory):
+    """Returns the stamps of a message directory and of its read
+    markers (see :data:`READ_DIR`)."""
+    return (directory_stamp(directory),
+            directory_stamp(os.path.join(directory, READ_DIR)))
+
+
+def claim_directory():
+    """Declares that this process serves :data:`MESSAGE_DIR`, for as
+    long as it runs, by locking ``.serving`` in it: shared with other
+    processes that use the same :data:`CHANGE_LOG`, and exclusive if
+    there is no log.
+
+    :raises RuntimeError: If another process serves the directory and
+        either of them has no change log
+
+    """
+    global _claim
+    if _claim is None:
+        os.makedirs(MESSAGE_DIR, exist_ok=True)
+        _claim = open(os.path.join(MESSAGE_DIR, ".serving"), "a")
+    mode = fcntl.LOCK_SH if CHANGE_LOG else fcntl.LOCK_EX
+    try:
+        # Claiming again converts our lock, rather than taking another
+        fcntl.flock(_claim, mode | fcntl.LOCK_NB)
+    except BlockingIOError:
+        raise RuntimeError(
+            "Another process is serving {}. Processes sharing messages "
+            "must all use the same change log.".format(MESSAGE_DIR))
+
+
+def save_index_snapshot():
+    """Saves the message index to :data:`INDEX_SNAPSHOT` (if set), so
+    that the next process to start can skip scanning ``messages/``.
+
+    """
+    if INDEX_SNAPSHOT:
+        with _index.lock:
+            _current_index().save_snapshot(INDEX_SNAPSHOT)
+
+
+metrics.register_gauge("rockettalk_index_messages",
+                       "Messages in the message index.",
+                       lambda: len(_index.entries))
+metrics.register_gauge("rockettalk_index_lookup_bytes",
+                       "Size of the index's table of message IDs, which "
+                       "answers every lookup by ID.",
+                       lambda: sys.getsizeof(_index.entries))
+
+
+def _index_bytes():
+    with _index.lock:
+        return _index.estimate_bytes()
+
+
+memory.register_account("message_cache", lambda: _cache.size, _cache.shrink)
+memory.register_account("message_index", _index_bytes)
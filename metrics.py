@@ -0,0 +1,348 @@
+"""Metrics module
+
+Contains helper functions for recording counters, gauges and latency
+histograms, and for exposing them in the `Prometheus text format
+<https://prometheus.io/docs/instrumenting/exposition_formats/>`_.
+
+Metrics are kept in process memory. Every update takes a single lock
+and a handful of dictionary operations, so recording is cheap enough
+to do on every request and storage call.
+
+"""
+import threading
+import time
+
+from bisect import bisect_left
+from functools import wraps
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+"""Upper bounds (in seconds) of the latency histogram buckets"""
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+"""The content type of :func:`render`'s output"""
+
+_lock = threading.Lock()
+_help = {}        # name -> (type, help text)
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., sum]
+_gauges = {}      # name -> function returning {labels: value}
+_local = threading.local()  # Per-thread timings; see start_timings
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def describe(name, kind, help_text):
+    """Sets the type and help text shown for a metric.
+
+    :param str name: The metric name
+    :param str kind: One of ``counter``, ``gauge`` or ``histogram``
+    :param str help_text: A one-line description of the metric
+
+    """
+    _help[name] = (kind, help_text)
+
+
+def inc(name, value=1, **labels):
+    """Increments a counter.
+
+    :param str name: The metric name
+    :param value: The amount to add
+    :param labels: Label names and values for this series
+
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """Records one observation (usually a duration in seconds) in a
+    histogram.
+
+    :param str name: The metric name
+    :param float value: The observed value
+    :param labels: Label names and values for this series
+
+    """
+    key = _key(name, labels)
+    index = bisect_left(DEFAULT_BUCKETS, value)
+    with _lock:
+        series = _histograms.get(key)
+        if series is None:
+            series = _histograms[key] = [0] * (len(DEFAULT_BUCKETS) + 2)
+        series[index] += 1
+        series[-1] += value
+
+
+def register_gauge(name, help_text, func):
+    """Registers a gauge whose value is computed when metrics are
+    rendered.
+
+    :param str name: The metric name
+    :param str help_text: A one-line description of the metric
+    :param func: A function taking no arguments. It returns either a
+        number, or a dict mapping label dicts (as tuples of
+        ``(name, value)`` pairs) to numbers.
+
+    """
+    describe(name, "gauge", help_text)
+    _gauges[name] = func
+
+
+def start_timings():
+    """Starts adding up, in the current thread, the time spent in each
+    operation timed with :class:`timer` and an ``op`` label (storage
+    and compression operations), e.g. while a request is handled.
+
+    :returns: A dict, filled in until :func:`stop_timings` is called,
+        mapping each ``op`` to a ``[calls, seconds]`` list. Operations
+        called by other timed operations are counted in both; the
+        ``None`` key holds the time spent in outermost operations
+        only, which is the total.
+
+    """
+    _local.timings = timings = {None: 0.0}
+    _local.depth = 0
+    return timings
+
+
+def stop_timings():
+    """Stops adding up timings in the current thread."""
+    _local.timings = None
+
+
+def _enter(labels):
+    if "op" in labels and getattr(_local, "timings", None) is not None:
+        _local.depth += 1
+
+
+def _leave(labels, duration):
+    op = labels.get("op")
+    timings = getattr(_local, "timings", None)
+    if op is None or timings is None:
+        return
+    _local.depth -= 1
+    totals = timings.get(op)
+    if totals is None:
+        totals = timings[op] = [0, 0.0]
+    totals[0] += 1
+    totals[1] += duration
+    if not _local.depth:
+        timings[None] += duration
+
+
+class timer:
+    """Times a block of code (or every call to a function) and records
+    the duration in a histogram.
+
+    Can be used as a context manager::
+
+        with timer("rockettalk_template_render_seconds", template=name):
+            ...
+
+    ...or as a decorator::
+
+        @timer("rockettalk_storage_seconds", op="load_message")
+        def load_message(message_id):
+            ...
+
+    """
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        _enter(self.labels)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter() - self.start
+        observe(self.name, duration, **self.labels)
+        _leave(self.labels, duration)
+
+    def __call__(self, func):
+        name, labels = self.name, self.labels
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            _enter(labels)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                observe(name, duration, **labels)
+                _leave(labels, duration)
+        return wrapper
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for k, v in pairs:
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n")
+        escaped.append('{}="{}"'.format(k, v.replace('"', '\\"')))
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """Renders every metric in the Prometheus text exposition format.
+
+    :returns: The metrics as a :class:`str`
+
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+
+    series = {}
+    for (name, labels), value in sorted(counters.items()):
+        series.setdefault(name, []).append(
+            name + _format_labels(labels) + " " + _format_value(value))
+
+    bounds = DEFAULT_BUCKETS + (float("inf"),)
+    for (name, labels), buckets in sorted(histograms.items()):
+        lines = series.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(bounds, buckets):
+            cumulative += count
+            le = (("le", _format_value(bound)),)
+            lines.append("{}_bucket{} {}".format(
+                name, _format_labels(labels, le), cumulative))
+        lines.append("{}_sum{} {}".format(
+            name, _format_labels(labels), _format_value(buckets[-1])))
+        lines.append("{}_count{} {}".format(
+            name, _format_labels(labels), cumulative))
+
+    for name, func in list(_gauges.items()):
+        value = func()
+        values = value if isinstance(value, dict) else {(): value}
+        series[name] = [name + _format_labels(labels) + " " +
+                        _format_value(v)
+                        for labels, v in sorted(values.items())]
+
+    out = []
+    for name in sorted(series):
+        if name in _help:
+            kind, help_text = _help[name]
+            out.append("# HELP {} {}".format(name, help_text))
+            out.append("# TYPE {} {}".format(name, kind))
+        out.extend(series[name])
+    return "\n".join(out) + "\n"
+
+
+def reset():
+    """Clears every recorded counter and histogram. Gauges are kept,
+    since they are computed on demand."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+class MetricsMiddleware:
+    """WSGI middleware that records the count, status and latency of
+    every request, labelled by the route rule that handled it. A
+    request is timed until its response has been sent.
+
+    The route is read from ``environ['bottle.route']``, which bottle
+    fills in once a request has been matched. Requests that match no
+    route are labelled ``<unmatched>``, so that junk URLs cannot
+    create an unbounded number of series.
+
+    :param app: The WSGI application to wrap
+
+    """
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        status = ["500"]
+
+        def recording_start_response(status_line, headers, exc_info=None):
+            status[0] = status_line.split(" ", 1)[0]
+            return start_response(status_line, headers, exc_info)
+
+        def finish():
+            route = environ.get("bottle.route")
+            rule = route.rule if route is not None else "<unmatched>"
+            method = environ.get("REQUEST_METHOD", "GET")
+            inc("rockettalk_http_requests_total", method=method, route=rule,
+                status=status[0])
+            observe("rockettalk_http_request_duration_seconds",
+                    time.perf_counter() - start, method=method, route=rule)
+
+        try:
+            result = self.app(environ, recording_start_response)
+        except BaseException:
+            finish()
+            raise
+        return ClosingIterable(result, finish)
+
+
+class ClosingIterable:
+    """Wraps a WSGI response iterable, and calls ``on_close`` once the
+    server closes it.
+
+    Middleware that measures a request uses this to stop measuring
+    once the response has been sent, rather than when the application
+    returns, since a streamed response (see ``server.streaming_view``)
+    does most of its work while it is sent.
+
+    """
+    def __init__(self, iterable, on_close):
+        self.iterable = iterable
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, "close"):
+                self.iterable.close()
+        finally:
+            on_close, self.on_close = self.on_close, None
+            if on_close is not None:
+                on_close()
+
+
+describe("rockettalk_http_requests_total", "counter",
+         "HTTP requests handled, by route and status code.")
+describe("rockettalk_http_request_duration_seconds", "histogram",
+         "Time spent handling HTTP requests, by route.")
+describe("rockettalk_storage_seconds", "histogram",
+         "Time spent in message storage operations.")
+describe("rockettalk_index_refreshes_total", "counter",
+         "Times the message index was brought up to date after another "
+         "process changed messages/, by how (replay, snapshot or rescan).")
+describe("rockettalk_index_checkpoints_total", "counter",
+         "Times the message index was saved to its snapshot after "
+         "CHECKPOINT_EVERY logged changes.")
+describe("rockettalk_journal_recovered_total", "counter",
+         "Pending changes left in the change log by a process that died, "
+         "by outcome (kept if they were made, otherwise dropped).")
+describe("rockettalk_password_check_seconds", "histogram",
+         "Time spent checking passwords.")
+describe("rockettalk_template_render_seconds", "histogram",
+         "Time spent rendering templates.")
+describe("rockettalk_compression_seconds", "histogram",
+         "Time spent compressing and decompressing message bodies.")
+describe("rockettalk_compression_bytes_total", "counter",
+         "Bytes of message bodies before (in) and after (out) compression.")
+describe("rockettalk_compression_skipped_total", "counter",
+         "Large message bodies saved uncompressed because they did not "
+         "shrink.")
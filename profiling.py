@@ -0,0 +1,154 @@
+"""Profiling module
+
+Contains an opt-in WSGI middleware that profiles selected requests
+with :mod:`cProfile`.
+
+A request is profiled when any of the following holds:
+
+* Profiling of every request was switched on (``server.py --profile``)
+* The request was picked at random (``server.py --profile-rate``)
+* The request carries an ``X-Profile`` header and was sent by an
+  administrator (see :func:`authentication.is_admin`)
+
+Each profile is written to the profile directory in the standard
+:mod:`pstats` format (view it with ``python -m pstats <file>`` or
+snakeviz), and a short text summary of the most recent profiles is
+kept in memory for ``/admin/profiles/``.
+
+When profiling is off, a request costs one dictionary lookup and one
+comparison.
+
+"""
+import os
+import random
+import threading
+import time
+
+from collections import deque
+from itertools import count
+from http.cookies import SimpleCookie
+
+from authentication import is_admin
+import metrics
+
+
+_settings = {
+    "directory": "profiles",  # Where .prof files are written
+    "always": False,          # Profile every request
+    "sample_rate": 0.0,       # Fraction of requests to profile
+    "summary_lines": 25,      # Functions listed in each summary
+}
+_recent = deque(maxlen=20)
+_lock = threading.Lock()
+_sequence = count()
+
+
+def configure(directory=None, always=None, sample_rate=None, keep=None):
+    """Updates the profiling settings.
+
+    Arguments left as ``None`` are not changed.
+
+    :param str directory: The directory to write profiles to
+    :param bool always: Whether to profile every request
+    :param float sample_rate: The fraction (0 to 1) of requests to
+        profile at random
+    :param int keep: How many recent summaries to keep in memory
+
+    """
+    global _recent
+    if directory is not None:
+        _settings["directory"] = directory
+    if always is not None:
+        _settings["always"] = always
+    if sample_rate is not None:
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("sample_rate must be between 0 and 1")
+        _settings["sample_rate"] = sample_rate
+    if keep is not None:
+        with _lock:
+            _recent = deque(_recent, maxlen=keep)
+
+
+def recent_profiles():
+    """Returns summaries of the most recently profiled requests.
+
+    :returns: A list of dicts (most recent first) with the keys
+        ``time``, ``method``, ``path``, ``duration``, ``file`` and
+        ``summary``
+
+    """
+    with _lock:
+        return list(reversed(_recent))
+
+
+def _should_profile(environ):
+    if "HTTP_X_PROFILE" in environ:
+        cookie = SimpleCookie(environ.get("HTTP_COOKIE", ""))
+        morsel = cookie.get("logged_in_as")
+        if morsel is not None and is_admin(morsel.value):
+            return True
+    if _settings["always"]:
+        return True
+    rate = _settings["sample_rate"]
+    return rate > 0 and random.random() < rate
+
+
+def _save(profile, environ, duration):
+    import io
+    import pstats
+
+    directory = _settings["directory"]
+    os.makedirs(directory, exist_ok=True)
+    started = time.time()
+    filename = os.path.join(directory, "{}-{}-{}.prof".format(
+        time.strftime("%Y%m%d-%H%M%S", time.localtime(started)),
+        environ.get("REQUEST_METHOD", "GET"),
+        next(_sequence)))
+    profile.dump_stats(filename)
+
+    out = io.StringIO()
+    stats = pstats.Stats(profile, stream=out)
+    stats.sort_stats("cumulative").print_stats(_settings["summary_lines"])
+    with _lock:
+        _recent.append({
+            "time": started,
+            "method": environ.get("REQUEST_METHOD", "GET"),
+            "path": environ.get("PATH_INFO", ""),
+            "duration": duration,
+            "file": filename,
+            "summary": out.getvalue(),
+        })
+
+
+class ProfilerMiddleware:
+    """WSGI middleware that profiles selected requests.
+
+    A request is profiled from the call into the wrapped application
+    (where bottle runs the handler) until its response has been sent,
+    so that templates rendered while they are streamed are included.
+
+    :param app: The WSGI application to wrap
+
+    """
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if not _should_profile(environ):
+            return self.app(environ, start_response)
+
+        import cProfile  # Not needed until the first profiled request
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+
+        def finish():
+            profile.disable()
+            _save(profile, environ, time.perf_counter() - start)
+
+        try:
+            result = self.app(environ, start_response)
+        except BaseException:
+            finish()
+            raise
+        return metrics.ClosingIterable(result, finish)
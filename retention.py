@@ -0,0 +1,343 @@
+"""Retention module
+
+Contains helper functions for deleting messages once they have been
+kept for long enough, according to a retention policy:
+
+* **max_age** - Messages older than this are deleted
+* **max_count** - Only this many of the most recent messages are kept
+  in each mailbox (a user's sent or received messages)
+
+A default policy applies to every user, and may be overridden per
+user. A message is deleted once it has expired from both its sender's
+and its recipient's mailbox (see :meth:`index.MessageIndex.expired`).
+
+Expired messages are found with the message index, so finding them
+never opens a message file. A background :class:`ExpiryWorker` deletes
+them in small batches, pausing between batches so that it never
+deletes more than a set number of messages per second; this keeps its
+I/O (and its hold on the index lock) from starving request handlers.
+After deleting, it compacts storage: it saves the index snapshot (if
+one is configured) and removes abandoned temporary files.
+
+The same check can be run as a *dry run*, which reports what would be
+deleted without deleting anything, from ``/admin/retention/`` or the
+command line::
+
+    $ python retention.py --max-age-days 90 --max-count 1000
+    $ python retention.py --policy retention.json --delete
+
+A policy file looks like this (``0`` means no limit)::
+
+    {"max_age_days": 90, "max_count": 1000,
+     "users": {"giovanni": {"max_age_days": 0, "max_count": 0}}}
+
+"""
+import json
+import threading
+import time
+import traceback
+
+from datetime import datetime, timedelta
+
+import message
+import metrics
+
+
+_settings = {
+    "max_age": None,    # A timedelta, or None for no limit
+    "max_count": None,  # An int, or None for no limit
+    "users": {},        # username -> {"max_age": ..., "max_count": ...}
+    "batch_size": 100,  # Messages deleted per batch
+    "rate": 200.0,      # Most messages deleted per second
+    "interval": 300.0,  # Seconds between runs of the worker
+    "dry_run": False,   # Whether the worker only reports
+}
+_last_report = {}
+_lock = threading.Lock()
+
+
+def configure(max_age_days=None, max_count=None, users=None,
+              batch_size=None, rate=None, interval=None, dry_run=None):
+    """Updates the retention settings.
+
+    Arguments left as ``None`` are not changed. A ``max_age_days`` or
+    ``max_count`` of ``0`` means no limit.
+
+    :param float max_age_days: The default maximum age, in days
+    :param int max_count: The default maximum mailbox size
+    :param dict users: Per-user overrides, mapping each username to a
+        dict with either or both of the keys ``max_age_days`` and
+        ``max_count``. Replaces any earlier overrides.
+    :param int batch_size: How many messages to delete at once
+    :param float rate: The most messages to delete per second
+    :param float interval: How many seconds to wait between runs
+    :param bool dry_run: Whether the worker should only report what
+        it would delete
+
+    """
+    if max_age_days is not None:
+        _settings["max_age"] = _to_max_age(max_age_days)
+    if max_count is not None:
+        _settings["max_count"] = max_count or None
+    if users is not None:
+        overrides = {}
+        for username, policy in users.items():
+            override = {}
+            if "max_age_days" in policy:
+                override["max_age"] = _to_max_age(policy["max_age_days"])
+            if "max_count" in policy:
+                override["max_count"] = policy["max_count"] or None
+            overrides[username.lower()] = override
+        _settings["users"] = overrides
+    if batch_size is not None:
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        _settings["batch_size"] = batch_size
+    if rate is not None:
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        _settings["rate"] = rate
+    if interval is not None:
+        _settings["interval"] = interval
+    if dry_run is not None:
+        _settings["dry_run"] = dry_run
+
+
+def load_policy(path):
+    """Configures retention from a JSON policy file (see the module
+    documentation for its format)."""
+    with open(path) as policy_file:
+        policy = json.load(policy_file)
+    configure(max_age_days=policy.get("max_age_days"),
+              max_count=policy.get("max_count"),
+              users=policy.get("users", {}))
+
+
+def _to_max_age(days):
+    return timedelta(days=days) if days else None
+
+
+def is_enabled():
+    """Checks whether any retention limit is configured."""
+    limits = [_settings["max_age"], _settings["max_count"]]
+    for override in _settings["users"].values():
+        limits.extend(override.values())
+    return any(limit is not None for limit in limits)
+
+
+def policy_for(username):
+    """Returns the ``(max_age, max_count)`` retention policy of a user.
+
+    :returns: A :class:`datetime.timedelta` and an :class:`int`, either
+        of which is ``None`` if there is no limit
+
+    """
+    override = _settings["users"].get(username, {})
+    return (override.get("max_age", _settings["max_age"]),
+            override.get("max_count", _settings["max_count"]))
+
+
+def describe_policy():
+    """Returns the current settings in a form that can be dumped as
+    JSON."""
+    def days(max_age):
+        return max_age.total_seconds() / 86400 if max_age else None
+
+    return {
+        "max_age_days": days(_settings["max_age"]),
+        "max_count": _settings["max_count"],
+        "users": {u: {"max_age_days": days(p.get("max_age")),
+                      "max_count": p.get("max_count")}
+                  for u, p in _settings["users"].items()},
+        "batch_size": _settings["batch_size"],
+        "rate": _settings["rate"],
+        "interval": _settings["interval"],
+        "dry_run": _settings["dry_run"],
+    }
+
+
+def last_report():
+    """Returns the report of the most recent run (see :func:`run_once`),
+    or an empty dict if there has been none."""
+    with _lock:
+        return dict(_last_report)
+
+
+def report_expired(now=None):
+    """Reports which messages are expired, without deleting them or
+    recording the report (see :func:`last_report`).
+
+    :param datetime.datetime now: The current time. Defaults to now.
+
+    :returns: A report dict as described for :func:`run_once`, whose
+        ``deleted`` and ``compacted`` are always 0
+
+    """
+    now = now or datetime.now()
+    return _report(message.find_expired_messages(policy_for, now), now, True)
+
+
+def _report(expired, now, dry_run):
+    by_reason = {"age": 0, "count": 0}
+    for _, _, reason in expired:
+        by_reason[reason] += 1
+    return {
+        "time": now.strftime(message.DATE_FORMAT),
+        "dry_run": dry_run,
+        "expired": len(expired),
+        "by_reason": by_reason,
+        "oldest": (expired[0][0].strftime(message.DATE_FORMAT)
+                   if expired else None),
+        "sample": [message_id for _, message_id, _ in expired[:20]],
+        "deleted": 0,
+        "compacted": 0,
+    }
+
+
+def run_once(dry_run=None, now=None, stop=None):
+    """Finds expired messages and (unless this is a dry run) deletes
+    them, a batch at a time, at no more than the configured rate.
+
+    :param bool dry_run: Whether to only report what would be deleted.
+        Defaults to the configured setting.
+    :param datetime.datetime now: The current time. Defaults to now.
+    :param threading.Event stop: If given and set, deleting stops
+        after the current batch.
+
+    :returns: A report dict with the keys ``time``, ``dry_run``,
+        ``expired`` (how many messages are expired), ``by_reason``
+        (the same, by ``"age"`` or ``"count"``), ``oldest`` (the time
+        of the oldest expired message), ``sample`` (the IDs of up to
+        20 of them), ``deleted``, ``compacted`` and ``duration``
+
+    """
+    if dry_run is None:
+        dry_run = _settings["dry_run"]
+    now = now or datetime.now()
+    stop = stop or threading.Event()
+    start = time.perf_counter()
+
+    expired = message.find_expired_messages(policy_for, now)
+    report = _report(expired, now, dry_run)
+
+    if not dry_run:
+        batch_size, rate = _settings["batch_size"], _settings["rate"]
+        for i in range(0, len(expired), batch_size):
+            if stop.is_set():
+                break
+            batch = expired[i:i + batch_size]
+            batch_start = time.perf_counter()
+            removed = set(message.remove_messages(m for _, m, _ in batch))
+            for _, message_id, reason in batch:
+                if message_id in removed:
+                    metrics.inc("rockettalk_retention_deleted_total",
+                                reason=reason)
+            report["deleted"] += len(removed)
+            # Sleep off whatever is left of this batch's time allowance
+            pause = len(batch) / rate - (time.perf_counter() - batch_start)
+            if pause > 0 and i + batch_size < len(expired):
+                stop.wait(pause)
+        report["compacted"] = _compact(report["deleted"])
+
+    report["duration"] = time.perf_counter() - start
+    metrics.inc("rockettalk_retention_runs_total",
+                mode="dry_run" if dry_run else "delete")
+    metrics.observe("rockettalk_retention_run_seconds", report["duration"])
+    with _lock:
+        _last_report.clear()
+        _last_report.update(report)
+    return report
+
+
+def _compact(deleted):
+    """Tidies storage after a run: removes abandoned temporary files,
+    and saves the index snapshot if any messages were deleted, so that
+    the next process does not have to rescan ``messages/``.
+
+    :returns: The number of temporary files removed
+
+    """
+    removed = message.clean_incoming()
+    if deleted:
+        message.save_index_snapshot()
+    return removed
+
+
+class ExpiryWorker(threading.Thread):
+    """A daemon thread that calls :func:`run_once` every ``interval``
+    seconds (see :func:`configure`), until :meth:`stop` is called.
+
+    An error in one run is printed and counted in
+    ``rockettalk_retention_errors_total``, and does not stop later
+    runs.
+
+    """
+    def __init__(self):
+        super().__init__(name="retention", daemon=True)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(_settings["interval"]):
+            try:
+                run_once(stop=self._stop_event)
+            except Exception:
+                metrics.inc("rockettalk_retention_errors_total")
+                traceback.print_exc()
+
+    def stop(self):
+        """Asks the worker to finish, and waits for it. A run in
+        progress stops after its current batch."""
+        self._stop_event.set()
+        self.join()
+
+
+def _pending():
+    report = last_report()
+    return report.get("expired", 0) - report.get("deleted", 0)
+
+
+def _last_run():
+    report = last_report()
+    if not report:
+        return 0
+    return time.mktime(time.strptime(report["time"], message.DATE_FORMAT))
+
+
+metrics.describe("rockettalk_retention_deleted_total", "counter",
+                 "Messages deleted by the retention worker, by reason.")
+metrics.describe("rockettalk_retention_runs_total", "counter",
+                 "Retention runs, by mode (delete or dry_run).")
+metrics.describe("rockettalk_retention_errors_total", "counter",
+                 "Retention runs that failed.")
+metrics.describe("rockettalk_retention_run_seconds", "histogram",
+                 "Time taken by each retention run, including pauses.")
+metrics.register_gauge("rockettalk_retention_pending",
+                       "Expired messages left undeleted by the last run.",
+                       _pending)
+metrics.register_gauge("rockettalk_retention_last_run_timestamp_seconds",
+                       "When the last retention run started.", _last_run)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Report (or delete) expired RocketTalk messages'
+    )
+    parser.add_argument('--max-age-days', type=float,
+                        help='Delete messages older than this.')
+    parser.add_argument('--max-count', type=int,
+                        help='Keep at most this many messages per mailbox.')
+    parser.add_argument('--policy', type=str,
+                        help='A JSON file with the retention policy.')
+    parser.add_argument('--rate', type=float,
+                        help='Delete at most this many messages a second.')
+    parser.add_argument('--delete', action='store_true',
+                        help='Delete expired messages (default: dry run).')
+    args = parser.parse_args()
+
+    if args.policy:
+        load_policy(args.policy)
+    configure(max_age_days=args.max_age_days, max_count=args.max_count,
+              rate=args.rate)
+    print(json.dumps(run_once(dry_run=not args.delete), indent=2))
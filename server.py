@@ -1,27 +1,99 @@
 # Python standard library imports
-import argparse
 import json
-import os
-import socket
-import sys
+import time
 
-from glob import glob
+from datetime import datetime, timedelta
+from functools import partial, wraps
 
 # Third party library imports (installed with pip)
-from bottle import (app, get, post, response, request, run,
-                    jinja2_view, redirect, static_file)
+from bottle import (app, get, post, response, request, run, view,
+                    Jinja2Template, redirect, static_file)
 from beaker.middleware import SessionMiddleware
 
 # Local imports
-from alerts import load_alerts, save_danger, save_success
+import accesslog
+import admission
+from alerts import load_alerts, save_alerts, save_danger, save_success
+import authentication
 from authentication import (
     requires_authentication, validate_login_form,
-    check_password, requires_authorization
+    check_password, requires_authorization, requires_admin,
+    is_authorized, may_view_message
 )
 from message import (
     validate_message_form, load_message, load_sent_messages,
-    load_received_messages, send_message
+    load_received_messages, remove_message,
+    remove_all_messages, iter_message_body, load_thread, mark_read,
+    mailbox_counts, find_message_headers, remove_messages,
+    remove_user_messages
 )
+import memory
+import message
+import metrics
+import profiling
+import retention
+import streaming
+
+
+class TimedJinja2Template(Jinja2Template):
+    """A Jinja2 template adapter that records how long each render
+    takes in the ``rockettalk_template_render_seconds`` histogram.
+
+    """
+    def render(self, *args, **kwargs):
+        with metrics.timer("rockettalk_template_render_seconds",
+                           template=self.name or "<string>"):
+            return super().render(*args, **kwargs)
+
+
+class StreamingJinja2Template(Jinja2Template):
+    """A Jinja2 template adapter that renders a template a piece at a
+    time, as the response is sent, instead of into one string.
+
+    Pieces are produced as the template runs, so a template that loops
+    over an iterator (like :func:`message.iter_message_body`) never
+    holds all of its output in memory. Render time is recorded like
+    :class:`TimedJinja2Template`'s, once the last piece is produced.
+
+    """
+    def render(self, *args, **kwargs):
+        for dictarg in args:
+            kwargs.update(dictarg)
+        context = self.defaults.copy()
+        context.update(kwargs)
+        return self._timed(self.tpl.generate(**context))
+
+    def _timed(self, pieces):
+        elapsed = 0.0
+        while True:
+            start = time.perf_counter()
+            piece = next(pieces, None)
+            elapsed += time.perf_counter() - start
+            if piece is None:
+                break
+            yield piece
+        metrics.observe("rockettalk_template_render_seconds", elapsed,
+                        template=self.name or "<string>")
+
+
+def current_mailbox_counts():
+    """Returns the logged in user's message counts (see
+    :func:`message.mailbox_counts`), or ``None`` if nobody is logged
+    in. Every template can call it as ``mailbox_counts()``; the navbar
+    does.
+
+    """
+    username = request.get_cookie("logged_in_as")
+    return mailbox_counts(username) if username else None
+
+
+Jinja2Template.defaults["mailbox_counts"] = current_mailbox_counts
+
+# Same as bottle.jinja2_view, but timed
+jinja2_view = partial(view, template_adapter=TimedJinja2Template)
+
+# Same as jinja2_view, but streams the rendered page
+streaming_view = partial(view, template_adapter=StreamingJinja2Template)
 
 
 @get('/')
@@ -59,6 +131,21 @@ def list_messages():
     return msgs
 
 
+@get('/counts/')
+@requires_authentication
+def show_counts():
+    """Handler for GET requests to ``/counts/`` path.
+
+    * Returns how many messages the user has received, and how many of
+      those are unread, as JSON (see :func:`message.mailbox_counts`).
+      Cheap enough for a page to poll.
+    * Requires users to be logged in
+
+    """
+    response.set_header("Cache-Control", "no-store")
+    return mailbox_counts(request.get_cookie("logged_in_as"))
+
+
 @get('/compose/')
 @jinja2_view("templates/compose_message.html")
 @load_alerts
@@ -78,16 +165,38 @@ def show_compose_message_form():
       username (from ``passwords.json``) excluding the currently
       logged in user.
 
+    * ``reply_to``: When replying (the ``reply_to`` query parameter is
+      a message ID), the message being replied to; otherwise ``None``.
+      Users may only reply to messages they may view.
+
+    * ``recipient`` and ``subject``: What to fill the form in with;
+      when replying, the other user in the conversation and the
+      subject with ``Re:`` in front
+
     :returns: a context dictionary (as described above) to be used by
         @jinja2_view to render a template.
 
     :rtype: dict
 
     """
-    result = {}
+    result = {"reply_to": None, "recipient": None, "subject": ""}
     with open("passwords.json") as p_files:
         pw = json.load(p_files)
     result["people"] = pw.keys()
+    reply_to = request.query.get("reply_to")
+    if reply_to:
+        username = request.get_cookie("logged_in_as")
+        if not may_view_message(username, reply_to):
+            save_danger("No such message " + reply_to)
+            redirect("/compose/")
+        parent = load_message(reply_to, lazy=True)
+        result["reply_to"] = parent
+        result["recipient"] = (parent["to"] if parent["from"] == username
+                               else parent["from"])
+        subject = parent["subject"]
+        if not subject.lower().startswith("re:"):
+            subject = "Re: " + subject
+        result["subject"] = subject
     return result
 
 
@@ -98,17 +207,32 @@ def process_compose_message_form():
 
     * Processes the message form
 
-        1. Validates the submitted form
+        1. Reads the submitted form with
+           :func:`streaming.read_message_form`, which spools large
+           bodies to a temporary file
+
+            - **If the body is too large**, saves a danger alert and
+              redirects the user back to ``/compose/``
+
+        2. Validates the submitted form
 
             - **If the form is has any errors**, saves the errors as
               danger alerts and redirects the user back to ``/compose/``
-            - Otherwise (no errors) proceed to step 2.
+            - **If the form replies to a message** (its
+              ``in_reply_to`` field) that the user may not view, the
+              same happens
+            - Otherwise (no errors) proceed to step 3.
 
-        2. Saves message data to a new file on disk
+        3. Saves message data to a new file on disk, and delivers a
+           copy to the recipient's node if sharding is on (see
+           :func:`sharding.send_message`)
 
-        3. Save a success alert message
+            - **If it cannot be delivered**, saves a danger alert and
+              redirects the user back to ``/compose/``
 
-        4. Redirects the user to ``/``
+        4. Save a success alert message
+
+        5. Redirects the user to ``/``
 
     * Requires users to be logged in
 
@@ -116,36 +240,98 @@ def process_compose_message_form():
         pages. It has no template to render.
 
     """
-    msg_form = request.forms
-    msg_form["from"] = request.get_cookie("logged_in_as")
-    errs = validate_message_form(msg_form)
-    if errs:  # Errors found in validation function
-        for e in errs:
-            save_danger(e)
+    try:
+        msg_form = streaming.read_message_form(request)
+    except streaming.BodyTooLarge as e:
+        save_danger(str(e))
         redirect("/compose/")
-    else:  # No errors found, continue with process
-        send_message(msg_form)
-        save_success("Message sent!")
-        redirect("/")
+    try:
+        msg_form["from"] = request.get_cookie("logged_in_as")
+        errs = validate_message_form(msg_form)
+        reply_to = msg_form.get("in_reply_to")
+        if reply_to and not may_view_message(msg_form["from"], reply_to):
+            errs.append("No such message " + reply_to)
+        if errs:  # Errors found in validation function
+            for e in errs:
+                save_danger(e)
+            redirect("/compose/")
+        else:  # No errors found, continue with process
+            import sharding  # Cheap; only delivery needs the network
+
+            try:
+                sharding.send_message(msg_form)
+            except ValueError as e:  # The message replied to is gone
+                save_danger(str(e))
+                redirect("/compose/")
+            except sharding.DeliveryError:
+                save_danger("The message could not be delivered. Please "
+                            "try again later.")
+                redirect("/compose/")
+            save_success("Message sent!")
+            redirect("/")
+    finally:
+        body = msg_form.get("body")
+        if hasattr(body, "close"):  # A large body spooled to a file
+            body.close()
 
 
 @get('/view/<message_id:re:[0-9a-f\-]{36}>/')
-@jinja2_view("templates/view_message.html")
+@streaming_view("templates/view_message.html")
 @load_alerts
 @requires_authorization
 def view_message(message_id):
     """Handler for GET requests to ``/view/<message_id>/`` path.
 
     * Displays a message
+    * Marks the message as read, if the user is its recipient
     * Requires a user to be authorized to view the message
     * Requires users to be logged in
     * Loads alerts for display
-    * Uses "templates/view_message.html" as its template
+    * Uses "templates/view_message.html" as its template, which is
+      streamed to the user as it renders
 
     This handler returns a context dictionary with the following fields:
 
     * ``message``: The message dictionary (loaded with
-      :func:`message.load_message`) for the given ``message_id``.
+      :func:`message.load_message`) for the given ``message_id``. Its
+      body is not read.
+
+    * ``body``: An iterator over pieces of the message body (see
+      :func:`message.iter_message_body`), so that a large body is
+      never held in memory at once.
+
+    :returns: a context dictionary (as described above) to be used by
+        @streaming_view to render a template.
+
+    :rtype: dict
+
+    """
+    msg = load_message(message_id, lazy=True)
+    if msg["to"] == request.get_cookie("logged_in_as"):
+        mark_read(message_id)
+    return {"message": msg, "body": iter_message_body(message_id)}
+
+
+@get(r'/thread/<message_id:re:[0-9a-f\-]{36}>/')
+@jinja2_view("templates/view_thread.html")
+@load_alerts
+@requires_authorization
+def view_thread(message_id):
+    """Handler for GET requests to ``/thread/<message_id>/`` path.
+
+    * Displays the whole conversation a message belongs to
+    * Requires a user to be authorized to view the message
+    * Requires users to be logged in
+    * Loads alerts for display
+    * Uses "templates/view_thread.html" as its template
+
+    This handler returns a context dictionary with the following fields:
+
+    * ``message_id``: The ID of the message the thread was opened from
+
+    * ``thread``: The messages of the conversation (loaded with
+      :func:`message.load_thread`) from least to most recent, leaving
+      out any the user may not view
 
     :returns: a context dictionary (as described above) to be used by
         @jinja2_view to render a template.
@@ -153,7 +339,10 @@ def view_message(message_id):
     :rtype: dict
 
     """
-    return {"message": load_message(message_id)}
+    username = request.get_cookie("logged_in_as")
+    thread = [m for m in load_thread(message_id)
+              if is_authorized(username, m)]
+    return {"message_id": message_id, "thread": thread}
 
 
 @get('/delete/<message_id:re:[0-9a-f\-]{36}>/')
@@ -172,7 +361,8 @@ def show_deletion_confirmation_form(message_id):
     This handler returns a context dictionary with the following fields:
 
     * ``message``: The message dictionary (loaded with
-      :func:`message.load_message`) for the given ``message_id``.
+      :func:`message.load_message`) for the given ``message_id``. Its
+      body is only read if the template uses it.
 
     :returns: a context dictionary (as described above) to be used by
         @jinja2_view to render a template.
@@ -180,7 +370,7 @@ def show_deletion_confirmation_form(message_id):
     :rtype: dict
 
     """
-    return {"message": load_message(message_id)}
+    return {"message": load_message(message_id, lazy=True)}
 
 
 @post('/delete/<message_id:re:[0-9a-f\-]{36}>/')
@@ -202,9 +392,8 @@ def delete_message(message_id):
         pages. It has no template to render.
 
     """
-    msg = "messages/{}.json".format(message_id)
     try:
-        os.remove(msg)  # Raising OSError?
+        remove_message(message_id)  # Raising OSError?
     except OSError:
         save_danger("No such message {}".format(message_id))
     else:
@@ -212,6 +401,70 @@ def delete_message(message_id):
     redirect("/")
 
 
+@post('/delete/')
+@requires_authentication
+def delete_messages():
+    """Handler for POST requests to ``/delete/`` path.
+
+    * Deletes several messages at once: every message whose ID is
+      given in an ``id`` field of the form (the field is repeated)
+
+        1. Looks up every message in the message index at once (see
+           :func:`message.find_message_headers`), so no file is read
+        2. Removes the messages the user sent or received, in one
+           batch (see :func:`message.remove_messages`)
+
+            - If any files could not be removed (``OSError``), then a
+              danger alert is saved.
+
+        3. Saves one alert summing up what happened to every ID: a
+           success alert if every message was deleted, and otherwise a
+           warning naming the IDs with no such message and those the
+           user may not delete
+        4. Redirects the user to ``/``
+
+    * Requires users to be logged in
+
+    :returns: None. This function only redirects users to other
+        pages. It has no template to render.
+
+    """
+    username = request.get_cookie("logged_in_as")
+    message_ids = list(dict.fromkeys(request.forms.getall("id")))
+    if not message_ids:
+        save_danger("No messages selected.")
+        redirect("/")
+    headers = find_message_headers(message_ids)
+    allowed = [i for i in message_ids
+               if i in headers and is_authorized(username, headers[i])]
+    try:
+        removed = set(remove_messages(allowed))
+    except OSError:
+        save_danger("Failed to delete messages.")
+        redirect("/")
+    missing = [i for i in message_ids
+               if i not in headers or i in allowed and i not in removed]
+    forbidden = [i for i in message_ids
+                 if i in headers and i not in allowed]
+    summary = "Deleted {} of {} messages.".format(len(removed),
+                                                  len(message_ids))
+    if missing:
+        summary += " No such message: {}.".format(_list_ids(missing))
+    if forbidden:
+        summary += " Not authorized: {}.".format(_list_ids(forbidden))
+    save_alerts(summary, kind="warning" if missing or forbidden
+                else "success")
+    redirect("/")
+
+
+def _list_ids(message_ids, limit=10):
+    """Lists message IDs for an alert, naming no more than ``limit``."""
+    text = ", ".join(message_ids[:limit])
+    if len(message_ids) > limit:
+        text += " and {} more".format(len(message_ids) - limit)
+    return text
+
+
 @get('/shred/')
 @jinja2_view("templates/shred_messages.html")
 @load_alerts
@@ -219,12 +472,15 @@ def delete_message(message_id):
 def show_shred_confirmation_form():
     """Handler for GET requests to ``/shred/`` path.
 
-    * Shows a form that can be used to delete all existing messages.
+    * Shows a form that can be used to delete the user's messages.
     * Requires users to be logged in
     * Loads alerts for display
     * Uses "templates/shred_messages.html" as its template
 
-    This handler returns an **empty** context dictionary.
+    This handler returns a context dictionary with the following fields:
+
+    * **everyone** (:class:`bool`) - False, since the form only shreds
+      the user's own messages (see :func:`show_admin_shred_form`)
 
     :returns: a context dictionary (as described above) to be used by
         @jinja2_view to render a template.
@@ -232,9 +488,20 @@ def show_shred_confirmation_form():
     :rtype: dict
 
     """
-    # This function doesn't need to pass any data to the template.
-    # Simply return {}
-    return {}
+    return {"everyone": False}
+
+
+def _parse_day(text):
+    """Parses a ``YYYY-MM-DD`` form field.
+
+    :returns: A :class:`datetime.datetime` at midnight, or None if the
+        field is blank
+
+    :raises ValueError: If the field is not a valid date
+
+    """
+    text = text.strip()
+    return datetime.strptime(text, "%Y-%m-%d") if text else None
 
 
 @post('/shred/')
@@ -242,29 +509,55 @@ def show_shred_confirmation_form():
 def shred_messages():
     """Handler for POST requests to ``/shred/`` path.
 
-    * Attempts to remove all saved message files
-
-        - If any files could not be removed (an exception of some sort),
-          then a danger alert is saved.
-        - If all files were removed successfully, a success alert is saved.
-        - In either case, the user is redirected to ``/``
-
+    * Attempts to remove the user's messages (see
+      :func:`message.remove_user_messages`). These form fields narrow
+      down which, and may be left out:
+
+        - ``mailbox`` - ``"sent"``, ``"received"`` or ``"both"`` (the
+          default)
+        - ``since`` and ``until`` - The first and last days
+          (``YYYY-MM-DD``) of the messages to remove
+
+    * If a field is invalid, a danger alert is saved and the user is
+      redirected to ``/shred/``
+    * If any files could not be removed (an exception of some sort),
+      then a danger alert is saved.
+    * Otherwise, a success alert is saved.
+    * In either case, the user is redirected to ``/``
     * Requires users to be logged in
 
+    Other users' messages are only removed if the user sent or received
+    them. Administrators can shred every message with ``/admin/shred/``.
+
     :returns: None. This function only redirects users to other
         pages. It has no template to render.
 
     """
-
-    all_msgs = glob("messages/*.json")
+    username = request.get_cookie("logged_in_as")
+    mailbox = request.forms.getunicode("mailbox") or "both"
+    try:
+        start = _parse_day(request.forms.getunicode("since") or "")
+        until = _parse_day(request.forms.getunicode("until") or "")
+    except ValueError:
+        save_danger("Dates must be in the form YYYY-MM-DD.")
+        redirect("/shred/")
+    if mailbox not in ("sent", "received", "both"):
+        save_danger("Unknown mailbox {}.".format(mailbox))
+        redirect("/shred/")
+    end = until + timedelta(days=1) if until else None
     try:
-        for msg in all_msgs:
-            os.remove(msg)
+        count = remove_user_messages(username,
+                                     sent=mailbox != "received",
+                                     received=mailbox != "sent",
+                                     start=start, end=end)
     except OSError:
         save_danger("Failed to shred messages.")
         redirect("/")
     else:
-        save_success("Shreded all messages.")
+        if mailbox == "both" and start is None and end is None:
+            save_success("Shreded all messages.")
+        else:
+            save_success("Shreded {} messages.".format(count))
         redirect("/")
 
 
@@ -371,6 +664,214 @@ def get_style_file(path):
     return static_file(path, root="assets")
 
 
+@get('/metrics')
+def show_metrics():
+    """Handler for GET requests to ``/metrics`` path.
+
+    * Returns request, storage, password check and template render
+      metrics in the Prometheus text format. See :mod:`metrics`.
+
+    """
+    response.content_type = metrics.CONTENT_TYPE
+    return metrics.render()
+
+
+@get('/admin/profiles/')
+@requires_admin
+def show_profiles():
+    """Handler for GET requests to ``/admin/profiles/`` path.
+
+    * Returns summaries of the most recently profiled requests as
+      JSON. See :mod:`profiling`.
+    * Requires users to be administrators
+
+    """
+    return {"profiles": profiling.recent_profiles()}
+
+
+@get('/admin/retention/')
+@requires_admin
+def show_retention():
+    """Handler for GET requests to ``/admin/retention/`` path.
+
+    * Returns the retention policy, the report of the expiry worker's
+      last run, and a dry run report of what would be deleted right
+      now, as JSON. See :mod:`retention`.
+    * Requires users to be administrators
+
+    """
+    return {"policy": retention.describe_policy(),
+            "last_run": retention.last_report(),
+            "dry_run": retention.report_expired()}
+
+
+@get('/admin/backup/')
+@requires_admin
+def download_backup():
+    """Handler for GET requests to ``/admin/backup/`` path.
+
+    * Streams a consistent snapshot of the message store as a
+      ``.tar.gz`` archive, without blocking other requests. See
+      :mod:`backup`.
+    * Requires users to be administrators
+
+    """
+    import backup  # Only needed by administrators
+
+    name = "rockettalk-{}.tar.gz".format(time.strftime("%Y%m%d-%H%M%S"))
+    response.content_type = "application/gzip"
+    response.set_header("Content-Disposition",
+                        'attachment; filename="{}"'.format(name))
+    return backup.stream_archive()
+
+
+@get('/admin/memory/')
+@requires_admin
+def show_memory():
+    """Handler for GET requests to ``/admin/memory/`` path.
+
+    * Returns the bytes held by in-process caches and indexes, the
+      memory budget, and (if allocations are traced) the allocation
+      sites holding the most memory and growing the fastest, as JSON.
+      The ``limit`` query parameter sets how many sites are listed.
+      See :mod:`memory`.
+    * Requires users to be administrators
+
+    """
+    try:
+        limit = int(request.query.get("limit") or 10)
+    except ValueError:
+        limit = 10
+    return memory.report(limit)
+
+
+@post('/admin/memory/snapshot/')
+@requires_admin
+def take_memory_snapshot():
+    """Handler for POST requests to ``/admin/memory/snapshot/`` path.
+
+    * Takes a :mod:`tracemalloc` snapshot now, for the next report to
+      compare against, and returns the report as JSON
+    * Requires users to be administrators
+
+    """
+    memory.take_snapshot()
+    return memory.report()
+
+
+@get('/admin/shred/')
+@jinja2_view("templates/shred_messages.html")
+@load_alerts
+@requires_admin
+def show_admin_shred_form():
+    """Handler for GET requests to ``/admin/shred/`` path.
+
+    * Shows a form that can be used to delete every message on the
+      server, whoever sent or received it.
+    * Requires users to be administrators
+    * Loads alerts for display
+    * Uses "templates/shred_messages.html" as its template
+
+    This handler returns a context dictionary with the following fields:
+
+    * **everyone** (:class:`bool`) - True
+
+    :returns: a context dictionary (as described above) to be used by
+        @jinja2_view to render a template.
+
+    :rtype: dict
+
+    """
+    return {"everyone": True}
+
+
+@post('/admin/shred/')
+@requires_admin
+def shred_all_messages():
+    """Handler for POST requests to ``/admin/shred/`` path.
+
+    * Attempts to remove all saved message files
+
+        - If any files could not be removed (an exception of some sort),
+          then a danger alert is saved.
+        - If all files were removed successfully, a success alert is saved.
+        - In either case, the user is redirected to ``/``
+
+    * Requires users to be administrators
+
+    :returns: None. This function only redirects users to other
+        pages. It has no template to render.
+
+    """
+    try:
+        remove_all_messages()
+    except OSError:
+        save_danger("Failed to shred messages.")
+        redirect("/")
+    else:
+        save_success("Shreded every message on the server.")
+        redirect("/")
+
+
+def requires_shard_secret(func):
+    """Same as :func:`sharding.requires_secret`, but :mod:`sharding`
+    (and the HTTP client it uses) is imported when an ``/internal/``
+    route is first called, rather than when server.py is imported.
+
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        import sharding
+        return sharding.requires_secret(func)(*args, **kwargs)
+    return wrapper
+
+
+@post(r'/internal/deliver/<name:re:[0-9a-f\-]{36}\.(json|msg)>')
+@requires_shard_secret
+def receive_message(name):
+    """Handler for POST requests to ``/internal/deliver/<name>`` path.
+
+    * Saves a message file delivered by another node (see
+      :func:`sharding.deliver`), unless the message is already here
+    * Marks it as read if the ``read`` query parameter is set
+    * Requires the shared secret of the nodes
+
+    """
+    saved = message.restore_message_file(name, request.body, index=True)
+    if request.query.get("read"):
+        mark_read(name.split(".")[0])
+    return {"saved": saved}
+
+
+@post('/internal/missing/')
+@requires_shard_secret
+def find_missing_messages():
+    """Handler for POST requests to ``/internal/missing/`` path.
+
+    * Returns which of the message IDs in the JSON request body (under
+      ``ids``) are not saved here, as JSON
+    * Requires the shared secret of the nodes
+
+    """
+    ids = (request.json or {}).get("ids", [])
+    return {"missing": [i for i in ids if not message.has_message(i)]}
+
+
+@post('/internal/rebalance/')
+@requires_shard_secret
+def rebalance_messages():
+    """Handler for POST requests to ``/internal/rebalance/`` path.
+
+    * Hands over the messages of users this node no longer owns, and
+      returns a report as JSON. See :func:`sharding.rebalance`.
+    * Requires the shared secret of the nodes
+
+    """
+    import sharding
+
+    return sharding.rebalance()
+
+
 # Configuration options for sessions.
 # Used by alerts module
 session_options = {
@@ -382,7 +883,40 @@ session_options = {
 message_app = app()
 message_app = SessionMiddleware(message_app, session_options)
 
-if __name__ == '__main__':
+# Turns requests away when the server is overloaded (see admission).
+# Outside the sessions middleware, so rejections skip session decoding
+message_app = admission.AdmissionMiddleware(message_app)
+
+# Records per-route request counts and latencies for /metrics
+message_app = metrics.MetricsMiddleware(message_app)
+
+# Profiles selected requests (off unless configured; see profiling)
+message_app = profiling.ProfilerMiddleware(message_app)
+
+# Writes a JSON line per request, including those turned away above
+# (off unless configured; see accesslog)
+message_app = accesslog.AccessLogMiddleware(message_app)
+
+
+def main(argv=None):
+    """Parses command line arguments and runs the web application.
+
+    Modules that are only needed here (``argparse``, ``socket``, ...)
+    are imported here rather than at the top of the file, so that
+    importing :mod:`server` (e.g., from a WSGI container or the tests)
+    does not pay for them.
+
+    :param list argv: The arguments to parse. Defaults to
+        ``sys.argv[1:]``.
+
+    """
+    import argparse
+    import atexit
+    import os
+    import signal
+    import socket
+    import sys
+
     # Set up a command line argument parser
     parser = argparse.ArgumentParser(
         description='Run the RocketTalk Messaging Application'
@@ -398,39 +932,283 @@ if __name__ == '__main__':
     parser.add_argument('--host', type=str, default="0.0.0.0",
                         help='The hostname to listen on.')
 
+    # Production mode runs a single process (no reloader child) without
+    # debug pages
+    parser.add_argument('--production', action='store_true',
+                        help='Disable debug mode and the reloader.')
+
+    # Load the message index from a snapshot instead of scanning
+    # messages/, and save it again on exit
+    parser.add_argument('--index-snapshot', type=str,
+                        help='A file to load/save the message index.')
+
+    # Share changes to messages/ with the other workers on this host
+    # (see message.CHANGE_LOG)
+    parser.add_argument('--change-log', type=str,
+                        help='A change log shared by every worker using '
+                             'the same messages. Required if there is '
+                             'more than one.')
+
+    # The format to save new messages in (see message.STORAGE_FORMAT)
+    parser.add_argument('--storage-format', choices=('json', 'binary'),
+                        default='json',
+                        help='The format to save new messages in.')
+
+    # Parallel loading for large scans (see message.LOAD_WORKERS)
+    parser.add_argument('--load-workers', type=int, default=1,
+                        help='How many messages to read at once.')
+    parser.add_argument('--load-in-processes', action='store_true',
+                        help='Decode messages in worker processes.')
+
+    # Compress large bodies (see message.COMPRESS_THRESHOLD)
+    parser.add_argument('--compress-threshold', type=int,
+                        default=message.COMPRESS_THRESHOLD,
+                        help='Compress bodies of at least this many bytes '
+                             '(0 to disable).')
+
+    # Cache hot messages in memory (see message.CACHE_BYTES)
+    parser.add_argument('--message-cache', type=float,
+                        default=message.CACHE_BYTES / 1024 / 1024,
+                        help='Most MiB of loaded messages to cache '
+                             '(0 to disable).')
+
+    # The largest message body that may be sent
+    parser.add_argument('--max-body-size', type=int,
+                        default=streaming.MAX_BODY_SIZE,
+                        help='The largest message body (in bytes) to accept.')
+
+    # Retention (see the retention module)
+    parser.add_argument('--retention-max-age', type=float,
+                        help='Delete messages older than this many days.')
+    parser.add_argument('--retention-max-count', type=int,
+                        help='Keep at most this many messages per mailbox.')
+    parser.add_argument('--retention-policy', type=str,
+                        help='A JSON file with per-user retention policies.')
+    parser.add_argument('--retention-interval', type=float, default=300.0,
+                        help='Seconds between retention runs.')
+    parser.add_argument('--retention-rate', type=float, default=200.0,
+                        help='Delete at most this many messages a second.')
+    parser.add_argument('--retention-dry-run', action='store_true',
+                        help='Only report what retention would delete.')
+
+    # Backups (see the backup module)
+    parser.add_argument('--backup-rate', type=float,
+                        help='Most MiB of messages a backup reads per '
+                             'second (0 for no limit; default 20).')
+
+    # Admission control (see the admission module)
+    parser.add_argument('--limit', type=str, action='append', default=[],
+                        metavar='CLASS=N',
+                        help='Handle at most N requests of a route class '
+                             '(list, shred, assets, admin, metrics or '
+                             'other) at once. May be given more than once.')
+    parser.add_argument('--max-queue', type=int, default=32,
+                        help='Most requests of a route class that may wait '
+                             'for a slot.')
+    parser.add_argument('--queue-timeout', type=float, default=0.5,
+                        help='Seconds a request may wait for a slot before '
+                             'getting a 503.')
+    parser.add_argument('--compose-rate', type=float, default=1.0,
+                        help='Messages per second each user may send '
+                             '(0 for no limit).')
+    parser.add_argument('--compose-burst', type=int, default=10,
+                        help='Messages each user may send in a burst.')
+
+    # Sharding (see the sharding module)
+    parser.add_argument('--node', type=str, action='append', default=[],
+                        metavar='NAME=URL',
+                        help='A node of a sharded deployment and its base '
+                             'URL. Give every node, including this one.')
+    parser.add_argument('--node-name', type=str,
+                        help='The name of this node.')
+    parser.add_argument('--shard-secret', type=str,
+                        help='The secret shared by every node.')
+
+    # Memory accounting (see the memory module)
+    parser.add_argument('--memory-budget', type=float, default=0.0,
+                        help='Shrink caches when caches and indexes hold '
+                             'more than this many MiB (0 for no budget).')
+    parser.add_argument('--memory-interval', type=float, default=60.0,
+                        help='Seconds between memory checks and '
+                             'snapshots.')
+    parser.add_argument('--trace-memory', type=int, default=0,
+                        metavar='FRAMES',
+                        help='Trace allocations with tracemalloc, keeping '
+                             'this many frames of each (0 to disable).')
+
+    # Access log (see the accesslog module)
+    parser.add_argument('--access-log', type=str, metavar='PATH',
+                        help='Write a JSON line per request to this file '
+                             '({pid} is replaced by the process ID), '
+                             'instead of a line per request to stderr.')
+    parser.add_argument('--access-log-max-bytes', type=float, default=64.0,
+                        help='Rotate the access log once it is this many '
+                             'MiB.')
+    parser.add_argument('--access-log-backups', type=int, default=5,
+                        help='How many rotated access logs to keep.')
+    parser.add_argument('--access-log-interval', type=float, default=1.0,
+                        help='Most seconds an access log record waits to '
+                             'be written.')
+
+    # Administrators may use /admin/ routes and the X-Profile header
+    parser.add_argument('--admin', type=str, action='append', default=[],
+                        help='A username with administrator access. '
+                             'May be given more than once.')
+
+    # Profiling options (see the profiling module)
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile every request.')
+    parser.add_argument('--profile-rate', type=float, default=0.0,
+                        help='Fraction of requests to profile at random.')
+    parser.add_argument('--profile-dir', type=str, default="profiles",
+                        help='The directory to write profiles to.')
+
     # Parse CLI args
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    message.STORAGE_FORMAT = args.storage_format
+    message.CHANGE_LOG = args.change_log
+    message.LOAD_WORKERS = args.load_workers
+    message.LOAD_IN_PROCESSES = args.load_in_processes
+    message.COMPRESS_THRESHOLD = args.compress_threshold
+    message.CACHE_BYTES = int(args.message_cache * 1024 * 1024)
+    streaming.MAX_BODY_SIZE = args.max_body_size
+    if args.backup_rate is not None:
+        import backup  # Otherwise not imported until the first backup
+        backup.RATE = int(args.backup_rate * 1024 * 1024)
+    limits = {}
+    for limit in args.limit:
+        name, _, value = limit.partition("=")
+        try:
+            limits[name] = int(value)
+        except ValueError:
+            parser.error("--limit must look like CLASS=N")
+    try:
+        admission.configure(limits=limits, max_queue=args.max_queue,
+                            queue_timeout=args.queue_timeout,
+                            compose_rate=args.compose_rate,
+                            compose_burst=args.compose_burst)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.node and not args.node_name:
+        parser.error("--node needs --node-name")
+    if args.node or args.node_name or args.shard_secret:
+        import sharding  # Otherwise not imported until it is needed
+        try:
+            sharding.configure(nodes=sharding.parse_nodes(args.node) or None,
+                               name=args.node_name,
+                               secret=args.shard_secret)
+        except ValueError as e:
+            parser.error(str(e))
+    authentication.ADMIN_USERS.update(a.lower() for a in args.admin)
+    profiling.configure(directory=args.profile_dir, always=args.profile,
+                        sample_rate=args.profile_rate)
+    try:
+        accesslog.configure(
+            path=args.access_log or "",
+            max_bytes=int(args.access_log_max_bytes * 1024 * 1024),
+            backups=args.access_log_backups,
+            flush_interval=args.access_log_interval)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.retention_policy:
+        retention.load_policy(args.retention_policy)
+    retention.configure(max_age_days=args.retention_max_age,
+                        max_count=args.retention_max_count,
+                        interval=args.retention_interval,
+                        rate=args.retention_rate,
+                        dry_run=args.retention_dry_run)
 
     # Make sure it's in the range we want
     if args.port < 8000 or args.port >= 9000:
         print("Please use a port in the range [8000, 9000).", file=sys.stderr)
         sys.exit(1)
 
+    fmt = "Looks like port {} is taken! Choose a different one."
+    reloader = not args.production
+    if reloader:
+        try:
+            # Attempt to bind to the port, just to make sure that it's
+            # free. Only needed with the reloader, since the port is
+            # bound by a child process that we cannot report errors from.
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.bind((args.host, args.port))
+            s.close()
+        except OSError:
+            # If it's NOT free, then it's time to bail. The user needs to
+            # specify a different port number to bind to.
+            print(fmt.format(args.port), file=sys.stderr)
+            sys.exit(1)
+
+    # Only the process that serves requests (not the reloader's
+    # watcher process) has an index worth saving, or should run
+    # background work
+    serving = not reloader or os.environ.get('BOTTLE_CHILD')
+
+    if serving:
+        # Without a change log, we would miss other processes' changes
+        # (see message.CHANGE_LOG), so make sure there are none
+        try:
+            message.claim_directory()
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+
+    if args.index_snapshot:
+        message.INDEX_SNAPSHOT = args.index_snapshot
+        if serving:
+            atexit.register(message.save_index_snapshot)
+            # Deploys stop us with SIGTERM; exit normally so that
+            # atexit handlers run
+            signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    if serving and accesslog.is_enabled():
+        access_log_writer = accesslog.AccessLogWriter()
+        access_log_writer.start()
+        # Registered before the other workers, so it runs after them
+        # and writes the last requests' records
+        atexit.register(access_log_writer.stop)
+
+    memory.configure(budget=int(args.memory_budget * 1024 * 1024),
+                     interval=args.memory_interval)
+    if serving and (args.memory_budget or args.trace_memory):
+        if args.trace_memory:
+            memory.start_tracing(args.trace_memory)
+        memory_worker = memory.MemoryWorker()
+        memory_worker.start()
+        atexit.register(memory_worker.stop)
+
+    if serving and retention.is_enabled():
+        worker = retention.ExpiryWorker()
+        worker.start()
+        # Registered after the snapshot, so it runs before it
+        atexit.register(worker.stop)
+
     try:
-        # Attempt to bind to the port, just to make sure that it's free
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.bind((args.host, args.port))
-        s.close()
+        # Run the app!
+        run(
+            app=message_app,                 # Use the bottle application
+                                             # we made
+
+            host=args.host, port=args.port,  # Bind to the provided
+                                             # host/port
+
+            debug=not args.production,       # Use debug mode (shows
+                                             # helpful error pages
+                                             # whenever there's a problem
+                                             # with the code)
+
+            reloader=reloader,               # Reload the web app whenever
+                                             # a module changes
+
+            quiet=accesslog.is_enabled()     # The access log replaces
+                                             # the line per request on
+                                             # stderr
+        )
     except OSError:
-        # If it's NOT free, then it's time to bail. The user needs to
-        # specify a different port number to bind to.
-        fmt = "Looks like port {} is taken! Choose a different one."
         print(fmt.format(args.port), file=sys.stderr)
         sys.exit(1)
 
-    # Run the app!
-    run(
-        app=message_app,                 # Use the bottle application
-                                         # we made
-
-        host=args.host, port=args.port,  # Bind to the provided
-                                         # host/port
 
-        debug=True,                      # Use debug mode (shows
-                                         # helpful error pages
-                                         # whenever there's a problem
-                                         # with the code)
-
-        reloader=True                    # Reload the web app whenever
-                                         # a module changes
-    )
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,490 @@
+"""Sharding module
+
+Contains helper functions for spreading mailboxes over several
+RocketTalk nodes, for when one host cannot hold every message:
+
+* **Ownership** - Each user belongs to one node, chosen by consistent
+  hashing of their username (see :class:`HashRing`). Adding a node
+  only moves about one user in every ``n`` (the new node's share).
+* **Routing** - A small front end, :class:`Router`, forwards each
+  request to the node owning the logged in user (or, for a login, the
+  user logging in). Nodes never need to know about it.
+* **Delivery** - A message is saved on its sender's node. If its
+  recipient belongs to another node, :func:`send_message` delivers a
+  copy there too, so each node holds every message its users sent or
+  received. Nodes talk to each other through ``/internal/`` endpoints,
+  which require a shared secret (see :func:`requires_secret`).
+* **Rebalancing** - Once nodes are added (and every node, and the
+  router, is restarted with the new list), :func:`rebalance` makes
+  each node hand over the messages of the users it no longer owns.
+
+Example, with two nodes on one machine::
+
+    $ python server.py --production --port 8001 --node-name a \\
+        --node a=http://127.0.0.1:8001 --node b=http://127.0.0.1:8002 \\
+        --shard-secret s3cret
+    $ python server.py --production --port 8002 --node-name b ...
+    $ python sharding.py route --port 8000 \\
+        --node a=http://127.0.0.1:8001 --node b=http://127.0.0.1:8002
+    $ python sharding.py rebalance --shard-secret s3cret \\
+        --node a=http://127.0.0.1:8001 --node b=http://127.0.0.1:8002
+
+"""
+import hashlib
+import hmac
+import http.client
+import io
+import json
+import os
+
+from bisect import bisect
+from functools import wraps
+from urllib.parse import parse_qs, quote, urlsplit
+from http.cookies import SimpleCookie
+
+from bottle import abort, request
+
+import message
+import metrics
+
+
+REPLICAS = 64
+"""How many points on the hash ring each node gets. More points spread
+users more evenly, at the cost of a larger ring."""
+
+SECRET_HEADER = "X-Shard-Secret"
+"""The request header carrying the shared secret between nodes"""
+
+MAX_LOGIN_FORM = 64 * 1024
+"""The largest login form the router reads to find out who is logging
+in"""
+
+CHUNK_SIZE = 64 * 1024
+"""How many bytes the router copies at a time"""
+
+# Connection-level headers, which are not passed through the router
+_HOP_BY_HOP = {"connection", "keep-alive", "proxy-authenticate",
+               "proxy-authorization", "te", "trailers",
+               "transfer-encoding", "upgrade"}
+
+_settings = {
+    "nodes": {},      # node name -> base URL
+    "name": None,     # The name of this node, if it is one
+    "secret": None,   # Shared by every node
+    "timeout": 10.0,  # Seconds to wait on another node
+}
+_ring = None
+
+
+class DeliveryError(Exception):
+    """Raised when another node cannot be reached, or turns a request
+    down."""
+
+
+class HashRing:
+    """A consistent hash ring, mapping keys (usernames) to nodes.
+
+    Each node is hashed to :data:`REPLICAS` points on a ring, and a key
+    belongs to the node of the first point at or after the key's own
+    hash. Adding a node only takes over the keys just before its own
+    points, so every other key stays where it was.
+
+    :param nodes: An iterable of node names
+
+    """
+    def __init__(self, nodes, replicas=REPLICAS):
+        points = sorted((_hash("{}#{}".format(node, i)), node)
+                        for node in nodes for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        """Returns the node ``key`` belongs to, or ``None`` if there
+        are no nodes."""
+        if not self._nodes:
+            return None
+        position = bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[position]
+
+
+def _hash(text):
+    return int.from_bytes(hashlib.md5(text.encode("utf-8")).digest()[:8],
+                          "big")
+
+
+def configure(nodes=None, name=None, secret=None, timeout=None):
+    """Updates the sharding settings.
+
+    Arguments left as ``None`` are not changed.
+
+    :param dict nodes: Maps every node's name to its base URL (e.g.,
+        ``"http://10.0.0.2:8001"``). Every node, and the router, must
+        be given the same nodes.
+    :param str name: The name of this node, if it is one
+    :param str secret: The secret nodes use to talk to each other
+    :param float timeout: How many seconds to wait on another node
+
+    """
+    global _ring
+    if nodes is not None:
+        _settings["nodes"] = dict(nodes)
+        _ring = HashRing(nodes)
+    if name is not None:
+        _settings["name"] = name
+    if secret is not None:
+        _settings["secret"] = secret
+    if timeout is not None:
+        _settings["timeout"] = timeout
+    if _settings["name"] and _settings["nodes"]:
+        if _settings["name"] not in _settings["nodes"]:
+            raise ValueError("Unknown node {!r}".format(_settings["name"]))
+        if not _settings["secret"]:
+            raise ValueError("Nodes need a shared secret")
+
+
+def is_enabled():
+    """Checks whether any nodes are configured."""
+    return bool(_settings["nodes"])
+
+
+def owner(username):
+    """Returns the name of the node a user belongs to, or ``None`` if
+    sharding is off."""
+    if _ring is None:
+        return None
+    return _ring.node_for(username)
+
+
+def send_message(message_dict):
+    """Saves a message on this node with :func:`message.send_message`,
+    and delivers a copy to its recipient's node if that is another
+    node.
+
+    :param dict message_dict: The message (see
+        :func:`message.send_message`)
+
+    :raises DeliveryError: If the copy could not be delivered. The
+        message is then not kept here either, so that the sender can
+        simply send it again.
+
+    :returns: The ID of the new message
+
+    """
+    message_id = message.send_message(message_dict)
+    node = owner(message_dict["to"])
+    if node is not None and node != _settings["name"]:
+        try:
+            deliver(node, message_id)
+        except DeliveryError:
+            message.remove_message(message_id)
+            raise
+    return message_id
+
+
+def deliver(node, message_id, read=False):
+    """Copies a message's file to another node (see
+    :func:`message.restore_message_file`). Delivering a message the
+    node already has does nothing.
+
+    :param str node: The name of the node
+    :param str message_id: The ID of the message
+    :param bool read: Whether to mark the message as read there
+
+    :raises DeliveryError: If the node could not be reached, or did not
+        accept the message
+
+    :returns: True if the node did not have the message yet
+
+    """
+    filename = message.message_file(message_id)
+    path = "/internal/deliver/{}".format(os.path.basename(filename))
+    if read:
+        path += "?read=1"
+    with open(filename, "rb") as msg_file:
+        result = _post(node, path, msg_file, "application/octet-stream",
+                       os.fstat(msg_file.fileno()).st_size)
+    metrics.inc("rockettalk_shard_deliveries_total", node=node)
+    return result["saved"]
+
+
+def find_missing(node, message_ids):
+    """Asks another node which of some messages it does not have.
+
+    :raises DeliveryError: If the node could not be reached
+
+    :returns: A list of IDs
+
+    """
+    body = json.dumps({"ids": list(message_ids)}).encode("utf-8")
+    return _post(node, "/internal/missing/", io.BytesIO(body),
+                 "application/json", len(body))["missing"]
+
+
+def _post(node, path, body, content_type, length):
+    """Sends a POST request to another node, and decodes its JSON
+    response."""
+    import urllib.request  # Only nodes that deliver messages need it
+
+    req = urllib.request.Request(
+        _settings["nodes"][node].rstrip("/") + path, data=body,
+        method="POST", headers={SECRET_HEADER: _settings["secret"] or "",
+                                "Content-Type": content_type,
+                                "Content-Length": str(length)})
+    try:
+        with urllib.request.urlopen(
+                req, timeout=_settings["timeout"]) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except (OSError, ValueError) as e:  # Including HTTP errors
+        metrics.inc("rockettalk_shard_errors_total", node=node)
+        raise DeliveryError("Could not reach node {}: {}".format(node, e))
+
+
+def rebalance(batch_size=100):
+    """Hands the messages this node no longer needs over to the nodes
+    that do, after nodes were added.
+
+    Every message is needed on the nodes of its sender and its
+    recipient. Each of those nodes (other than this one) is asked
+    which messages it is missing, a batch at a time, and is delivered
+    just those (read markers included). Messages whose sender and
+    recipient both belong to other nodes are then removed here, unless
+    delivering them failed; running this again retries them.
+
+    :param int batch_size: How many messages to ask about at once
+
+    :returns: A report dict with the keys ``checked`` (how many
+        messages this node had), ``delivered``, ``removed`` and
+        ``failed``
+
+    """
+    name = _settings["name"]
+    wanted = {}  # node -> [message id, ...]
+    leaving = []
+    recipients = {}
+    headers = message.list_message_headers()
+    for message_id, _, to, sender in headers:
+        owners = {owner(to), owner(sender)}
+        for node in owners - {name}:
+            wanted.setdefault(node, []).append(message_id)
+        if name not in owners:
+            leaving.append(message_id)
+        recipients[message_id] = owner(to)
+
+    report = {"checked": len(headers), "delivered": 0, "removed": 0,
+              "failed": 0}
+    failed = set()
+    for node, message_ids in sorted(wanted.items()):
+        for start in range(0, len(message_ids), batch_size):
+            batch = message_ids[start:start + batch_size]
+            try:
+                missing = find_missing(node, batch)
+            except DeliveryError:
+                failed.update(batch)
+                continue
+            for message_id in missing:
+                read = (recipients[message_id] == node and
+                        message.is_read(message_id))
+                try:
+                    if deliver(node, message_id, read):
+                        report["delivered"] += 1
+                except (DeliveryError, FileNotFoundError):
+                    failed.add(message_id)
+    report["removed"] = len(message.remove_messages(
+        i for i in leaving if i not in failed))
+    report["failed"] = len(failed)
+    return report
+
+
+def requires_secret(func):
+    """Updates a handler, so that only other nodes may use it: requests
+    without the shared secret (see :data:`SECRET_HEADER`) get ``403
+    Forbidden``, and every request gets ``404 Not Found`` if this is
+    not a node."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        secret = _settings["secret"]
+        if not (_settings["name"] and secret):
+            abort(404)
+        given = request.get_header(SECRET_HEADER) or ""
+        if not hmac.compare_digest(given.encode("utf-8"),
+                                   secret.encode("utf-8")):
+            abort(403, "Bad shard secret")
+        return func(*args, **kwargs)
+    return wrapper
+
+
+class Router:
+    """A WSGI application that forwards every request to the node
+    owning the user it is for (see the module documentation).
+
+    The user is the one in the ``logged_in_as`` cookie, or for a login
+    form, the one logging in. Requests from nobody in particular (the
+    login page, assets) go to the node owning the empty username, so
+    they always go to the same node. ``/internal/`` requests are
+    turned away, since only nodes should send them, to each other.
+
+    Requests and responses are streamed through, :data:`CHUNK_SIZE`
+    bytes at a time, with the original ``Host`` header, so redirects
+    still point at the router.
+
+    """
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "/")
+        if path.startswith("/internal/"):
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return [b"Not found"]
+        body = environ["wsgi.input"]
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        username = _cookie_username(environ)
+        if (not username and path == "/login/" and
+                environ.get("REQUEST_METHOD") == "POST" and
+                length <= MAX_LOGIN_FORM):
+            data = body.read(length)
+            body = io.BytesIO(data)
+            form = parse_qs(data.decode("utf-8", "replace"))
+            username = form.get("username", [""])[0].lower()
+        node = owner(username or "")
+        try:
+            response = self._forward(node, environ, body, length)
+        except OSError:
+            metrics.inc("rockettalk_router_requests_total", node=node,
+                        outcome="error")
+            start_response("502 Bad Gateway", [("Content-Type",
+                                                "text/plain")])
+            return [b"The server for this account is unavailable."]
+        metrics.inc("rockettalk_router_requests_total", node=node,
+                    outcome="ok")
+        start_response("{} {}".format(response.status, response.reason),
+                       [(k, v) for k, v in response.getheaders()
+                        if k.lower() not in _HOP_BY_HOP])
+        return _ResponseBody(response)
+
+    def _forward(self, node, environ, body, length):
+        url = urlsplit(_settings["nodes"][node])
+        connection = http.client.HTTPConnection(
+            url.hostname, url.port, timeout=_settings["timeout"])
+        target = url.path.rstrip("/") + quote(
+            environ.get("SCRIPT_NAME", "") + environ.get("PATH_INFO", "/"))
+        if environ.get("QUERY_STRING"):
+            target += "?" + environ["QUERY_STRING"]
+        try:
+            connection.putrequest(environ.get("REQUEST_METHOD", "GET"),
+                                  target, skip_host=True,
+                                  skip_accept_encoding=True)
+            for key, value in environ.items():
+                if key.startswith("HTTP_"):
+                    header = key[5:].replace("_", "-").title()
+                    if header.lower() not in _HOP_BY_HOP:
+                        connection.putheader(header, value)
+            if environ.get("CONTENT_TYPE"):
+                connection.putheader("Content-Type", environ["CONTENT_TYPE"])
+            connection.putheader("Content-Length", str(length))
+            connection.putheader("X-Forwarded-For",
+                                 environ.get("REMOTE_ADDR", ""))
+            connection.endheaders()
+            while length > 0:
+                chunk = body.read(min(length, CHUNK_SIZE))
+                if not chunk:
+                    break
+                connection.send(chunk)
+                length -= len(chunk)
+            return connection.getresponse()
+        except BaseException:
+            connection.close()
+            raise
+
+
+class _ResponseBody:
+    """Iterates over a forwarded response's body, and closes its
+    connection once the server closes the iterable."""
+    def __init__(self, response):
+        self.response = response
+
+    def __iter__(self):
+        while True:
+            chunk = self.response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        self.response.close()
+
+
+def _cookie_username(environ):
+    cookie = SimpleCookie(environ.get("HTTP_COOKIE", ""))
+    morsel = cookie.get("logged_in_as")
+    return morsel.value.lower() if morsel is not None else ""
+
+
+def parse_nodes(specs):
+    """Parses ``NAME=URL`` command line arguments.
+
+    :raises ValueError: If one is malformed
+
+    :returns: A dict mapping names to URLs
+
+    """
+    nodes = {}
+    for spec in specs:
+        name, _, url = spec.partition("=")
+        if not name or not url.startswith("http://"):
+            raise ValueError("--node must look like NAME=http://HOST:PORT")
+        nodes[name] = url
+    return nodes
+
+
+metrics.describe("rockettalk_shard_deliveries_total", "counter",
+                 "Message files delivered to other nodes, by node.")
+metrics.describe("rockettalk_shard_errors_total", "counter",
+                 "Requests to other nodes that failed, by node.")
+metrics.describe("rockettalk_router_requests_total", "counter",
+                 "Requests forwarded by the router, by node and outcome "
+                 "(ok or error).")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from bottle import run
+
+    parser = argparse.ArgumentParser(
+        description='Route requests to, or rebalance, sharded RocketTalk '
+                    'nodes'
+    )
+    parser.add_argument('command', choices=('route', 'rebalance'),
+                        help='Run the router, or rebalance every node.')
+    parser.add_argument('--node', type=str, action='append', default=[],
+                        metavar='NAME=URL', required=True,
+                        help='A node and its base URL. Give every node.')
+    parser.add_argument('--host', type=str, default="0.0.0.0",
+                        help='The hostname for the router to listen on.')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='The port for the router to listen on.')
+    parser.add_argument('--server', type=str, default="wsgiref",
+                        help='The bottle server adapter to route with '
+                             '(e.g., a threaded one such as "paste").')
+    parser.add_argument('--shard-secret', type=str,
+                        help='The secret shared by the nodes (for '
+                             'rebalance).')
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='Seconds to wait on a node.')
+    args = parser.parse_args()
+
+    try:
+        nodes = parse_nodes(args.node)
+    except ValueError as e:
+        parser.error(str(e))
+    configure(nodes=nodes, secret=args.shard_secret, timeout=args.timeout)
+    if args.command == 'route':
+        run(app=Router(), host=args.host, port=args.port,
+            server=args.server)
+    else:
+        if not args.shard_secret:
+            parser.error("rebalance needs --shard-secret")
+        # Rebalancing can take a while on a large node
+        configure(timeout=max(args.timeout, 3600.0))
+        for name in sorted(nodes):
+            print(name, json.dumps(_post(name, "/internal/rebalance/",
+                                         io.BytesIO(b""), "application/json",
+                                         0)))
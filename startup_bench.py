@@ -0,0 +1,117 @@
+"""Startup benchmark module
+
+Measures how long it takes to start RocketTalk, so that cold-start
+time can be tracked over time:
+
+* **import** - Importing :mod:`server` in a fresh interpreter
+* **first_request** - Importing :mod:`server` and serving the first
+  request (``GET /login/``), including the first message index scan
+  when a mailbox is listed
+* **slowest_imports** - The modules that took the longest to import,
+  according to ``python -X importtime``
+
+Each run appends one JSON line to a history file (by default
+``startup_history.jsonl``), tagged with the git revision.
+
+Example::
+
+    $ python startup_bench.py --runs 10 --messages 10000
+
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from bench_message import generate_corpus, git_revision, summarize_latencies
+from loadtest import prepare_workdir
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+FIRST_REQUEST = """
+import sys
+sys.path.insert(0, {here!r})
+from webtest import TestApp
+import server
+app = TestApp(server.message_app)
+app.get('/login/')
+app.post('/login/', {{'username': 'jessie', 'password': 'frog'}})
+app.get('/')
+"""
+
+
+def time_command(code, cwd, runs):
+    """Runs ``python -c code`` ``runs`` times and summarizes the wall
+    time of each run (see :func:`bench_message.summarize_latencies`)."""
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, "-c", code], cwd=cwd)
+        latencies.append(time.perf_counter() - start)
+    return summarize_latencies(latencies)
+
+
+def slowest_imports(cwd, count=15):
+    """Returns the ``count`` modules with the largest cumulative import
+    time when importing :mod:`server`, as ``[module, microseconds]``
+    pairs."""
+    code = "import sys; sys.path.insert(0, {!r}); import server".format(HERE)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            cwd=cwd, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        # Lines look like "import time:   self [us] | cumulative | name"
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        times.append([parts[2].strip(), int(parts[1])])
+    times.sort(key=lambda t: t[1], reverse=True)
+    return times[:count]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark RocketTalk startup time'
+    )
+    parser.add_argument('--runs', type=int, default=5,
+                        help='How many times to start the app.')
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='Messages to generate for the first request.')
+    parser.add_argument('--history', type=str,
+                        default=os.path.join(HERE, "startup_history.jsonl"),
+                        help='The file to append results to.')
+    args = parser.parse_args()
+
+    workdir = prepare_workdir()
+    original = os.getcwd()
+    try:
+        os.chdir(workdir)
+        generate_corpus(args.messages, users=4)
+        import_code = "import sys; sys.path.insert(0, {!r}); " \
+                      "import server".format(HERE)
+        report = {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "messages": args.messages,
+            "import": time_command(import_code, workdir, args.runs),
+            "first_request": time_command(FIRST_REQUEST.format(here=HERE),
+                                          workdir, args.runs),
+            "slowest_imports": slowest_imports(workdir),
+        }
+    finally:
+        os.chdir(original)
+        shutil.rmtree(workdir)
+
+    with open(args.history, "a") as history:
+        history.write(json.dumps(report, sort_keys=True) + "\n")
+
+    print("import:        p50 {:.1f} ms".format(report["import"]["p50"] * 1e3))
+    print("first request: p50 {:.1f} ms".format(
+        report["first_request"]["p50"] * 1e3))
+    for name, micros in report["slowest_imports"]:
+        print("  {:>8.1f} ms  {}".format(micros / 1e3, name))
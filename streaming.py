@@ -0,0 +1,233 @@
+"""Streaming module
+
+Contains helper functions for reading large form submissions in
+chunks, so that a worker never holds a whole message body in memory.
+
+Bottle reads an ``application/x-www-form-urlencoded`` request body
+into a single string before parsing it, and refuses bodies larger
+than ``bottle.BaseRequest.MEMFILE_MAX`` (100 KiB).
+:func:`read_message_form` instead decodes the body as it arrives, and
+spools a large message body to a temporary file. From there,
+:func:`message.send_message` copies it into storage in chunks.
+
+"""
+import codecs
+import tempfile
+
+from urllib.parse import unquote_to_bytes
+
+from bottle import BaseRequest, HTTPError
+
+
+MAX_BODY_SIZE = 10 * 1024 * 1024
+"""The largest message body (in UTF-8 encoded bytes) that may be sent"""
+
+SPOOL_THRESHOLD = 64 * 1024
+"""Message bodies at least this large are spooled to a temporary file
+instead of being kept in memory"""
+
+CHUNK_SIZE = 64 * 1024
+"""How many bytes of a request body to read at a time"""
+
+SPOOLED_FIELDS = ("body",)
+"""The form fields that may be large. Every other field is limited to
+``bottle.BaseRequest.MEMFILE_MAX`` bytes."""
+
+
+class BodyTooLarge(ValueError):
+    """Raised when a submitted form is larger than allowed."""
+
+
+def read_message_form(request):
+    """Reads a submitted message form, without holding a large body in
+    memory.
+
+    * The ``Content-Length`` header is checked first, so a request that
+      could not possibly fit is refused before any of it is read.
+    * The body is then decoded :data:`CHUNK_SIZE` bytes at a time. Once
+      the message body grows past :data:`MAX_BODY_SIZE`, reading stops.
+    * A body of at least :data:`SPOOL_THRESHOLD` bytes is returned as a
+      temporary file (holding UTF-8 text) rather than a :class:`str`.
+      Close it once done with it.
+
+    Multipart forms are left to bottle, which spools their parts
+    itself.
+
+    :param bottle.BaseRequest request: The request to read
+
+    :raises BodyTooLarge: If the form is larger than allowed
+
+    :returns: A dict-like object mapping each field to its value
+
+    """
+    content_type = request.content_type.split(";")[0].strip().lower()
+    if content_type.startswith("multipart/"):
+        form = request.forms
+        body = form.get("body", "")
+        if isinstance(body, str) and len(body.encode()) > MAX_BODY_SIZE:
+            raise BodyTooLarge(_too_large())
+        return form
+
+    length = request.content_length
+    # Every byte of a URL-encoded body may take three bytes (%XX)
+    if length > 3 * MAX_BODY_SIZE + BaseRequest.MEMFILE_MAX:
+        raise BodyTooLarge(_too_large())
+    if length < 0:  # Chunked transfer encoding; bottle undoes it
+        return read_form(request.body)
+    return read_form(request.environ["wsgi.input"], length)
+
+
+def read_form(stream, length=None):
+    """Decodes a URL-encoded form from a binary stream, a chunk at a
+    time.
+
+    :param stream: A binary file object to read the form from
+    :param int length: How many bytes to read, or ``None`` to read
+        until the end of the stream
+
+    :raises BodyTooLarge: If a field is larger than allowed
+    :raises bottle.HTTPError: If the stream ends before ``length``
+        bytes were read
+
+    :returns: A dict mapping each field name to its (last) value. See
+        :func:`read_message_form`.
+
+    """
+    parser = _FormParser()
+    try:
+        while length is None or length > 0:
+            size = CHUNK_SIZE if length is None else min(CHUNK_SIZE, length)
+            chunk = stream.read(size)
+            if not chunk:
+                if length is not None:
+                    raise HTTPError(400, "Request body is truncated.")
+                break
+            if length is not None:
+                length -= len(chunk)
+            parser.feed(chunk)
+        return parser.close()
+    except Exception:
+        parser.discard()
+        raise
+
+
+def _too_large():
+    return "Message body is too large (the limit is {} bytes).".format(
+        MAX_BODY_SIZE)
+
+
+class _FormParser:
+    """Splits a URL-encoded form into fields as chunks of it arrive."""
+    def __init__(self):
+        self.fields = {}
+        self.raw_name = bytearray()
+        self.value = None  # A _FieldValue once the name has been read
+
+    def feed(self, chunk):
+        pos = 0
+        while pos < len(chunk):
+            if self.value is None:
+                ends = [i for i in (chunk.find(b"=", pos),
+                                    chunk.find(b"&", pos)) if i >= 0]
+                end = min(ends) if ends else len(chunk)
+                self.raw_name += chunk[pos:end]
+                if len(self.raw_name) > BaseRequest.MEMFILE_MAX:
+                    raise BodyTooLarge("Form field name is too long.")
+                if end == len(chunk):
+                    return
+                self.value = _FieldValue(_unquote(self.raw_name).decode(
+                    "utf-8", "replace"))
+                if chunk[end] == ord("&"):
+                    self._finish()
+                pos = end + 1
+            else:
+                end = chunk.find(b"&", pos)
+                if end < 0:
+                    self.value.feed(chunk[pos:])
+                    return
+                self.value.feed(chunk[pos:end])
+                self._finish()
+                pos = end + 1
+
+    def _finish(self):
+        name, value = self.value.name, self.value.close()
+        self.raw_name = bytearray()
+        self.value = None
+        if not name and not value:
+            return  # Empty pair, e.g. from "a=1&&b=2"
+        old = self.fields.get(name)
+        if hasattr(old, "close"):
+            old.close()
+        self.fields[name] = value
+
+    def close(self):
+        if self.value is None and self.raw_name:
+            self.value = _FieldValue(_unquote(self.raw_name).decode(
+                "utf-8", "replace"))
+        if self.value is not None:
+            self._finish()
+        return self.fields
+
+    def discard(self):
+        for value in self.fields.values():
+            if hasattr(value, "close"):
+                value.close()
+        if self.value is not None and self.value.file is not None:
+            self.value.file.close()
+
+
+class _FieldValue:
+    """The value of one form field, decoded as it arrives."""
+    def __init__(self, name):
+        self.name = name
+        self.spool = name in SPOOLED_FIELDS
+        self.limit = MAX_BODY_SIZE if self.spool else BaseRequest.MEMFILE_MAX
+        self.size = 0
+        self.pending = b""  # The start of a %XX escape cut off by a chunk
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.pieces = []
+        self.file = None
+
+    def feed(self, data):
+        data = self.pending + data
+        cut = data.rfind(b"%", max(0, len(data) - 2))
+        if cut >= 0:
+            data, self.pending = data[:cut], data[cut:]
+        else:
+            self.pending = b""
+        self._write(_unquote(data))
+
+    def _write(self, raw):
+        self.size += len(raw)
+        if self.size > self.limit:
+            if self.file is not None:
+                self.file.close()
+            if self.spool:
+                raise BodyTooLarge(_too_large())
+            raise BodyTooLarge("The {} field is too large.".format(self.name))
+        text = self.decoder.decode(raw)
+        if self.file is None and self.spool and self.size >= SPOOL_THRESHOLD:
+            self.file = tempfile.TemporaryFile()
+            for piece in self.pieces:
+                self.file.write(piece.encode("utf-8"))
+            self.pieces = []
+        if self.file is not None:
+            self.file.write(text.encode("utf-8"))
+        else:
+            self.pieces.append(text)
+
+    def close(self):
+        self._write(_unquote(self.pending))
+        self.pending = b""
+        text = self.decoder.decode(b"", True)
+        if self.file is not None:
+            self.file.write(text.encode("utf-8"))
+            self.file.seek(0)
+            return self.file
+        self.pieces.append(text)
+        return "".join(self.pieces)
+
+
+def _unquote(data):
+    """Decodes one piece of a URL-encoded field name or value."""
+    return unquote_to_bytes(bytes(data).replace(b"+", b" "))
@@ -0,0 +1,82 @@
+# Python standard library imports
+import json
+import os
+
+# Other libraries
+from webtest import TestApp as HelperApp  # To avoid confusing PyTest
+
+# Our code
+import accesslog
+import server
+
+
+def setup_function(function):
+    accesslog.configure(path="access-{pid}.log", max_bytes=64 * 1024 * 1024,
+                        backups=5, max_buffer=100000)
+    accesslog._buffer.clear()
+
+
+def teardown_function(function):
+    accesslog.configure(path="")
+    accesslog._buffer.clear()
+
+
+def read_log(path):
+    with open(path) as log:
+        return [json.loads(line) for line in log]
+
+
+def test_access_log():
+    """Make sure every request is written as a JSON line, with its
+    route, status, user and storage timings, and only by the writer"""
+    path = "access-{}.log".format(os.getpid())
+    app = HelperApp(server.message_app)
+    app.get('/login/')
+    app.post('/login/', {'username': 'jessie', 'password': 'frog'})
+    app.post('/compose/', {'to': 'james', 'subject': 's', 'body': 'b'})
+    app.get('/')
+    app.get('/nowhere/', status=404)
+    assert len(accesslog._buffer) == 5 and not os.path.exists(path)
+
+    writer = accesslog.AccessLogWriter()
+    assert writer.flush() == 5 and not accesslog._buffer
+    records = read_log(path)
+    assert [(r['method'], r['route'], r['status']) for r in records] == [
+        ('GET', '/login/', 200), ('POST', '/login/', 302),
+        ('POST', '/compose/', 302), ('GET', '/', 200),
+        ('GET', None, 404)]
+    assert [r['user'] for r in records] == [None, None, 'jessie', 'jessie',
+                                            'jessie']
+    home = records[3]
+    assert home['path'] == '/' and home['bytes'] > 0 and home['ms'] > 0
+    calls, ms = home['storage']['load_received_messages']
+    assert calls == 1 and 0 < ms <= home['storage_ms'] <= home['ms']
+    assert 'send_message' in records[2]['storage']
+    assert records[0]['storage'] == {} and records[0]['storage_ms'] == 0
+    writer.stop()
+
+
+def test_rotation_and_drops():
+    """Make sure the log is rotated once it is too big, only the newest
+    backups are kept, and records are dropped once the buffer is full"""
+    path = "access-{}.log".format(os.getpid())
+    accesslog.configure(max_bytes=1000, backups=2, max_buffer=3)
+    app = HelperApp(server.message_app)
+    writer = accesslog.AccessLogWriter()
+    for _ in range(4):
+        for _ in range(4):
+            app.get('/login/')
+        assert writer.flush() == 3  # The fourth was dropped
+    writer.stop()
+    assert not os.path.exists(path + '.3')
+    assert all(os.path.getsize(p) <= 1000
+               for p in (path, path + '.1', path + '.2'))
+    lines = sum(len(read_log(p)) for p in (path, path + '.1', path + '.2'))
+    assert 3 <= lines < 12
+
+
+def test_path_placeholders():
+    """Make sure only {pid} is replaced in the path"""
+    accesslog.configure(path="logs/{date}-{}-{pid}.log")
+    assert accesslog._settings["path"] == "logs/{{date}}-{{}}-{}.log".format(
+        os.getpid())
@@ -0,0 +1,70 @@
+# Python standard library imports
+import threading
+
+from webtest import TestApp as HelperApp  # To avoid confusing PyTest
+
+# Our code
+import admission
+import server
+
+
+DEFAULTS = {"limits": dict(admission._settings["limits"]), "max_queue": 32,
+            "queue_timeout": 0.5, "compose_rate": 0, "compose_burst": 10}
+
+
+def teardown_function(function):
+    admission.configure(**DEFAULTS)
+
+
+def test_route_classes():
+    """Make sure paths are sorted into the right route classes"""
+    assert admission.route_class('/') == 'list'
+    assert admission.route_class('/shred/') == 'shred'
+    assert admission.route_class('/assets/css/style.css') == 'assets'
+    assert admission.route_class('/view/x/') == 'other'
+
+
+def test_token_bucket():
+    """Make sure bursts are allowed, and then the rate is enforced"""
+    admission.configure(compose_rate=0.5, compose_burst=2)
+    assert admission.take_token('jessie', now=100.0) == 0
+    assert admission.take_token('jessie', now=100.0) == 0
+    assert admission.take_token('jessie', now=100.0) == 2.0
+    assert admission.take_token('james', now=100.0) == 0
+    assert admission.take_token('jessie', now=101.0) == 1.0
+    assert admission.take_token('jessie', now=102.0) == 0
+
+
+def test_concurrency_limit():
+    """Make sure a full route class turns requests away with a 503,
+    and frees its slot once the response is sent"""
+    admission.configure(limits={'other': 1}, max_queue=0)
+    started, finish = threading.Event(), threading.Event()
+
+    def slow_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        started.set()
+        finish.wait(5)
+        return [b'done']
+
+    app = HelperApp(admission.AdmissionMiddleware(slow_app))
+    thread = threading.Thread(target=app.get, args=('/view/x/',))
+    thread.start()
+    started.wait(5)
+    response = app.get('/view/y/', status=503)
+    assert response.headers['Retry-After'] == '1'
+    finish.set()
+    thread.join()
+    assert app.get('/view/y/').text == 'done'
+
+
+def test_compose_rate_limit():
+    """Make sure sending too fast gets a 429"""
+    admission.configure(compose_rate=0.01, compose_burst=1)
+    app = HelperApp(server.message_app)
+    app.post('/login/', {'username': 'jessie', 'password': 'frog'})
+    form = {'to': 'james', 'subject': 's', 'body': 'S'}
+    assert app.post('/compose/', form).status == "302 Found"
+    response = app.post('/compose/', form, status=429)
+    assert int(response.headers['Retry-After']) > 1
+    assert len(server.message.load_sent_messages('jessie')) == 1
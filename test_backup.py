@@ -0,0 +1,95 @@
+# Python standard library imports
+import io
+import os
+import shutil
+import tarfile
+
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+# Our code
+import backup
+import message
+
+
+def send(sender, receiver, body, minutes_ago=0):
+    """A helper function to save a message. Returns its ID."""
+    sent = datetime(2016, 3, 1, 12) - timedelta(minutes=minutes_ago)
+    msg = {'id': str(uuid4()), 'to': receiver, 'from': sender,
+           'subject': 's', 'body': body, 'time': sent}
+    return message.import_messages([msg])[0]
+
+
+def test_snapshot_is_consistent():
+    """Make sure a snapshot keeps messages deleted after it started,
+    and leaves out messages sent after it started"""
+    kept = send('jessie', 'james', 'kept')
+    deleted = send('james', 'jessie', 'deleted')
+
+    snapshot = message.begin_snapshot()
+    message.remove_message(deleted)
+    later = send('jessie', 'james', 'later')
+    snapshot.fill()
+    archive = io.BytesIO()
+    stats = backup.write_archive(snapshot, archive, rate=0)
+    snapshot.close()
+
+    assert stats['messages'] == 2
+    assert not os.listdir(os.path.join('messages', message.SNAPSHOT_DIR))
+    archive.seek(0)
+    with tarfile.open(fileobj=archive, mode='r:gz') as tar:
+        names = tar.getnames()
+    assert names[0] == backup.MANIFEST
+    assert sorted(names[1:]) == sorted(m + '.json' for m in (kept, deleted))
+    assert later + '.json' not in names
+
+
+def test_restore(monkeypatch):
+    """Make sure a backup restores every message, and the index is
+    rebuilt from the manifest without reading the files"""
+    message.STORAGE_FORMAT = 'binary'
+    try:
+        ids = [send('jessie', 'james', 'body {}'.format(i), 10 - i)
+               for i in range(5)]
+    finally:
+        message.STORAGE_FORMAT = 'json'
+    ids.append(send('james', 'jessie', 'x' * (message.COMPRESS_THRESHOLD)))
+    message.mark_read(ids[0])
+    message.mark_read(ids[5])
+    backup.create_backup('backup.tar.gz', rate=0)
+    originals = {m: dict(message.load_message(m)) for m in ids}
+
+    shutil.rmtree('messages')
+
+    def no_scan(directory):
+        raise AssertionError("messages/ was scanned")
+
+    monkeypatch.setattr(message, '_scan_messages', no_scan)
+    stats = backup.restore_backup('backup.tar.gz', rate=0)
+    assert stats['messages'] == 6 and stats['indexed']
+    assert stats['read'] == 2
+    assert message.is_read(ids[0]) and message.is_read(ids[5])
+    assert not message.is_read(ids[1])
+    assert message.mailbox_counts('james') == {'total': 5, 'unread': 4}
+    assert message.mailbox_counts('jessie') == {'total': 1, 'unread': 0}
+    assert [m['id'] for m in message.load_received_messages('james')] == \
+        list(reversed(ids[:5]))
+    for message_id, original in originals.items():
+        assert dict(message.load_message(message_id)) == original
+
+    # Restoring again skips what is already there
+    monkeypatch.undo()
+    stats = backup.restore_backup('backup.tar.gz', rate=0)
+    assert stats['messages'] == 0 and stats['existing'] == 6
+
+
+def test_throttle(monkeypatch):
+    """Make sure reads are slowed down to the rate"""
+    sleeps = []
+    monkeypatch.setattr(backup.time, 'sleep', sleeps.append)
+    throttle = backup._Throttle(1000)
+    reader = backup._ThrottledReader(io.BytesIO(b'x' * 500), throttle)
+    reader.read(250)
+    reader.read(250)
+    # 500 bytes at 1000 bytes a second should take half a second
+    assert 0.4 < sleeps[-1] <= 0.5
@@ -0,0 +1,26 @@
+# Our code
+import cache
+
+
+def test_evicts_least_recently_used():
+    """Make sure the cache stays under its byte limit by evicting the
+    least recently used entries, and drops stale versions"""
+    lru = cache.LRUCache("test", 10000, max_entry_bytes=5000)
+    for key in "abcd":
+        lru.put(key, 1, "x" * 2000)
+    assert lru.get("a", 1) == "x" * 2000  # Now b is least recently used
+    lru.put("e", 1, "x" * 2000)
+    assert lru.get("b", 1) is None
+    assert [lru.get(k, 1) is not None for k in "acde"] == [True] * 4
+    assert lru.size <= 10000
+
+    # Another version of a value is a miss, and drops the old one
+    assert lru.get("a", 2) is None
+    assert lru.stats()["entries"] == 3
+
+    # Values too large to cache are not
+    lru.put("f", 1, "x" * 6000)
+    assert lru.get("f", 1) is None
+
+    assert lru.resize(0) > 0
+    assert lru.stats() == {"entries": 0, "bytes": 0, "max_bytes": 0}
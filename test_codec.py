@@ -0,0 +1,70 @@
+# Python standard library imports
+import os
+
+from datetime import datetime
+
+# Our code
+import codec
+import message
+
+
+def test_round_trip():
+    """Make sure messages survive encoding and decoding"""
+    msg = {'to': 'james', 'from': 'jessie', 'subject': 'Ünïcödé ☃',
+           'body': '\U0001F680' * 1000, 'time': datetime(2016, 2, 19, 12)}
+    data = codec.encode(msg)
+    assert codec.is_binary(data)
+    assert codec.decode(data) == msg
+
+    header = codec.decode(data[:60], body=False)
+    assert 'body' not in header
+    assert header['time'] == msg['time']
+    assert header['subject'] == msg['subject']
+
+
+def test_mixed_formats(monkeypatch):
+    """Make sure JSON and binary messages can be read side by side"""
+    message.send_message({'to': 'james', 'from': 'jessie',
+                          'subject': 'json', 'body': 'J'})
+    monkeypatch.setattr(message, 'STORAGE_FORMAT', 'binary')
+    message.send_message({'to': 'james', 'from': 'jessie',
+                          'subject': 'binary', 'body': 'B'})
+
+    extensions = sorted(os.path.splitext(n)[1] for n in os.listdir('messages'))
+    assert extensions == ['.json', '.msg']
+
+    messages = message.load_received_messages('james')
+    assert {(m['subject'], m['body']) for m in messages} == {
+        ('json', 'J'), ('binary', 'B')}
+    for m in messages:
+        assert message.load_message(m['id']) == m
+        message.remove_message(m['id'])
+    assert os.listdir('messages') == []
+
+
+def test_convert_directory():
+    """Make sure converting keeps every message intact"""
+    for c in 'abc':
+        message.send_message({'to': 'james', 'from': 'jessie',
+                              'subject': c, 'body': c.upper()})
+    before = [m.copy() for m in message.load_all_messages()]
+
+    assert codec.convert_directory('messages') == 3
+    assert all(n.endswith('.msg') for n in os.listdir('messages'))
+    assert message.load_all_messages() == before
+
+
+def test_convert_keeping_originals():
+    """Make sure a message kept in both formats is listed once, and
+    removing it removes both files"""
+    message.send_message({'to': 'james', 'from': 'jessie',
+                          'subject': 's', 'body': 'b'})
+    assert codec.convert_directory('messages', keep=True) == 1
+    message._index.clear()  # Rebuilt from both files
+
+    messages = message.load_received_messages('james')
+    assert len(messages) == 1
+    assert message.mailbox_counts('james')['total'] == 1
+    message.remove_message(messages[0]['id'])
+    assert os.listdir('messages') == []
+    assert message.load_received_messages('james') == []
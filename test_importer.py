@@ -0,0 +1,67 @@
+# Python standard library imports
+import csv
+import json
+
+# Our code
+import importer
+import message
+
+
+def test_import_jsonl():
+    """Make sure valid records are imported and bad ones rejected"""
+    records = [
+        {'to': 'James', 'from': 'jessie', 'subject': 'old', 'body': 'b',
+         'time': '2015-01-02 03:04:05'},
+        {'to': 'james', 'from': 'jessie', 'subject': '', 'body': 'b',
+         'time': '2015-01-02 03:04:05'},
+        {'to': 'james', 'from': 'jessie', 'subject': 's', 'body': 'b',
+         'time': 'yesterday'},
+        {'to': 'jessie', 'from': 'james', 'subject': 'new', 'body': 'b',
+         'time': '2016-01-02 03:04:05',
+         'id': 'b58cba44-da39-11e5-9342-56f85ff10656'},
+    ]
+    with open('in.jsonl', 'w') as f:
+        for r in records:
+            f.write(json.dumps(r) + '\n')
+        f.write('not json\n')
+
+    progress = importer.import_file('in.jsonl', batch_size=1, workers=2,
+                                    rejects='rejects.jsonl')
+    assert (progress['records'], progress['imported'],
+            progress['rejected']) == (5, 2, 3)
+    with open('rejects.jsonl') as f:
+        assert [json.loads(line)['record'] for line in f] == [2, 3, 5]
+
+    old, = message.load_received_messages('james')
+    assert (old['subject'], old['from']) == ('old', 'jessie')
+    assert old['time'].year == 2015
+    new, = message.load_received_messages('jessie')
+    assert new['id'] == 'b58cba44-da39-11e5-9342-56f85ff10656'
+
+    # Importing again saves nothing new
+    progress = importer.import_file('in.jsonl')
+    assert (progress['imported'], progress['duplicates']) == (0, 2)
+    assert len(message.load_all_messages()) == 2
+
+
+def test_import_csv_checkpoint():
+    """Make sure an import resumes from its checkpoint"""
+    with open('in.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['from', 'to', 'subject', 'body', 'time'])
+        for i in range(10):
+            writer.writerow(['jessie', 'james', 's{}'.format(i),
+                             'line one\nline, "two"',
+                             '2016-02-{:02} 12:00:00'.format(i + 1)])
+
+    importer.save_checkpoint('in.ckpt', 'in.csv', {
+        'records': 4, 'imported': 4, 'duplicates': 0, 'rejected': 0})
+    progress = importer.import_file('in.csv', batch_size=3,
+                                    checkpoint='in.ckpt')
+    assert (progress['records'], progress['imported']) == (10, 10)
+    messages = message.load_received_messages('james')
+    assert [m['subject'] for m in messages] == [
+        's{}'.format(i) for i in range(9, 3, -1)]
+    assert messages[0]['body'] == 'line one\nline, "two"'
+    with open('in.ckpt') as f:
+        assert json.load(f)['records'] == 10
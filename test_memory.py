@@ -0,0 +1,47 @@
+# Our code
+import memory
+import message
+
+
+def teardown_function(function):
+    memory.configure(budget=0)
+    memory.stop_tracing()
+
+
+def send(body):
+    message.send_message({'from': 'jessie', 'to': 'james',
+                          'subject': 's', 'body': body})
+
+
+def test_budget_shrinks_caches():
+    """Make sure going over the budget shrinks the message cache, and
+    only by the excess"""
+    for i in range(20):
+        send('b' * 1000)
+    for msg in message.load_received_messages('james'):
+        message.load_message(msg['id'])
+    accounts = memory.accounted()
+    assert accounts['message_cache'] > 20 * 1000
+    assert accounts['message_index'] > 0
+    assert memory.enforce_budget() == 0  # No budget
+
+    total = sum(accounts.values())
+    memory.configure(budget=total - 5000)
+    freed = memory.enforce_budget()
+    assert 5000 <= freed < 10000
+    assert sum(memory.accounted().values()) <= total - 5000
+    assert message._cache.max_bytes == message.CACHE_BYTES
+
+
+def test_tracing_report():
+    """Make sure reports list where memory is allocated, and what grew
+    since the first snapshot"""
+    assert not memory.report()['tracing']
+    memory.start_tracing()
+    kept = [bytearray(1000) for _ in range(1000)]
+    report = memory.report(limit=5)
+    assert report['tracing'] and len(report['top']) == 5
+    grown = [s for s in report['since_first'] if 'test_memory.py' in s['site']]
+    assert grown[0]['bytes_diff'] >= 1000 * 1000
+    assert grown[0]['count_diff'] >= 1000
+    del kept
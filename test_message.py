@@ -0,0 +1,511 @@
+# Python standard library imports
+import json
+import os
+import tempfile
+import uuid
+
+from datetime import datetime
+
+# Our code
+import message
+
+
+def send(sender, receiver, subject="s", body="b"):
+    """A helper function to send a message without going through the
+    web app.
+
+    """
+    message.send_message({'from': sender, 'to': receiver,
+                          'subject': subject, 'body': body})
+
+
+def test_index_tracks_outside_changes():
+    """Make sure the index notices files added behind its back"""
+    send('jessie', 'james')
+    assert len(message.load_received_messages('james')) == 1
+
+    # Copy the message file under a new name, like another process would
+    filename, = os.listdir('messages')
+    with open(os.path.join('messages', filename)) as original:
+        data = original.read()
+    with open('messages/b58cba44-da39-11e5-9342-56f85ff10656.json', 'w') as f:
+        f.write(data)
+
+    assert len(message.load_received_messages('james')) == 2
+
+
+def test_index_snapshot(monkeypatch):
+    """Make sure a saved index snapshot is loaded instead of scanning"""
+    for _ in range(3):
+        send('jessie', 'james')
+    send('james', 'jessie')
+    expected = [m['id'] for m in message.load_sent_messages('jessie')]
+
+    monkeypatch.setattr(message, 'INDEX_SNAPSHOT', 'index.snapshot')
+    message.save_index_snapshot()
+
+    # Forget everything, and make sure we don't scan again
+    message._index.clear()
+
+    def no_scan(directory):
+        raise AssertionError("Should have loaded the snapshot")
+    monkeypatch.setattr(message, '_scan_messages', no_scan)
+
+    assert [m['id'] for m in message.load_sent_messages('jessie')] == expected
+    assert len(message.load_received_messages('jessie')) == 1
+
+
+def test_parallel_loading(monkeypatch):
+    """Make sure the parallel loader gives the same answer, in the
+    same order, as loading one message at a time"""
+    for i in range(40):
+        send('jessie' if i % 3 else 'james', 'cassidy', subject=str(i))
+    monkeypatch.setattr(message, 'LOAD_WORKERS', 1)
+    message._index.clear()
+    expected = message.load_all_messages()
+
+    monkeypatch.setattr(message, 'LOAD_WORKERS', 4)
+    monkeypatch.setattr(message, 'PARALLEL_THRESHOLD', 2)
+    message._index.clear()  # Forces a (parallel) rescan
+    assert message.load_all_messages() == expected
+    assert message.load_received_messages('cassidy') == expected
+
+
+def test_read_fields_tricky_bodies():
+    """Make sure fields are found correctly no matter what the subject
+    and body contain"""
+    body = 'He said "to": "cassidy", \\"from\\": \\\\ ☃ \U0001F680'
+    send('jessie', 'james', subject='"time": "never"', body=body)
+
+    msg, = message.load_all_messages()
+    assert msg['to'] == 'james'
+    assert msg['from'] == 'jessie'
+    assert msg['subject'] == '"time": "never"'
+    assert msg['body'] == body
+    assert message.load_message(msg['id'])['body'] == body
+
+
+def test_read_fields_other_layouts():
+    """Make sure files written in other layouts still load"""
+    fields = {'body': 'B', 'subject': 'S', 'to': 'james', 'from': 'jessie',
+              'time': '2016-02-19 12:00:00'}
+    with open('messages/b58cba44-da39-11e5-9342-56f85ff10656.json', 'w') as f:
+        json.dump(fields, f)  # Body first
+    with open('messages/c58cba44-da39-11e5-9342-56f85ff10656.json', 'w') as f:
+        json.dump(fields, f, separators=(',', ':'))  # Compact
+
+    messages = message.load_received_messages('james')
+    assert len(messages) == 2
+    for m in messages:
+        assert (m['subject'], m['body'], m['from']) == ('S', 'B', 'jessie')
+
+
+def test_lazy_bodies(monkeypatch):
+    """Make sure listing messages doesn't read their bodies"""
+    send('jessie', 'james', body='secret')
+    bodies_read = []
+    original = message._read_body
+
+    def counting_read_body(filename):
+        bodies_read.append(filename)
+        return original(filename)
+    monkeypatch.setattr(message, '_read_body', counting_read_body)
+
+    msg, = message.load_sent_messages('jessie')
+    assert set(msg) == {'id', 'from', 'to', 'subject', 'body', 'time'}
+    assert msg['subject'] == 's'
+    assert bodies_read == []
+
+    assert msg['body'] == 'secret'
+    assert len(bodies_read) == 1
+
+
+def test_compressed_bodies(monkeypatch):
+    """Make sure large bodies are stored compressed and read back"""
+    body = 'All work and no play makes Jack a dull boy.\n' * 5000
+    for storage_format in ('json', 'binary'):
+        monkeypatch.setattr(message, 'STORAGE_FORMAT', storage_format)
+        send('jessie', 'james', subject=storage_format, body=body)
+    send('jessie', 'james', subject='small', body='tiny')
+
+    sizes = {}
+    for name in os.listdir('messages'):
+        sizes[name] = os.path.getsize(os.path.join('messages', name))
+        if name.endswith('.json'):
+            with open(os.path.join('messages', name)) as f:
+                data = json.load(f)
+            if data['subject'] == 'small':
+                assert 'encoding' not in data
+            else:
+                assert data['encoding'] == 'zlib'
+    assert sorted(sizes.values())[-1] < len(body) // 10
+
+    decompressed = []
+    original = message._decode_body
+
+    def counting_decode_body(body, encoding):
+        if encoding:
+            decompressed.append(encoding)
+        return original(body, encoding)
+    monkeypatch.setattr(message, '_decode_body', counting_decode_body)
+
+    messages = message.load_received_messages('james')
+    assert decompressed == []
+    for m in messages:
+        full = message.load_message(m['id'])
+        assert m['subject'] == full['subject']
+        assert m['body'] == full['body']
+        assert m['body'] == ('tiny' if m['subject'] == 'small' else body)
+    assert decompressed == ['zlib'] * 4
+
+    # Turning compression off does not affect reading
+    monkeypatch.setattr(message, 'COMPRESS_THRESHOLD', 0)
+    send('jessie', 'james', subject='plain', body=body)
+    plain = [m for m in message.load_received_messages('james')
+             if m['subject'] == 'plain']
+    assert plain[0]['body'] == body
+
+
+def test_streamed_bodies(monkeypatch):
+    """Make sure bodies can be written from and read into streams"""
+    # Quotes, backslashes, control characters and surrogate pairs, cut
+    # at every possible place by small chunks
+    body = 'He said "\\o/"\n\t\u00e9\U0001F680 ' * 3000
+    monkeypatch.setattr(message, 'STREAM_CHUNK', 61)
+    for storage_format in ('json', 'binary'):
+        monkeypatch.setattr(message, 'STORAGE_FORMAT', storage_format)
+        for threshold in (0, 1024):
+            monkeypatch.setattr(message, 'COMPRESS_THRESHOLD', threshold)
+            with tempfile.TemporaryFile() as body_file:
+                body_file.write(body.encode('utf-8'))
+                send('jessie', 'james', subject=storage_format,
+                     body=body_file)
+
+    assert os.listdir('messages/.incoming') == []
+    messages = message.load_received_messages('james')
+    assert len(messages) == 4
+    for m in messages:
+        assert m['body'] == body
+        pieces = list(message.iter_message_body(m['id']))
+        assert len(pieces) > 1
+        assert ''.join(pieces) == body
+
+    # Bodies saved all at once can be streamed too
+    monkeypatch.setattr(message, 'STORAGE_FORMAT', 'json')
+    send('jessie', 'cassidy', body=body)
+    m, = message.load_received_messages('cassidy')
+    assert ''.join(message.iter_message_body(m['id'])) == body
+
+
+def test_threads(monkeypatch):
+    """Make sure replies are grouped into threads, in both formats,
+    and that the thread index survives a rescan"""
+    send('jessie', 'james', subject='first')
+    first, = message.load_sent_messages('jessie')
+    message.send_message({'from': 'james', 'to': 'jessie', 'subject': 'Re',
+                          'body': 'b', 'in_reply_to': first['id']})
+    reply, = message.load_sent_messages('james')
+    monkeypatch.setattr(message, 'STORAGE_FORMAT', 'binary')
+    message.send_message({'from': 'jessie', 'to': 'james', 'subject': 'Re',
+                          'body': 'b', 'in_reply_to': reply['id']})
+    send('jessie', 'cassidy')
+
+    assert reply['in_reply_to'] == reply['thread'] == first['id']
+    thread = message.load_thread(reply['id'])
+    assert len(thread) == 3
+    assert [m['time'] for m in thread] == sorted(m['time'] for m in thread)
+    last = [m for m in thread if m['id'] not in (first['id'], reply['id'])][0]
+    assert last['in_reply_to'] == reply['id']
+    assert last['thread'] == first['id']
+    assert 'thread' not in first
+
+    # The same threads are found by scanning the files
+    message._index.clear()
+    assert {m['id'] for m in message.load_thread(last['id'])} == \
+        {m['id'] for m in thread}
+
+    # Replies stay together once the first message is gone
+    message.remove_message(first['id'])
+    assert len(message.load_thread(reply['id'])) == 2
+
+    try:
+        message.send_message({'from': 'james', 'to': 'jessie', 'subject': 's',
+                              'body': 'b', 'in_reply_to': first['id']})
+    except ValueError:
+        pass
+    else:
+        assert False, "Replied to a deleted message"
+
+
+def test_mailbox_counts():
+    """Make sure received and unread counts follow sends, reads and
+    deletes, and survive a rescan"""
+    for _ in range(3):
+        send('jessie', 'james')
+    send('james', 'jessie')
+    first, second, third = message.load_received_messages('james')
+    assert message.mailbox_counts('james') == {'total': 3, 'unread': 3}
+
+    assert message.mark_read(first['id'])
+    assert not message.mark_read(first['id'])
+    assert message.mailbox_counts('james') == {'total': 3, 'unread': 2}
+    assert message.mailbox_counts('jessie') == {'total': 1, 'unread': 1}
+
+    # Another process marking a message read is noticed
+    open(os.path.join('messages', message.READ_DIR, second['id']), 'w').close()
+    assert message.mailbox_counts('james') == {'total': 3, 'unread': 1}
+
+    message._index.clear()
+    assert message.mailbox_counts('james') == {'total': 3, 'unread': 1}
+    assert message.is_read(second['id']) and not message.is_read(third['id'])
+
+    message.remove_messages([first['id'], third['id']])
+    assert message.mailbox_counts('james') == {'total': 1, 'unread': 0}
+    assert os.listdir(os.path.join('messages', message.READ_DIR)) == \
+        [second['id']]
+    message.remove_all_messages()
+    assert message.mailbox_counts('james') == {'total': 0, 'unread': 0}
+    assert os.listdir(os.path.join('messages', message.READ_DIR)) == []
+
+
+def test_remove_user_messages():
+    """Make sure a user's messages can be removed by mailbox and time,
+    leaving everyone else's alone"""
+    def imported(sender, receiver, day):
+        return message.import_messages([{
+            'id': str(uuid.uuid4()), 'from': sender, 'to': receiver,
+            'subject': 's', 'body': 'b', 'time': datetime(2020, 1, day)}])[0]
+    old, middle, new = (imported('jessie', 'james', d) for d in (1, 2, 3))
+    reply = imported('james', 'jessie', 2)
+    other = imported('butch', 'cassidy', 2)
+
+    assert message.remove_user_messages(
+        'james', sent=False, start=datetime(2020, 1, 2),
+        end=datetime(2020, 1, 3)) == 1
+    assert not message.has_message(middle)
+    assert message.remove_user_messages('jessie', received=False) == 2
+    assert [m['id'] for m in message.load_received_messages('jessie')] == \
+        [reply]
+    assert message.remove_user_messages('jessie') == 1
+    assert message.has_message(other)
+    assert not any(message.has_message(i) for i in (old, new, reply))
+
+
+def test_remove_messages_keeps_undeletable(monkeypatch):
+    """Make sure a message whose file cannot be deleted stays listed,
+    and keeps its read marker"""
+    for _ in range(3):
+        send('jessie', 'james')
+    first, stuck, last = sorted(
+        m['id'] for m in message.load_received_messages('james'))
+    message.mark_read(stuck)
+    stuck_file = message._message_filename(stuck)
+    remove = os.remove
+
+    def guarded_remove(path, *args, **kwargs):
+        if os.path.abspath(path) == os.path.abspath(stuck_file):
+            raise PermissionError(13, "Permission denied", path)
+        return remove(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, 'remove', guarded_remove)
+    try:
+        message.remove_messages([first, stuck, last])
+    except PermissionError:
+        pass
+    else:
+        assert False, "Removed an undeletable message"
+    monkeypatch.undo()
+
+    assert not message.has_message(first)
+    assert message.has_message(stuck) and message.has_message(last)
+    assert message.is_read(stuck)
+    assert message.mailbox_counts('james') == {'total': 2, 'unread': 1}
+    message._index.clear()  # What a rescan finds agrees
+    assert message.mailbox_counts('james') == {'total': 2, 'unread': 1}
+
+
+def test_message_cache(monkeypatch):
+    """Make sure loaded messages are cached, and dropped when their
+    file changes or is deleted"""
+    message._cache.clear()  # Of earlier tests' messages
+    send('jessie', 'james', body='cached')
+    msg, = message.load_received_messages('james')
+    filename = message._message_filename(msg['id'])
+    assert message.load_message(msg['id'])['body'] == 'cached'
+
+    def no_reads(*args, **kwargs):
+        raise AssertionError("Read a cached message")
+    with monkeypatch.context() as patch:
+        patch.setattr(message, '_read_fields', no_reads)
+        assert message.load_message(msg['id'])['body'] == 'cached'
+        assert message.load_message(msg['id'], lazy=True)['subject'] == 's'
+
+    # A message replaced on disk is read again
+    with open(filename) as f:
+        data = json.load(f)
+    data['body'] = 'changed'
+    with open(filename + '.new', 'w') as f:
+        json.dump(data, f)
+    os.replace(filename + '.new', filename)
+    assert message.load_message(msg['id'])['body'] == 'changed'
+
+    message.remove_message(msg['id'])
+    assert message._cache.stats()['entries'] == 0
+
+
+def _other_worker(first_id, second_id):
+    """Changes messages/ from another process"""
+    send('jessie', 'james', subject='from another worker')
+    message.mark_read(first_id)
+    message.remove_message(second_id)
+
+
+def test_change_log(monkeypatch):
+    """Make sure changes made by another process are replayed from the
+    change log, and an unlogged change still causes a rescan"""
+    import multiprocessing
+    import time
+
+    monkeypatch.setattr(message, 'CHANGE_LOG', 'changes.db')
+    for _ in range(2):
+        send('jessie', 'james')
+    first, second = message.load_received_messages('james')
+    assert message.mailbox_counts('james') == {'total': 2, 'unread': 2}
+
+    def scan(directory):
+        raise AssertionError("messages/ was rescanned")
+    scan_messages = message._scan_messages
+    monkeypatch.setattr(message, '_scan_messages', scan)
+
+    time.sleep(0.05)  # So that the directory stamps change
+    worker = multiprocessing.get_context('fork').Process(
+        target=_other_worker, args=(first['id'], second['id']))
+    worker.start()
+    worker.join()
+    assert worker.exitcode == 0
+
+    received = message.load_received_messages('james')
+    assert sorted(m['subject'] for m in received) == \
+        ['from another worker', 's']
+    assert message.is_read(first['id'])
+    assert message.mailbox_counts('james') == {'total': 2, 'unread': 1}
+
+    # Our own changes are logged too, and don't look like someone else's
+    message.remove_message(first['id'])
+    assert message.mailbox_counts('james') == {'total': 1, 'unread': 1}
+
+    time.sleep(0.05)
+    kept, = message.load_received_messages('james')
+    with open(os.path.join('messages', kept['id'] + '.json')) as f:
+        data = f.read()
+    with open('messages/b58cba44-da39-11e5-9342-56f85ff10656.json', 'w') as f:
+        f.write(data)
+    monkeypatch.setattr(message, '_scan_messages', scan_messages)
+    assert message.mailbox_counts('james') == {'total': 2, 'unread': 2}
+
+
+def _crashing_worker(how):
+    """Dies halfway through sending a message"""
+    def die(*args, **kwargs):
+        if how == 'torn':
+            with open(args[0], 'w') as f:
+                f.write('{"to": "james", "from": "jessie", "subj')
+        os._exit(0)
+    if how == 'after write':
+        message.ChangeLog.complete = die
+    else:
+        message._write_record = die
+    send('jessie', 'james', subject=how)
+
+
+def test_change_log_batches_are_atomic():
+    """Make sure a batch of intents that fails partway logs nothing"""
+    import sqlite3
+
+    from changelog import ChangeLog
+
+    log = ChangeLog('changes.db')
+    try:
+        with log.transaction():
+            try:
+                log.intend([('remove', 'a'), ('remove', 'b', 'x', 'y', 'z',
+                                              'w', 'too many fields')])
+            except sqlite3.Error:
+                pass
+            else:
+                assert False, "Logged a malformed change"
+            assert log.pending() == [] and log.last_seq() == 0
+            seqs = log.intend([('remove', 'a')])
+            assert [s for s, _, _ in log.pending()] == seqs
+    finally:
+        log.close()
+
+
+def test_crash_recovery(monkeypatch):
+    """Make sure changes left halfway by a process that died are
+    recovered from the change log without a rescan, and that a process
+    starting up replays the log from the last checkpoint"""
+    import multiprocessing
+
+    monkeypatch.setattr(message, 'CHANGE_LOG', 'changes.db')
+    monkeypatch.setattr(message, 'INDEX_SNAPSHOT', 'index.pickle')
+    monkeypatch.setattr(message, 'CHECKPOINT_EVERY', 1)
+    send('jessie', 'james', subject='before')
+    assert message.mailbox_counts('james')['total'] == 1
+    assert os.path.exists('index.pickle')
+
+    def scan(directory):
+        raise AssertionError("messages/ was rescanned")
+    monkeypatch.setattr(message, '_scan_messages', scan)
+
+    for how in ('after write', 'before write', 'torn'):
+        worker = multiprocessing.get_context('fork').Process(
+            target=_crashing_worker, args=(how,))
+        worker.start()
+        worker.join()
+    # Before, the complete message and the torn one
+    assert len([f for f in os.listdir('messages') if f.endswith('.json')]) \
+        == 3
+
+    received = message.load_received_messages('james')
+    assert sorted(m['subject'] for m in received) == ['after write', 'before']
+    assert sorted(f for f in os.listdir('messages')
+                  if f.endswith('.json')) == sorted(
+                      m['id'] + '.json' for m in received)
+    assert not message._change_log().pending()
+
+    # A new process loads the last checkpoint and replays the rest
+    message._index.clear()
+    assert message.mailbox_counts('james')['total'] == 2
+
+
+def test_claim_directory(monkeypatch):
+    """Make sure processes may only share messages/ if they all use a
+    change log"""
+    import fcntl
+
+    message.claim_directory()
+    other = open(os.path.join('messages', '.serving'))
+    try:
+        try:
+            fcntl.flock(other, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            pass
+        else:
+            assert False, "Shared messages/ without a change log"
+
+        monkeypatch.setattr(message, 'CHANGE_LOG', 'changes.db')
+        message.claim_directory()  # Replaces the exclusive claim
+        fcntl.flock(other, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        monkeypatch.setattr(message, 'CHANGE_LOG', None)
+        try:
+            message.claim_directory()
+        except RuntimeError:
+            pass
+        else:
+            assert False, "Claimed messages/ another process shares"
+    finally:
+        other.close()
+        message._claim.close()
+        message._claim = None
+    assert message.load_all_messages() == []
@@ -0,0 +1,83 @@
+# Python standard library imports
+import json
+import os
+
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+# Our code
+import message
+import metrics
+import retention
+
+
+NOW = datetime(2016, 3, 1, 12)
+
+
+def write(sender, receiver, days_old):
+    """A helper function to save a message sent ``days_old`` days
+    before ``NOW``. Returns its ID."""
+    message_id = str(uuid4())
+    sent = NOW - timedelta(days=days_old)
+    with open(os.path.join('messages', message_id + '.json'), 'w') as f:
+        json.dump({'to': receiver, 'from': sender, 'subject': 's',
+                   'time': sent.strftime(message.DATE_FORMAT),
+                   'body': 'b'}, f)
+    return message_id
+
+
+def setup_function(function):
+    retention.configure(max_age_days=0, max_count=0, users={},
+                        batch_size=100, rate=200.0, dry_run=False)
+
+
+def teardown_function(function):
+    setup_function(function)
+
+
+def test_max_age():
+    """Make sure old messages expire, unless a mailbox keeps them"""
+    old = write('jessie', 'james', 40)
+    write('jessie', 'james', 10)
+    kept = write('jessie', 'giovanni', 40)
+    retention.configure(max_age_days=30,
+                        users={'Giovanni': {'max_age_days': 0}})
+
+    report = retention.run_once(now=NOW)
+    assert report['expired'] == report['deleted'] == 1
+    assert report['by_reason'] == {'age': 1, 'count': 0}
+    assert report['sample'] == [old]
+    assert sorted(m['id'] for m in message.load_all_messages()) == sorted(
+        [kept] + [m['id'] for m in message.load_received_messages('james')])
+    assert len(message.load_all_messages()) == 2
+
+
+def test_max_count():
+    """Make sure full mailboxes are trimmed, oldest first"""
+    ids = [write('jessie', 'james', days) for days in (5, 4, 3, 2, 1)]
+    retention.configure(max_count=2, batch_size=2)
+
+    report = retention.run_once(now=NOW)
+    assert report['by_reason'] == {'age': 0, 'count': 3}
+    assert [m['id'] for m in message.load_all_messages()] == ids[:-3:-1]
+
+
+def test_dry_run():
+    """Make sure dry runs report, but do not delete"""
+    for days in (50, 40, 1):
+        write('jessie', 'james', days)
+    retention.configure(max_age_days=30, dry_run=True)
+
+    before = retention.last_report()
+    assert retention.report_expired(now=NOW)['expired'] == 2
+    assert retention.last_report() == before
+    report = retention.run_once(now=NOW)
+    assert (report['expired'], report['deleted']) == (2, 0)
+    assert retention.last_report() == report
+    assert len(message.load_all_messages()) == 3
+    assert 'rockettalk_retention_pending 2' in metrics.render()
+
+    report = retention.run_once(dry_run=False, now=NOW)
+    assert report['deleted'] == 2
+    assert len(message.load_all_messages()) == 1
+    assert 'rockettalk_retention_pending 0' in metrics.render()
@@ -1,9 +1,11 @@
 # Python standard library imports
+import io
 import json
 import os
 import pickle
 import random
 import string
+import tarfile
 import time
 
 from base64 import b64decode
@@ -212,6 +214,65 @@ def test_view_authorization():
     assert urlsplit(response.location).path == "/"
 
 
+def test_threads():
+    """Make sure replies show up in the conversation, which only the
+    people in it may see"""
+    app = HelperApp(server.message_app)
+    app.post('/login/', {'username': 'jessie', 'password': 'frog'})
+    app.post('/compose/', {'to': 'james', 'subject': 'Lunch?', 'body': 'A'})
+    first, = message.load_sent_messages('jessie')
+
+    app.get('/logout/')
+    app.post('/login/', {'username': 'james', 'password': 'potato'})
+    response = app.get('/compose/?reply_to={}'.format(first['id']))
+    assert 'value="Re: Lunch?"' in response.text
+    app.post('/compose/', {'to': 'jessie', 'subject': 'Re: Lunch?',
+                           'body': 'Sure', 'in_reply_to': first['id']})
+    reply, = message.load_sent_messages('james')
+    assert reply['in_reply_to'] == first['id']
+
+    response = app.get('/thread/{}/'.format(reply['id']))
+    assert response.status == "200 OK"
+    assert response.text.index('Lunch?') < response.text.index('Sure')
+
+    # Cassidy can neither see the thread nor reply to it
+    app.get('/logout/')
+    app.post('/login/', {'username': 'cassidy', 'password': 'dog'})
+    response = app.get('/thread/{}/'.format(first['id']))
+    assert urlsplit(response.location).path == "/"
+    app.get('/')
+    response = app.post('/compose/', {'to': 'jessie', 'subject': 's',
+                                      'body': 'b', 'in_reply_to': first['id']})
+    assert urlsplit(response.location).path == "/compose/"
+    assert unpack_alerts(app.cookies) == [
+        {'kind': 'danger', 'message': 'No such message ' + first['id']}]
+    assert message.load_sent_messages('cassidy') == []
+
+
+def test_unread_counts():
+    """Make sure viewing a received message marks it as read, and that
+    the counts are on every page and at /counts/"""
+    app = HelperApp(server.message_app)
+    app.post('/login/', {'username': 'jessie', 'password': 'frog'})
+    for subject in ('a', 'b'):
+        app.post('/compose/', {'to': 'james', 'subject': subject,
+                               'body': 'S'})
+    msg = message.load_sent_messages('jessie')[0]
+
+    # The sender viewing it does not count
+    app.get('/view/{}/'.format(msg['id']))
+    app.get('/logout/')
+    app.post('/login/', {'username': 'james', 'password': 'potato'})
+    assert app.get('/counts/').json == {'total': 2, 'unread': 2}
+
+    app.get('/view/{}/'.format(msg['id']))
+    assert app.get('/counts/').json == {'total': 2, 'unread': 1}
+    assert '>1 / 2</span>' in app.get('/compose/').text
+
+    app.post('/shred/')
+    assert app.get('/counts/').json == {'total': 0, 'unread': 0}
+
+
 def test_compose_success_alerts():
     """Try adding an message and check for success messages."""
     app = HelperApp(server.message_app)
@@ -433,6 +494,41 @@ def test_shred():
     assert len(glob("messages/*.json")) == 0
 
 
+def test_scoped_shred():
+    """Make sure users can only shred their own messages, and only
+    administrators can shred everyone's"""
+    app = HelperApp(server.message_app)
+    app.post('/login/', {'username': 'butch', 'password': 'toothpaste'})
+    app.post('/compose/', {'to': 'cassidy', 'subject': 's', 'body': 'b'})
+    app.post('/login/', {'username': 'jessie', 'password': 'frog'})
+    app.post('/compose/', {'to': 'james', 'subject': 's', 'body': 'b'})
+    app.get('/compose/')  # Clears alerts
+
+    response = app.post('/shred/', {'until': 'yesterday'})
+    assert urlsplit(response.location).path == "/shred/"
+    app.get('/shred/')
+    app.post('/shred/', {'mailbox': 'received'})
+    assert unpack_alerts(app.cookies) == [{'kind': 'success',
+                                           'message': 'Shreded 0 messages.'}]
+    app.get('/shred/')
+    app.post('/shred/', {'mailbox': 'sent',
+                         'since': datetime.now().strftime('%Y-%m-%d')})
+    assert unpack_alerts(app.cookies) == [{'kind': 'success',
+                                           'message': 'Shreded 1 messages.'}]
+    assert len(glob("messages/*.json")) == 1
+
+    # Everyone's messages need an administrator
+    response = app.post('/admin/shred/')
+    assert urlsplit(response.location).path == "/"
+    assert len(glob("messages/*.json")) == 1
+    server.authentication.ADMIN_USERS.add('jessie')
+    try:
+        app.post('/admin/shred/')
+    finally:
+        server.authentication.ADMIN_USERS.discard('jessie')
+    assert len(glob("messages/*.json")) == 0
+
+
 def test_list_login():
     """Make sure we get redirected as expected for /"""
     assert_redirect_to_login('/')
@@ -547,3 +643,212 @@ def test_logout():
     response = app.get('/logout/')
     assert response.status == "200 OK"
     assert app.cookies['logged_in_as'] == ""
+
+
+def test_metrics():
+    """Make sure requests and storage calls show up in /metrics"""
+    app = HelperApp(server.message_app)
+    app.post('/login/', {'username': 'jessie', 'password': 'frog'})
+    app.post('/compose/', {'to': 'james', 'subject': 's', 'body': 'S'})
+    app.get('/')
+
+    response = app.get('/metrics')
+    assert response.status == "200 OK"
+    assert response.content_type == "text/plain"
+
+    text = response.text
+    assert 'rockettalk_http_requests_total{method="GET",route="/",' \
+        'status="200"}' in text
+    assert 'rockettalk_storage_seconds_count{op="send_message"}' in text
+    assert 'rockettalk_password_check_seconds_count' in text
+    assert ('rockettalk_template_render_seconds_count'
+            '{template="templates/list_messages.html"}') in text
+
+
+def test_profiles():
+    """Make sure admins can profile requests with the X-Profile header"""
+    app = HelperApp(server.message_app)
+    app.post('/login/', {'username': 'jessie', 'password': 'frog'})
+
+    # Only administrators may see profiles
+    response = app.get('/admin/profiles/')
+    assert response.status == "302 Found"
+    assert urlsplit(response.location).path == "/"
+
+    server.authentication.ADMIN_USERS.add('jessie')
+    try:
+        app.get('/', headers={'X-Profile': '1'})
+        profiles = app.get('/admin/profiles/').json['profiles']
+    finally:
+        server.authentication.ADMIN_USERS.discard('jessie')
+
+    assert profiles[0]['path'] == '/'
+    assert 'list_messages' in profiles[0]['summary']
+    assert os.path.exists(profiles[0]['file'])
+
+
+def test_backup():
+    """Make sure admins can download a backup of every message"""
+    app = HelperApp(server.message_app)
+    app.post('/login/', {'username': 'jessie', 'password': 'frog'})
+    app.post('/compose/', {'to': 'james', 'subject': 's', 'body': 'S'})
+
+    response = app.get('/admin/backup/')
+    assert response.status == "302 Found"
+
+    server.authentication.ADMIN_USERS.add('jessie')
+    try:
+        response = app.get('/admin/backup/')
+    finally:
+        server.authentication.ADMIN_USERS.discard('jessie')
+
+    assert response.content_type == "application/gzip"
+    with tarfile.open(fileobj=io.BytesIO(response.body), mode='r:gz') as tar:
+        names = tar.getnames()
+    assert names == ['MANIFEST.jsonl'] + [
+        os.path.basename(f) for f in glob('messages/*.json')]
+    assert not os.listdir('messages/.snapshots')
+
+
+def test_memory_report():
+    """Make sure admins can see what caches and indexes hold"""
+    app = HelperApp(server.message_app)
+    app.post('/login/', {'username': 'jessie', 'password': 'frog'})
+    assert app.get('/admin/memory/').status == "302 Found"
+
+    server.authentication.ADMIN_USERS.add('jessie')
+    try:
+        report = app.get('/admin/memory/').json
+    finally:
+        server.authentication.ADMIN_USERS.discard('jessie')
+    assert set(report['accounts']) >= {'message_cache', 'message_index'}
+    assert report['accounted'] == sum(report['accounts'].values())
+    assert not report['tracing']
+
+
+def test_compose_large_body(monkeypatch):
+    """Make sure large bodies are spooled, stored and streamed back,
+    and that too large bodies are refused"""
+    app = HelperApp(server.message_app)
+    app.post('/login/', {'username': 'jessie', 'password': 'frog'})
+    app.get('/')
+
+    body = ''.join(random.choice(string.ascii_letters + ' &%=+\u00e9')
+                   for _ in range(300 * 1024))
+    app.post('/compose/', {'to': 'james', 'subject': 'big', 'body': body})
+    assert unpack_alerts(app.cookies) == [{'kind': 'success',
+                                           'message': 'Message sent!'}]
+
+    msg, = message.load_sent_messages('jessie')
+    assert msg['body'] == body
+    response = app.get('/view/{}/'.format(msg['id']))
+    assert body in response.text
+
+    monkeypatch.setattr(server.streaming, 'MAX_BODY_SIZE', 1000)
+    app.get('/')
+    response = app.post('/compose/', {'to': 'james', 'subject': 'huge',
+                                      'body': 'x' * 1001})
+    assert urlsplit(response.location).path == "/compose/"
+    alerts = unpack_alerts(app.cookies)
+    assert alerts == [{'kind': 'danger', 'message': 'Message body is too '
+                       'large (the limit is 1000 bytes).'}]
+    assert len(message.load_sent_messages('jessie')) == 1
+
+
+def test_unknown_ids_skip_storage(monkeypatch):
+    """Make sure unknown message IDs are turned away without looking
+    for their files"""
+    app = HelperApp(server.message_app)
+    app.post('/login/', {'username': 'jessie', 'password': 'frog'})
+    app.post('/compose/', {'to': 'james', 'subject': 's', 'body': 'b'})
+    msg, = message.load_sent_messages('jessie')
+
+    def no_files(message_id):
+        raise AssertionError("Looked for a message file")
+    monkeypatch.setattr(message, '_message_filename', no_files)
+    bogus_uuid = "b58cba44-da39-11e5-9342-56f85ff10656"
+    for path in ('/view/{}/', '/delete/{}/'):
+        app.get('/compose/')  # Clears alerts
+        response = app.get(path.format(bogus_uuid))
+        assert urlsplit(response.location).path == "/"
+        assert unpack_alerts(app.cookies) == [
+            {'kind': 'danger', 'message': 'No such message ' + bogus_uuid}]
+
+    # Known messages are still checked, without reading them either
+    cassidy = HelperApp(server.message_app)
+    cassidy.post('/login/', {'username': 'cassidy', 'password': 'dog'})
+    cassidy.get('/compose/')
+    cassidy.get('/delete/{}/'.format(msg['id']))
+    assert unpack_alerts(cassidy.cookies) == [
+        {'kind': 'danger', 'message': 'User not authorized to view message'}]
+    text = app.get('/metrics').text
+    assert 'rockettalk_authorization_total{outcome="unknown"} ' in text
+    assert 'rockettalk_index_messages 1' in text
+
+
+def test_bulk_delete():
+    """Delete many messages in one request, and get one alert summing
+    up what happened to each"""
+    app = HelperApp(server.message_app)
+    app.post('/login/', {'username': 'jessie', 'password': 'frog'})
+    for i in range(5):
+        app.post('/compose/', {'to': 'james', 'subject': str(i), 'body': 'b'})
+    message.send_message({'from': 'james', 'to': 'cassidy',
+                          'subject': 'private', 'body': 'b'})
+    mine = [m['id'] for m in message.load_sent_messages('jessie')]
+    private, = [m['id'] for m in message.load_sent_messages('james')]
+    bogus_uuid = "b58cba44-da39-11e5-9342-56f85ff10656"
+    assert mine[0] in app.get('/').text  # Listed with a checkbox; clears
+
+    response = app.post('/delete/', [('id', i) for i in mine[:4]] +
+                        [('id', mine[0]), ('id', private), ('id', bogus_uuid)])
+    assert urlsplit(response.location).path == "/"
+    assert unpack_alerts(app.cookies) == [{
+        'kind': 'warning',
+        'message': 'Deleted 4 of 6 messages. No such message: {}. '
+                   'Not authorized: {}.'.format(bogus_uuid, private)}]
+    assert [m['id'] for m in message.load_sent_messages('jessie')] == \
+        mine[4:]
+    assert message.load_sent_messages('james')
+
+    app.get('/')
+    app.post('/delete/', {'id': mine[4]})
+    assert unpack_alerts(app.cookies) == [
+        {'kind': 'success', 'message': 'Deleted 1 of 1 messages.'}]
+    app.get('/')
+    app.post('/delete/')
+    assert unpack_alerts(app.cookies) == [
+        {'kind': 'danger', 'message': 'No messages selected.'}]
+
+
+def test_streamed_view_timing(monkeypatch):
+    """Make sure the latency metric and profiles include the time spent
+    rendering a streamed page, after the handler has returned"""
+    def slow_body(message_id):
+        time.sleep(0.2)
+        yield 'Slow body'
+
+    monkeypatch.setattr(server, 'iter_message_body', slow_body)
+    message.send_message({'to': 'jessie', 'from': 'james',
+                          'subject': 's', 'body': 'b'})
+    message_id = message.load_received_messages('jessie')[0]['id']
+    app = HelperApp(server.message_app)
+    app.post('/login/', {'username': 'jessie', 'password': 'frog'})
+    server.metrics.reset()
+
+    server.authentication.ADMIN_USERS.add('jessie')
+    try:
+        response = app.get('/view/{}/'.format(message_id),
+                           headers={'X-Profile': '1'})
+        profiles = app.get('/admin/profiles/').json['profiles']
+    finally:
+        server.authentication.ADMIN_USERS.discard('jessie')
+    assert 'Slow body' in response.text
+
+    key = server.metrics._key('rockettalk_http_request_duration_seconds',
+                              {'method': 'GET',
+                               'route': '/view/<message_id:re:[0-9a-f\\-]'
+                                        '{36}>/'})
+    assert server.metrics._histograms[key][-1] >= 0.2
+    assert profiles[0]['duration'] >= 0.2
+    assert 'slow_body' in profiles[0]['summary']
@@ -0,0 +1,151 @@
+# Python standard library imports
+import multiprocessing
+import os
+import shutil
+import socket
+import time
+import urllib.error
+import urllib.request
+
+from glob import glob
+
+# Other libraries
+from webtest import TestApp as HelperApp  # To avoid confusing PyTest
+
+# Our code
+import sharding
+
+
+def teardown_function(function):
+    sharding._settings.update(nodes={}, name=None, secret=None)
+    sharding._ring = None
+
+
+def free_port(start=8500):
+    """Finds a free port that server.py will accept"""
+    for port in range(start, 9000):
+        with socket.socket() as s:
+            try:
+                s.bind(("127.0.0.1", port))
+            except OSError:
+                continue
+            return port
+    raise RuntimeError("No free port")
+
+
+def run_node(name, nodes):
+    """Runs a node in its own directory, in a child process"""
+    if not os.path.isdir(name):
+        os.mkdir(name)
+        os.mkdir(os.path.join(name, "messages"))
+        shutil.copyfile("passwords.json",
+                        os.path.join(name, "passwords.json"))
+        shutil.copytree("templates", os.path.join(name, "templates"))
+    os.chdir(name)
+    import server
+    argv = ['--production', '--host', '127.0.0.1', '--node-name', name,
+            '--port', nodes[name].rsplit(':', 1)[1],
+            '--shard-secret', 'secret', '--compose-rate', '0']
+    for node, url in nodes.items():
+        argv += ['--node', '{}={}'.format(node, url)]
+    server.main(argv)
+
+
+def start_nodes(nodes):
+    context = multiprocessing.get_context('fork')
+    processes = []
+    for name in nodes:
+        process = context.Process(target=run_node, args=(name, nodes))
+        process.start()
+        processes.append(process)
+    for url in nodes.values():
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(url + '/login/', timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+    return processes
+
+
+def test_hash_ring():
+    """Make sure users are spread evenly, and adding a node only moves
+    users to the new node"""
+    users = ['user{}'.format(i) for i in range(3000)]
+    ring = sharding.HashRing(['a', 'b', 'c'])
+    owners = {u: ring.node_for(u) for u in users}
+    for node in 'abc':
+        assert 0.2 < list(owners.values()).count(node) / len(users) < 0.47
+
+    bigger = sharding.HashRing(['a', 'b', 'c', 'd'])
+    moved = [u for u in users if bigger.node_for(u) != owners[u]]
+    assert all(bigger.node_for(u) == 'd' for u in moved)
+    assert 0.1 < len(moved) / len(users) < 0.4
+
+
+def stop_nodes(processes):
+    for process in processes:
+        process.terminate()
+        process.join()
+
+
+def login(username, password):
+    app = HelperApp(sharding.Router())
+    app.post('/login/', {'username': username, 'password': password})
+    return app
+
+
+def test_sharded_nodes():
+    """Make sure the router sends users to their own node, messages
+    reach recipients on other nodes, and adding a node and rebalancing
+    moves its users' messages there"""
+    port = free_port()
+    # A second node that takes james, but not jessie, from the first
+    second = next(n for n in 'bcdefghijk'
+                  if sharding.HashRing(['a', n]).node_for('james') == n and
+                  sharding.HashRing(['a', n]).node_for('jessie') == 'a')
+    nodes = {'a': 'http://127.0.0.1:{}'.format(port)}
+    processes = start_nodes(nodes)
+    try:
+        sharding.configure(nodes=nodes, secret='secret')
+        jessie = login('jessie', 'frog')
+        jessie.post('/compose/', {'to': 'james', 'subject': 'Before',
+                                  'body': 'b'})
+        assert 'Before' in login('james', 'potato').get('/').text
+    finally:
+        stop_nodes(processes)
+
+    nodes[second] = 'http://127.0.0.1:{}'.format(free_port(port + 1))
+    processes = start_nodes(nodes)
+    try:
+        sharding.configure(nodes=nodes)
+        report = sharding._post('a', '/internal/rebalance/', None,
+                                'application/json', 0)
+        assert report == {'checked': 1, 'delivered': 1, 'removed': 0,
+                          'failed': 0}
+        assert len(glob(os.path.join(second, 'messages', '*.json'))) == 1
+
+        # Messages between nodes are delivered to the recipient's node
+        jessie = login('jessie', 'frog')
+        response = jessie.post('/compose/', {'to': 'james',
+                                             'subject': 'After',
+                                             'body': 'b'})
+        assert response.location.endswith('/')  # Sent, not sent back
+        assert 'After' in jessie.get('/').text
+        james = login('james', 'potato')
+        text = james.get('/').text
+        assert 'Before' in text and 'After' in text
+        assert len(glob(os.path.join(second, 'messages', '*.json'))) == 2
+
+        # Only other nodes may use /internal/
+        james.post('/internal/rebalance/', status=404)
+        try:
+            urllib.request.urlopen(urllib.request.Request(
+                nodes['a'] + '/internal/rebalance/', data=b'',
+                method='POST'))
+        except urllib.error.HTTPError as e:
+            assert e.code == 403
+        else:
+            assert False, "Rebalanced without the secret"
+    finally:
+        stop_nodes(processes)